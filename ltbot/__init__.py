@@ -4,9 +4,12 @@ This module contains classes and functions for using a Twitch bot and
 Lichess bot for playing chess on Lichess with Twitch chat.
 
     * Lichess - Handles Lichess connections
+    * AsyncLichess - Handles Lichess connections with asyncio
     * LichessTwitchBot - Bot for playing on Lichess with Twitch chat
+    * ShardSupervisor - Runs the bot in many channels over shard processes
     * load_configuration - Loads bot configuration from yaml file
     * setup_logging - Enables logging for program
+    * start_metrics_server - Serves metrics in the Prometheus text format
 
     COPYRIGHT INFORMATION
     ---------------------
@@ -16,6 +19,8 @@ Some code in this file is licensed under the Apache License, Version 2.0.
     http://aws.amazon.com/apache2.0/
 """
 
-from .lichess import Lichess
+from .lichess import Lichess, AsyncLichess
 from .lichess_twitch_bot import LichessTwitchBot
+from .shard import ShardSupervisor
+from .metrics import start_metrics_server
 from .util import load_configuration, setup_logging
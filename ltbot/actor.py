@@ -0,0 +1,202 @@
+"""Bot actor
+
+Single threaded processing of everything that changes the bot state.
+Other threads only send typed inputs to the actor.
+
+    * ChatCommand - A command from Twitch chat
+    * TimerFired - A bot timer ran out
+    * LichessResult - A Lichess request finished
+    * GameUpdate - A new state from a Lichess game stream
+    * GameStreamClosed - A Lichess game stream closed
+    * Actor - Handles inputs from a queue on a single thread
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, NamedTuple
+
+import chess
+
+from .commands import Command
+from .metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+INPUT_WAIT_SECONDS = REGISTRY.histogram(
+    "ltbot_actor_wait_seconds", "Time inputs waited for the bot actor", ("input",)
+)
+TRANSITION_SECONDS = REGISTRY.histogram(
+    "ltbot_actor_transition_seconds",
+    "Time the bot actor took to handle an input",
+    ("input", "from_state", "to_state"),
+)
+
+
+class ChatCommand(NamedTuple):
+    user: dict
+    command: Command
+
+
+class TimerFired(NamedTuple):
+    timer: str
+    args: tuple = ()
+
+
+class LichessResult(NamedTuple):
+    request: str
+    args: tuple
+    future: Future
+
+
+class GameUpdate(NamedTuple):
+    game_id: str
+    color: chess.Color
+    board: chess.Board
+    state: object
+
+
+class GameStreamClosed(NamedTuple):
+    game_id: str
+
+
+class Actor:
+    """Handles inputs from a queue on a single thread
+
+    Inputs are dispatched to a handler by their type, and the handlers
+    are the only code that changes the state they own, so that state
+    needs no locks. Timers are kept by the actor and fire as inputs in
+    the same queue. The wait and handling time of every input is
+    recorded, labelled with the state before and after it.
+
+    ---
+
+    Methods
+    -------
+    send(message)
+        Queues an input, safe to call from any thread
+    send_after(delay, message)
+        Queues an input after a delay
+    drain()
+        Handles the queued inputs on the calling thread
+    start()
+        Starts the actor thread
+    stop()
+        Stops the actor thread
+    """
+
+    def __init__(self, handlers: dict, state: Callable[[], str] = None, name: str = "actor"):
+        """
+        Parameters
+        ----------
+        handlers : dict
+            Handler called with the input, by input type
+        state : Callable[[], str]
+            Returns the name of the current state, for the metrics
+        name : str
+            Name of the actor thread
+        """
+
+        self.handlers = dict(handlers)
+        self.state = state or (lambda: "")
+        self.name = name
+        self._inputs = collections.deque()
+        self._timers = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def send(self, message):
+        """Queue an input
+
+        Parameters
+        ----------
+        message : NamedTuple
+            The input, its type must have a handler
+        """
+
+        with self._condition:
+            self._inputs.append((time.monotonic(), message))
+            self._condition.notify()
+
+    def send_after(self, delay: float, message):
+        """Queue an input after a delay
+
+        Parameters
+        ----------
+        delay : float
+            Seconds to wait before queueing the input
+        message : NamedTuple
+            The input, its type must have a handler
+        """
+
+        with self._condition:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._counter), message))
+            self._condition.notify()
+
+    def start(self):
+        """Start the actor thread"""
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the actor thread, queued inputs and timers are dropped"""
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def drain(self):
+        """Handle the queued inputs and due timers on the calling thread
+
+        Used by replays and tests instead of starting the actor thread.
+        """
+
+        while True:
+            item = self._next(block=False)
+            if item is None:
+                return
+            self._handle(*item)
+
+    def _next(self, block: bool = True):
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    due, _, message = heapq.heappop(self._timers)
+                    self._inputs.append((due, message))
+                if self._inputs:
+                    return self._inputs.popleft()
+                if not block:
+                    return None
+                self._condition.wait(self._timers[0][0] - now if self._timers else None)
+            return None
+
+    def _handle(self, queued: float, message):
+        input_name = type(message).__name__
+        start = time.monotonic()
+        INPUT_WAIT_SECONDS.observe(input_name, value=start - queued)
+        from_state = self.state()
+        try:
+            self.handlers[type(message)](message)
+        except Exception:
+            LOG.exception("Failed to handle {}".format(input_name))
+        TRANSITION_SECONDS.observe(
+            input_name, from_state, self.state(), value=time.monotonic() - start
+        )
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            self._handle(*item)
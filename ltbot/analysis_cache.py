@@ -0,0 +1,418 @@
+"""Analysis cache
+
+Engine results kept by position across games, so positions the bot has
+already searched deep enough, like chat picked openings against the
+same opponents, are played without searching again.
+
+    * Analysis - Result of an engine search
+    * engine_analysis - Reads the result of the last search from an engine
+    * history_matters - Checks if the best move of a position depends on its history
+    * variant_key - Names the variant of a position with the state Zobrist keys leave out
+    * AnalysisCache - In-memory LRU over a SQLite file shared by all processes
+    * required_depth - Depth a cached analysis needs for a time control
+    * open_analysis_cache - Returns the cache of the calling process
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+from typing import NamedTuple, Optional, Tuple
+
+import chess
+import chess.polyglot
+
+LOG = logging.getLogger(__name__)
+
+# Positions kept in memory by every process
+DEFAULT_MEMORY_ENTRIES = 50000
+
+# Seconds to wait for another process writing to the database
+DATABASE_TIMEOUT = 1.0
+
+# Positions this close to the fifty move rule are searched, see history_matters
+MAX_HALFMOVE_CLOCK = 60
+
+# Depth a cached analysis needs by game speed, slower games search deeper
+DEFAULT_MIN_DEPTH = {
+    "ultraBullet": 12,
+    "bullet": 16,
+    "blitz": 20,
+    "rapid": 24,
+    "classical": 28,
+    "correspondence": 32,
+}
+
+
+class Analysis(NamedTuple):
+    best_move: str
+    ponder_move: Optional[str]
+    depth: int
+    score_cp: Optional[int]
+    score_mate: Optional[int]
+
+
+def _signed(key: int) -> int:
+    # SQLite integers are signed 64 bit
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def engine_analysis(
+    engine, best_move: chess.Move, ponder_move: Optional[chess.Move]
+) -> Optional[Analysis]:
+    """Read the result of the last search from an engine
+
+    Parameters
+    ----------
+    engine : EngineWrapper
+        The engine that searched
+    best_move : chess.Move
+        The best move it returned
+    ponder_move : chess.Move
+        The ponder move it returned, if any
+
+    Returns
+    -------
+    Analysis
+        The result, or None if the engine does not report the search depth
+    """
+
+    handlers = getattr(engine.engine, "info_handlers", None)
+    if not handlers or best_move is None:
+        return None
+    info = handlers[0].info
+    depth = info.get("depth")
+    if not depth:
+        return None
+    # Scores are reported by principal variation, the first one is the best move
+    score = info.get("score", {}).get(1)
+    return Analysis(
+        best_move.uci(),
+        ponder_move.uci() if ponder_move else None,
+        depth,
+        getattr(score, "cp", None),
+        getattr(score, "mate", None),
+    )
+
+
+def history_matters(board: chess.Board) -> bool:
+    """Check if the best move of a position depends on how it was reached
+
+    The Zobrist key leaves out repetitions and the halfmove clock, so a
+    cached move could walk into a threefold repetition or a fifty move
+    draw that a search of the game would avoid.
+
+    Parameters
+    ----------
+    board : chess.Board
+        The position with the moves of the game
+
+    Returns
+    -------
+    bool
+        True if the position already occurred or the halfmove clock is high
+    """
+
+    return board.halfmove_clock >= MAX_HALFMOVE_CLOCK or board.is_repetition(2)
+
+
+def variant_key(board: chess.Board) -> str:
+    """Name the variant of a position with the state Zobrist keys leave out
+
+    Polyglot Zobrist keys do not cover the pockets and promoted pieces of
+    crazyhouse or the remaining checks of three-check, so positions that
+    only differ in those would share a key.
+
+    Parameters
+    ----------
+    board : chess.Board
+        The position
+
+    Returns
+    -------
+    str
+        The UCI variant, followed by the variant state if it has any
+    """
+
+    variant = board.uci_variant
+    if variant == "crazyhouse":
+        return "{}[{}/{}]{}".format(
+            variant, board.pockets[chess.WHITE], board.pockets[chess.BLACK], board.promoted
+        )
+    if variant == "3check":
+        return "{}+{}+{}".format(
+            variant, board.remaining_checks[chess.WHITE], board.remaining_checks[chess.BLACK]
+        )
+    return variant
+
+
+class AnalysisCache:
+    """In-memory LRU over a SQLite file shared by all processes
+
+    Positions are keyed by their Zobrist hash and variant, with the
+    pockets or remaining checks of the variants that have them. Lookups
+    check the in-memory tier first and then the database, which every
+    game process opens on its own so they see each other's results. A
+    result only replaces a stored one if it searched deeper. Zobrist keys
+    can collide, so cached moves are only returned if they are legal.
+    Positions whose best move depends on the history of the game, after
+    a repetition or close to the fifty move rule, are neither looked up
+    nor stored.
+
+    ---
+
+    Attributes
+    ----------
+    path : str
+        The database file, None keeps results in memory only
+
+    Methods
+    -------
+    get(board, min_depth=0)
+        Returns the cached analysis of a position, or None
+    put(board, analysis)
+        Stores the analysis of a position
+    lookup(board, min_depth)
+        Returns the cached best and ponder move if searched deep enough
+    store(board, engine, best_move, ponder_move)
+        Stores the result of the last search of an engine
+    close()
+        Closes the database
+    """
+
+    def __init__(self, path: str = None, memory_entries: int = DEFAULT_MEMORY_ENTRIES):
+        """
+        Parameters
+        ----------
+        path : str
+            The database file, created if missing, None keeps results in
+            memory only
+        memory_entries : int
+            Positions kept in memory
+        """
+
+        self.path = path
+        self.memory_entries = memory_entries
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._database = None
+        if path is not None:
+            self._database = sqlite3.connect(
+                path, timeout=DATABASE_TIMEOUT, check_same_thread=False, isolation_level=None
+            )
+            # Readers do not block the writing process in write ahead log mode
+            self._database.execute("PRAGMA journal_mode=WAL")
+            self._database.execute("PRAGMA synchronous=NORMAL")
+            self._database.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                "key INTEGER NOT NULL, variant TEXT NOT NULL, best_move TEXT NOT NULL, "
+                "ponder_move TEXT, depth INTEGER NOT NULL, score_cp INTEGER, score_mate INTEGER, "
+                "PRIMARY KEY (key, variant)) WITHOUT ROWID"
+            )
+
+    def __len__(self):
+        """Number of positions in memory"""
+
+        return len(self._memory)
+
+    def _key(self, board: chess.Board) -> tuple:
+        return chess.polyglot.zobrist_hash(board), variant_key(board)
+
+    def _remember(self, key: tuple, analysis: Analysis):
+        self._memory[key] = analysis
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, board: chess.Board, min_depth: int = 0) -> Optional[Analysis]:
+        """Get the cached analysis of a position
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position
+        min_depth : int
+            An analysis in memory that is shallower is looked up in the
+            database, another process may have searched deeper
+
+        Returns
+        -------
+        Analysis
+            The deepest stored analysis, or None if the position is not cached
+        """
+
+        key = self._key(board)
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+                if cached.depth >= min_depth or self._database is None:
+                    return cached
+            if self._database is None:
+                return None
+            try:
+                row = self._database.execute(
+                    "SELECT best_move, ponder_move, depth, score_cp, score_mate FROM analysis "
+                    "WHERE key = ? AND variant = ?",
+                    (_signed(key[0]), key[1]),
+                ).fetchone()
+            except sqlite3.Error:
+                LOG.exception("Failed to read analysis cache")
+                return cached
+            if row is None:
+                return cached
+            analysis = Analysis(*row)
+            self._remember(key, analysis)
+            return analysis
+
+    def put(self, board: chess.Board, analysis: Analysis):
+        """Store the analysis of a position, unless a deeper one is cached
+
+        Parameters
+        ----------
+        board : chess.Board
+            The searched position
+        analysis : Analysis
+            The search result
+        """
+
+        key = self._key(board)
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and cached.depth > analysis.depth:
+                return
+            self._remember(key, analysis)
+            if self._database is None:
+                return
+            try:
+                self._database.execute(
+                    "INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key, variant) DO UPDATE SET best_move = excluded.best_move, "
+                    "ponder_move = excluded.ponder_move, depth = excluded.depth, "
+                    "score_cp = excluded.score_cp, score_mate = excluded.score_mate "
+                    "WHERE excluded.depth >= analysis.depth",
+                    (_signed(key[0]), key[1], *analysis),
+                )
+            except sqlite3.Error:
+                LOG.exception("Failed to write analysis cache")
+
+    def lookup(
+        self, board: chess.Board, min_depth: int
+    ) -> Optional[Tuple[chess.Move, Optional[chess.Move]]]:
+        """Get the cached best and ponder move if searched deep enough
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position to play in
+        min_depth : int
+            Shallower analyses are not used
+
+        Returns
+        -------
+        Tuple[chess.Move, Optional[chess.Move]]
+            Best and ponder move, or None if the position has to be searched,
+            always for a repeated position or a high halfmove clock
+        """
+
+        if history_matters(board):
+            return None
+        analysis = self.get(board, min_depth)
+        if analysis is None or analysis.depth < min_depth:
+            return None
+        best_move = chess.Move.from_uci(analysis.best_move)
+        if not board.is_legal(best_move):
+            return None
+        ponder_move = None
+        if analysis.ponder_move:
+            ponder_move = chess.Move.from_uci(analysis.ponder_move)
+            board.push(best_move)
+            if not board.is_legal(ponder_move):
+                ponder_move = None
+            board.pop()
+        return best_move, ponder_move
+
+    def store(
+        self, board: chess.Board, engine, best_move: chess.Move, ponder_move: Optional[chess.Move]
+    ):
+        """Store the result of the last search of an engine
+
+        Parameters
+        ----------
+        board : chess.Board
+            The searched position
+        engine : EngineWrapper
+            The engine that searched
+        best_move : chess.Move
+            The best move it returned
+        ponder_move : chess.Move
+            The ponder move it returned, if any
+        """
+
+        if history_matters(board):
+            return
+        analysis = engine_analysis(engine, best_move, ponder_move)
+        if analysis is not None:
+            self.put(board, analysis)
+
+    def close(self):
+        with self._lock:
+            if self._database is not None:
+                self._database.close()
+                self._database = None
+
+
+def required_depth(cache_config: dict, speed: str) -> int:
+    """Get the depth a cached analysis needs for a time control
+
+    Parameters
+    ----------
+    cache_config : dict
+        The engine analysis_cache configuration, min_depth is a depth
+        for every game or a depth by game speed
+    speed : str
+        The Lichess speed of the game, like "blitz"
+
+    Returns
+    -------
+    int
+        The minimum depth
+    """
+
+    min_depth = cache_config.get("min_depth", DEFAULT_MIN_DEPTH)
+    if isinstance(min_depth, dict):
+        return min_depth.get(speed, max(min_depth.values()))
+    return min_depth
+
+
+_cache = None
+_cache_pid = None
+
+
+def open_analysis_cache(cache_config: dict) -> AnalysisCache:
+    """Get the cache of the calling process, opening it on first use
+
+    SQLite connections must not be used across a fork, so every process
+    opens its own.
+
+    Parameters
+    ----------
+    cache_config : dict
+        The engine analysis_cache configuration, with the database path
+        and the number of positions kept in memory
+
+    Returns
+    -------
+    AnalysisCache
+        The cache, shared by every game of the process
+    """
+
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = AnalysisCache(
+            cache_config.get("path", "analysis.sqlite3"),
+            cache_config.get("memory_entries", DEFAULT_MEMORY_ENTRIES),
+        )
+        _cache_pid = os.getpid()
+    return _cache
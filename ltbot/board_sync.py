@@ -0,0 +1,200 @@
+"""Board sync
+
+Keeps the board of a game in step with the move lists Lichess sends,
+and checkpoints it so a game stream that reconnects resumes from the
+last checkpoint instead of replaying the whole game.
+
+    * BoardSync - Applies the difference between move lists to a board
+    * resume_board - Returns the board sync of a game, from its checkpoint if there is one
+    * release_board - Drops the checkpoint of a finished game
+"""
+
+import collections
+import logging
+from typing import List
+
+import chess
+
+LOG = logging.getLogger(__name__)
+
+# Plies between checkpoints of a game
+DEFAULT_CHECKPOINT_INTERVAL = 16
+
+# Games whose checkpoint is kept, a game process plays one game at a time
+MAX_CHECKPOINTS = 8
+
+# Latest board and move list of every game, by game id
+_checkpoints = collections.OrderedDict()
+
+
+class BoardSync:
+    """Applies the difference between move lists to a board
+
+    Lichess sends the whole move list with every game state. The moves
+    after the applied ones are pushed, and if the list does not extend
+    the applied moves, after a takeback or a missed update, the board is
+    rewound to the common part of both lists first. Every few plies the
+    board is checkpointed for resume_board.
+
+    ---
+
+    Attributes
+    ----------
+    board : chess.Board
+        The board of the game
+    moves : List[str]
+        Applied moves in UCI notation
+    rewound : int
+        Plies taken back by the last update
+
+    Methods
+    -------
+    update(moves)
+        Brings the board to a move list
+    checkpoint()
+        Saves the board for resume_board
+    """
+
+    def __init__(
+        self,
+        game_id: str,
+        board: chess.Board,
+        moves: str = "",
+        checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL,
+    ):
+        """
+        Parameters
+        ----------
+        game_id : str
+            Id of the game, the checkpoints are saved under it
+        board : chess.Board
+            Board with the moves of moves already pushed, usually the
+            starting position with no moves
+        moves : str
+            Space separated moves already pushed on the board
+        checkpoint_interval : int
+            Plies between checkpoints
+        """
+
+        self.game_id = game_id
+        self.board = board
+        self.moves = moves.split()
+        self.rewound = 0
+        self.checkpoint_interval = checkpoint_interval
+        self._applied = " ".join(self.moves)
+        self._checkpoint_ply = len(self.moves)
+
+    def update(self, moves: str) -> List[str]:
+        """Bring the board to a move list
+
+        Parameters
+        ----------
+        moves : str
+            Full move list from the game state
+
+        Returns
+        -------
+        List[str]
+            Moves pushed on the board, after the rewound plies were taken back
+        """
+
+        applied = self._applied
+        if moves.startswith(applied) and (
+            not applied or len(moves) == len(applied) or moves[len(applied)] == " "
+        ):
+            keep = len(self.moves)
+            new_moves = moves[len(applied) :].split()
+        else:
+            incoming = moves.split()
+            keep = 0
+            for applied_move, move in zip(self.moves, incoming):
+                if applied_move != move:
+                    break
+                keep += 1
+            new_moves = incoming[keep:]
+
+        self.rewound = len(self.moves) - keep
+        if self.rewound:
+            LOG.debug("Rewinding {} plies of game {}".format(self.rewound, self.game_id))
+        for _ in range(self.rewound):
+            self.board.pop()
+        del self.moves[keep:]
+        for move in new_moves:
+            self.board.push(chess.Move.from_uci(move))
+        self.moves.extend(new_moves)
+        self._applied = moves.strip()
+
+        if len(self.moves) < self._checkpoint_ply:
+            self._checkpoint_ply = len(self.moves)
+        elif len(self.moves) - self._checkpoint_ply >= self.checkpoint_interval:
+            self.checkpoint()
+        return new_moves
+
+    def checkpoint(self):
+        """Save a copy of the board for resume_board"""
+
+        _checkpoints[self.game_id] = (self.board.copy(), self._applied)
+        _checkpoints.move_to_end(self.game_id)
+        while len(_checkpoints) > MAX_CHECKPOINTS:
+            _checkpoints.popitem(last=False)
+        self._checkpoint_ply = len(self.moves)
+
+    def __len__(self):
+        """Number of applied plies"""
+
+        return len(self.moves)
+
+
+def resume_board(
+    game_id: str,
+    board: chess.Board,
+    moves: str,
+    checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL,
+) -> BoardSync:
+    """Get the board sync of a game, from its checkpoint if there is one
+
+    A game stream that reconnects resumes from the last checkpoint of
+    the game, if the move list still extends it, and only pushes the
+    moves played since.
+
+    Parameters
+    ----------
+    game_id : str
+        Id of the game
+    board : chess.Board
+        Starting position of the game, used without a checkpoint
+    moves : str
+        Full move list of the game
+    checkpoint_interval : int
+        Plies between checkpoints
+
+    Returns
+    -------
+    BoardSync
+        The board sync, brought to the move list
+    """
+
+    applied = ""
+    checkpoint = _checkpoints.get(game_id)
+    if checkpoint is not None:
+        saved_board, saved_moves = checkpoint
+        if moves.startswith(saved_moves) and (
+            len(moves) == len(saved_moves) or moves[len(saved_moves)] == " "
+        ):
+            LOG.debug("Resuming game {} from ply {}".format(game_id, len(saved_board.move_stack)))
+            board, applied = saved_board.copy(), saved_moves
+    sync = BoardSync(game_id, board, applied, checkpoint_interval)
+    sync.update(moves)
+    return sync
+
+
+def release_board(game_id: str):
+    """Drop the checkpoint of a finished game
+
+    Parameters
+    ----------
+    game_id : str
+        Id of the game
+    """
+
+    _checkpoints.pop(game_id, None)
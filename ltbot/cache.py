@@ -0,0 +1,107 @@
+"""TTL cache
+
+Small thread safe cache with a time to live per entry, used for Lichess
+lookups that change rarely.
+
+    * TTLCache - Cache with per-entry expiry and request collapsing
+"""
+
+import threading
+import time
+
+
+class _Flight:
+    """Load of a cache entry that other callers can wait for"""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """Cache with per-entry expiry and collapsing of concurrent loads
+
+    When several threads ask for the same missing key at once, only the
+    first one calls the loader and the others wait for its result.
+
+    ---
+
+    Methods
+    -------
+    get_or_load(key, loader, ttl)
+        Returns the cached value or loads it
+    invalidate(key=None)
+        Drops one entry or the whole cache
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader, ttl: float):
+        """Get a cached value, loading it if missing or expired
+
+        Parameters
+        ----------
+        key : Hashable
+            Cache key
+        loader : Callable[[], Any]
+            Loads the value, exceptions are passed on to every waiter
+        ttl : float
+            Seconds the loaded value stays valid
+
+        Returns
+        -------
+            The cached or loaded value
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                # An invalidation during the load means the value may be stale
+                if flight.error is None and self._flights.get(key) is flight:
+                    self._entries[key] = (time.monotonic() + ttl, flight.value)
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, key=None):
+        """Drop cached values
+
+        Parameters
+        ----------
+        key : Hashable
+            Key to drop, None drops every entry
+        """
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._flights.clear()
+            else:
+                self._entries.pop(key, None)
+                self._flights.pop(key, None)
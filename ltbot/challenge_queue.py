@@ -0,0 +1,202 @@
+"""Challenge queue
+
+Priority queue of the challenges lichess_bot waits to accept.
+
+    * ChallengeQueue - Heap of challenges by score or arrival, with expiry
+"""
+
+import heapq
+import itertools
+import logging
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class ChallengeQueue:
+    """Heap of challenges by score or arrival, with expiry
+
+    Challenges are ordered by their score, best first, or in arrival
+    order. Canceled challenges are removed lazily: they are forgotten at
+    once and their heap entries skipped when they come up. Challenges
+    older than the maximum age are dropped the same way, Lichess has
+    expired them by then.
+
+    The queue is owned by the dispatcher. Game processes see the queued
+    challenges through a shared list view, which is replaced by publish
+    once per change instead of being edited entry by entry.
+
+    Not thread safe, the dispatcher loop is the only caller.
+
+    ---
+
+    Methods
+    -------
+    push(challenge, now=None)
+        Queues a challenge, replacing a queued challenge with the same id
+    pop(now=None)
+        Takes the next challenge to accept and the time it was queued
+    remove(challenge_id)
+        Forgets a challenge
+    snapshot(now=None)
+        Lists the queued challenges in the order they will be taken
+    publish(now=None)
+        Updates the shared view if the queue changed
+    """
+
+    def __init__(self, sort_by: str = "best", max_age: float = None, view=None):
+        """
+        Parameters
+        ----------
+        sort_by : str
+            "best" takes the challenge with the highest score first,
+            anything else takes the oldest challenge first
+        max_age : float
+            Seconds a challenge is kept, None keeps challenges until they
+            are taken or removed
+        view : list
+            Shared list, e.g. a Manager list, that publish keeps up to date
+        """
+
+        self.by_score = sort_by == "best"
+        self.max_age = max_age
+        self.view = view
+        self._heap = []
+        # Queued challenge, the time it was queued and its heap sequence number, by id
+        self._challenges = {}
+        self._counter = itertools.count()
+        self._changed = False
+
+    def __len__(self):
+        """Number of queued challenges, expired ones included until they come up"""
+
+        return len(self._challenges)
+
+    def __contains__(self, challenge_id: str):
+        return challenge_id in self._challenges
+
+    def push(self, challenge, now: float = None):
+        """Queue a challenge, replacing a queued challenge with the same id
+
+        Parameters
+        ----------
+        challenge : Challenge
+            The challenge
+        now : float
+            Current time.monotonic(), the time the challenge arrived, read
+            if not given
+        """
+
+        if now is None:
+            now = time.monotonic()
+        sequence = next(self._counter)
+        # The sequence number keeps the order of equal scores and marks the
+        # entry, a replaced challenge leaves a stale entry in the heap
+        self._challenges[challenge.id] = (challenge, now, sequence)
+        heapq.heappush(self._heap, (*self._heap_key(challenge, sequence), challenge.id))
+        self._changed = True
+        self._compact()
+
+    def pop(self, now: float = None):
+        """Take the next challenge to accept and the time it was queued
+
+        Parameters
+        ----------
+        now : float
+            Current time.monotonic(), read if not given
+
+        Returns
+        -------
+        tuple
+            The challenge and the time.monotonic() it was queued at, or
+            None if the queue is empty
+        """
+
+        if now is None:
+            now = time.monotonic()
+        while self._heap:
+            _, sequence, challenge_id = heapq.heappop(self._heap)
+            entry = self._challenges.get(challenge_id)
+            if entry is None or entry[2] != sequence:
+                continue
+            del self._challenges[challenge_id]
+            self._changed = True
+            challenge, queued, _ = entry
+            if self._expired(queued, now):
+                LOG.info("    Drop expired {}".format(challenge))
+                continue
+            return challenge, queued
+        return None
+
+    def remove(self, challenge_id: str) -> bool:
+        """Forget a challenge, its heap entry is skipped when it comes up
+
+        Parameters
+        ----------
+        challenge_id : str
+            Id of the challenge
+
+        Returns
+        -------
+        bool
+            True if the challenge was queued
+        """
+
+        if self._challenges.pop(challenge_id, None) is None:
+            return False
+        self._changed = True
+        self._compact()
+        return True
+
+    def snapshot(self, now: float = None) -> list:
+        """List the queued challenges in the order they will be taken
+
+        Parameters
+        ----------
+        now : float
+            Current time.monotonic(), read if not given
+
+        Returns
+        -------
+        list
+            The queued challenges that have not expired
+        """
+
+        if now is None:
+            now = time.monotonic()
+        entries = sorted(
+            (self._heap_key(challenge, sequence), challenge)
+            for challenge, queued, sequence in self._challenges.values()
+            if not self._expired(queued, now)
+        )
+        return [challenge for _, challenge in entries]
+
+    def publish(self, now: float = None):
+        """Update the shared view if the queue changed since the last publish
+
+        Parameters
+        ----------
+        now : float
+            Current time.monotonic(), read if not given
+        """
+
+        if self.view is None or not self._changed:
+            return
+        self.view[:] = self.snapshot(now)
+        self._changed = False
+
+    def _heap_key(self, challenge, sequence: int) -> tuple:
+        return (-challenge.score() if self.by_score else 0, sequence)
+
+    def _expired(self, queued: float, now: float) -> bool:
+        return self.max_age is not None and now - queued > self.max_age
+
+    def _compact(self):
+        # Rebuild once stale entries outnumber the live ones, so the heap
+        # stays proportional to the queue however many challenges are canceled
+        if len(self._heap) > 2 * len(self._challenges) + 16:
+            self._heap = [
+                (*self._heap_key(challenge, sequence), challenge.id)
+                for challenge, _, sequence in self._challenges.values()
+            ]
+            heapq.heapify(self._heap)
@@ -0,0 +1,92 @@
+"""Chat logs
+
+Recording of incoming Twitch chat to a compact log that can be replayed,
+see ltbot.replay.
+
+    * ChatRecorder - Writes incoming chat events to a compressed log
+    * read_chat_log - Reads the events of a chat log
+"""
+
+import gzip
+import json
+import time
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from irc.client import Event
+
+
+class ChatRecorder:
+    """Writes incoming chat events to a gzip compressed log
+
+    Every event is one JSON line with its receive time, so a log can be
+    replayed at the pace it was recorded. Logs are appended to, a log
+    that spans restarts replays each run in turn.
+
+    ---
+
+    Methods
+    -------
+    record(event)
+        Writes an event to the log
+    close()
+        Flushes and closes the log
+    """
+
+    def __init__(self, path: Path):
+        """
+        Parameters
+        ----------
+        path : Path
+            The log file, usually ending in .jsonl.gz
+        """
+
+        self.path = Path(path)
+        self._stream = gzip.open(self.path, "at", encoding="utf-8")
+
+    def record(self, event: Event):
+        """Write an event to the log
+
+        Parameters
+        ----------
+        event : Event
+            The received IRC event
+        """
+
+        line = {
+            "time": time.time(),
+            "type": event.type,
+            "source": str(event.source),
+            "target": event.target,
+            "arguments": event.arguments,
+            # Twitch sends every tag on every message, a flat dict keeps it short
+            "tags": {tag["key"]: tag["value"] for tag in event.tags or ()},
+        }
+        self._stream.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self._stream.close()
+
+
+def read_chat_log(path: Path) -> Iterator[Tuple[float, Event]]:
+    """Read the events of a chat log
+
+    Parameters
+    ----------
+    path : Path
+        A log written by ChatRecorder
+
+    Returns
+    -------
+    Iterator[Tuple[float, Event]]
+        Receive time and event of every recorded message
+    """
+
+    with gzip.open(path, "rt", encoding="utf-8") as stream:
+        for line in stream:
+            record = json.loads(line)
+            tags = [{"key": key, "value": value} for key, value in record["tags"].items()]
+            event = Event(
+                record["type"], record["source"], record["target"], record["arguments"], tags
+            )
+            yield record["time"], event
@@ -0,0 +1,81 @@
+"""Twitch chat commands
+
+Routing of chat messages to the configured bot commands.
+
+    * Command - A routed chat command
+    * CommandRouter - Matches chat messages against the configured commands
+"""
+
+from typing import NamedTuple, Optional
+
+# Commands that are followed by a space and an argument
+ARGUMENT_COMMANDS = frozenset(("challenge_vote", "clock_limit", "clock_increment", "move_vote"))
+
+
+class Command(NamedTuple):
+    name: str
+    argument: str
+
+
+class CommandRouter:
+    """Matches chat messages against the configured commands
+
+    The router is built once from the command configuration. Most chat
+    messages are not commands, so a message is first checked against the
+    set of characters that commands start with, and then looked up in a
+    single dictionary by its first word.
+
+    ---
+
+    Attributes
+    ----------
+    commands : dict
+        Command string by command name
+
+    Methods
+    -------
+    route(message)
+        Returns the command in a message, or None
+    """
+
+    def __init__(self, commands: dict, argument_commands: frozenset = ARGUMENT_COMMANDS):
+        """
+        Parameters
+        ----------
+        commands : dict
+            Command string by command name, as in configuration["command"]
+        argument_commands : frozenset
+            Names of the commands that take an argument
+        """
+
+        self.commands = dict(commands)
+        self._routes = {
+            command: (name, name in argument_commands) for name, command in self.commands.items()
+        }
+        self._first_characters = frozenset(command[0] for command in self._routes if command)
+
+    def route(self, message: str) -> Optional[Command]:
+        """Find the command in a chat message
+
+        Parameters
+        ----------
+        message : str
+            The chat message
+
+        Returns
+        -------
+        Command
+            Name and argument of the command, or None if the message is
+            not a command
+        """
+
+        if not message or message[0] not in self._first_characters:
+            return None
+        word, separator, argument = message.partition(" ")
+        route = self._routes.get(word)
+        if route is None:
+            return None
+        name, takes_argument = route
+        if takes_argument != bool(separator):
+            return None
+        return Command(name, argument)
@@ -0,0 +1,79 @@
+"""Control event bus
+
+Carries the control events of lichess_bot to its dispatcher without a
+Manager process: the Lichess event stream is read by a thread of the
+dispatcher process, and game workers report finished games through the
+result pipe of the process pool.
+
+    * ControlBus - In-process queue of control events with their receive time
+"""
+
+import logging
+import queue
+import time
+
+try:
+    from .metrics import REGISTRY
+except ImportError:
+    # Imported as a top-level module by lichess_bot
+    from metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+CONTROL_WAIT_SECONDS = REGISTRY.histogram(
+    "ltbot_control_wait_seconds", "Time control events waited for the dispatcher", ("event",)
+)
+
+
+class ControlBus:
+    """In-process queue of control events with their receive time
+
+    Events are kept as the decoded objects, nothing is pickled or sent
+    to another process. Producers are threads of the dispatcher process:
+    the event stream reader and the result handler of the process pool.
+
+    ---
+
+    Methods
+    -------
+    put_nowait(event)
+        Queues an event, safe to call from any thread
+    get(timeout=None)
+        Takes the next event and the time it was received
+    """
+
+    def __init__(self):
+        self._events = queue.SimpleQueue()
+
+    def put_nowait(self, event):
+        """Queue an event
+
+        Parameters
+        ----------
+        event : StreamEvent
+            The event, anything with item access to its "type"
+        """
+
+        self._events.put_nowait((time.monotonic(), event))
+
+    def get(self, timeout: float = None):
+        """Take the next event and the time it was received
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for an event, None waits forever
+
+        Returns
+        -------
+        tuple
+            time.monotonic() when the event was queued and the event, or
+            None if the wait timed out
+        """
+
+        try:
+            received, event = self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        CONTROL_WAIT_SECONDS.observe(event["type"], value=time.monotonic() - received)
+        return received, event
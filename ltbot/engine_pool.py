@@ -0,0 +1,269 @@
+"""Warm engine pool
+
+Engines kept running between games, so a game does not wait for the
+engine to start, load its network and allocate its hash table.
+
+    * EnginePool - Warm engines of one process, reset and checked between games
+    * init_engine_pool - Creates the pool of a game worker process
+    * acquire_engine - Takes an engine for a game from the worker pool
+    * release_engine - Returns the engine of a finished game to the worker pool
+"""
+
+import collections
+import logging
+import multiprocessing.util
+from typing import Callable
+
+import chess
+
+LOG = logging.getLogger(__name__)
+
+
+def engine_key(board: chess.Board) -> tuple:
+    """Engines are created for a variant, only games of that variant reuse them"""
+
+    return type(board).uci_variant, board.chess960
+
+
+def reset_engine(engine, options: dict = None):
+    """Start a new game on an engine, clearing its hash table and history
+
+    UCI engines also get the options they were created with again, so an
+    option changed during a game does not carry over to the next one.
+
+    Parameters
+    ----------
+    engine : EngineWrapper
+        The engine of a finished game
+    options : dict
+        UCI options the engine was created with
+    """
+
+    inner = engine.engine
+    if hasattr(inner, "ucinewgame"):
+        inner.ucinewgame()
+        if options and hasattr(inner, "setoption"):
+            inner.setoption(dict(options))
+    elif hasattr(inner, "new"):
+        inner.new()
+
+
+def check_engine(engine) -> bool:
+    """Check that an engine is running and answers
+
+    Parameters
+    ----------
+    engine : EngineWrapper
+        The engine to check
+
+    Returns
+    -------
+    bool
+        True if the engine can play
+    """
+
+    inner = engine.engine
+    try:
+        if hasattr(inner, "is_alive") and not inner.is_alive():
+            return False
+        if hasattr(inner, "isready"):
+            inner.isready()
+        elif hasattr(inner, "ping"):
+            inner.ping()
+    except Exception:
+        LOG.exception("Engine health check failed")
+        return False
+    return True
+
+
+class EnginePool:
+    """Warm engines of one process, reset and checked between games
+
+    Engines returned after a game are reset with a new game command and
+    the options they were created with, and kept by variant. An engine is checked before it is handed out and
+    replaced by a new one if it stopped answering. At most size engines
+    are kept, the least recently returned are quit first.
+
+    Not thread safe, a game worker process plays one game at a time.
+
+    ---
+
+    Methods
+    -------
+    warm(board)
+        Starts engines for the variant of a board until the pool is full
+    acquire(board)
+        Takes an engine for a game on a board
+    release(engine, board)
+        Returns the engine of a finished game
+    close()
+        Quits every idle engine
+    """
+
+    def __init__(self, engine_factory: Callable, size: int = 1, options: dict = None):
+        """
+        Parameters
+        ----------
+        engine_factory : Callable
+            Creates an engine for a board
+        size : int
+            Idle engines kept at most
+        options : dict
+            UCI options the factory creates engines with, reapplied between games
+        """
+
+        self.engine_factory = engine_factory
+        self.size = size
+        self.options = dict(options or {})
+        # Idle engines by variant key, in the order they were returned
+        self._idle = collections.OrderedDict()
+
+    def __len__(self):
+        """Number of idle engines"""
+
+        return len(self._idle)
+
+    def warm(self, board: chess.Board = None):
+        """Start engines for the variant of a board until the pool is full
+
+        Parameters
+        ----------
+        board : chess.Board
+            Board of the variant to start engines for, standard chess if not given
+        """
+
+        board = board or chess.Board()
+        while len(self._idle) < self.size:
+            engine = self.engine_factory(board)
+            self._idle[id(engine)] = (engine_key(board), engine)
+        LOG.debug("Warmed {} engines".format(len(self._idle)))
+
+    def acquire(self, board: chess.Board):
+        """Take an engine for a game on a board
+
+        Parameters
+        ----------
+        board : chess.Board
+            The board of the game
+
+        Returns
+        -------
+        EngineWrapper
+            An idle engine of the variant if one answers, otherwise a new engine
+        """
+
+        key = engine_key(board)
+        for engine_id, (idle_key, engine) in reversed(list(self._idle.items())):
+            if idle_key != key:
+                continue
+            del self._idle[engine_id]
+            if check_engine(engine):
+                return engine
+            LOG.warning("Replacing an engine that stopped answering")
+            self._quit(engine)
+        return self.engine_factory(board)
+
+    def release(self, engine, board: chess.Board):
+        """Return the engine of a finished game
+
+        Parameters
+        ----------
+        engine : EngineWrapper
+            The engine, idle again
+        board : chess.Board
+            The board of the finished game
+        """
+
+        try:
+            reset_engine(engine, self.options)
+        except Exception:
+            LOG.exception("Failed to reset engine")
+            self._quit(engine)
+            return
+        self._idle[id(engine)] = (engine_key(board), engine)
+        while len(self._idle) > self.size:
+            _, (_, oldest) = self._idle.popitem(last=False)
+            self._quit(oldest)
+
+    def close(self):
+        """Quit every idle engine"""
+
+        while self._idle:
+            _, (_, engine) = self._idle.popitem()
+            self._quit(engine)
+
+    def _quit(self, engine):
+        try:
+            engine.quit()
+        except Exception:
+            LOG.debug("Engine quit failed", exc_info=True)
+
+
+# The pool of a game worker process, set up by init_engine_pool
+_pool = None
+
+
+def init_engine_pool(engine_factory: Callable, size: int, options: dict = None):
+    """Create the pool of a game worker process and warm its engines
+
+    Used as the initializer of the game worker processes, so every worker
+    has its engines running before it is handed its first game. The
+    idle engines are quit when the worker exits.
+
+    Parameters
+    ----------
+    engine_factory : Callable
+        Creates an engine for a board
+    size : int
+        Idle engines kept by the worker, 0 quits engines after every game
+    options : dict
+        UCI options the factory creates engines with, reapplied between games
+    """
+
+    global _pool
+    _pool = EnginePool(engine_factory, size, options)
+    # Workers that exit run their finalizers, a terminated worker leaves its
+    # engines to exit on the end of their input instead
+    multiprocessing.util.Finalize(_pool, _pool.close, exitpriority=10)
+    try:
+        _pool.warm()
+    except Exception:
+        LOG.exception("Failed to warm engines, starting them per game")
+
+
+def acquire_engine(engine_factory: Callable, board: chess.Board):
+    """Take an engine for a game from the worker pool
+
+    Parameters
+    ----------
+    engine_factory : Callable
+        Creates an engine when the process has no pool
+    board : chess.Board
+        The board of the game
+
+    Returns
+    -------
+    EngineWrapper
+        The engine for the game
+    """
+
+    if _pool is None:
+        return engine_factory(board)
+    return _pool.acquire(board)
+
+
+def release_engine(engine, board: chess.Board):
+    """Return the engine of a finished game to the worker pool
+
+    Parameters
+    ----------
+    engine : EngineWrapper
+        The engine of the game
+    board : chess.Board
+        The board of the game
+    """
+
+    if _pool is None:
+        engine.quit()
+    else:
+        _pool.release(engine, board)
@@ -0,0 +1,275 @@
+"""Lichess event stream hub
+
+Keeps one long-lived connection to the Lichess event stream per account,
+decodes each event once into a typed event and fans it out to the
+registered subscribers.
+
+    * EventStreamHub - Multiplexes the Lichess event stream
+    * event_id - Gets the challenge or game id of an event
+"""
+
+import collections
+import itertools
+import logging
+import threading
+
+try:
+    from .stream_events import StreamEvent, decode_line
+except ImportError:
+    # Imported as a top-level module by lichess_bot
+    from stream_events import StreamEvent, decode_line
+
+LOG = logging.getLogger(__name__)
+
+
+def event_id(event: StreamEvent):
+    """Get the id of the challenge or game an event belongs to
+
+    Parameters
+    ----------
+    event : StreamEvent
+        Decoded event from the Lichess event stream
+
+    Returns
+    -------
+        The challenge or game id, or None if the event has no id
+    """
+
+    for key in ("challenge", "game"):
+        if key in event:
+            return event[key].get("id")
+    return None
+
+
+class EventStreamHub:
+    """Single reader of the Lichess event stream with fan-out subscribers
+
+    Subscribers are registered for an event type, an event type and id,
+    or for every event. Keep-alive lines are only dispatched to
+    subscribers of the "ping" type. The stream is reopened automatically
+    with an exponential delay when it drops, and the most recent events
+    are kept so that a waiter registered slightly too late still sees
+    the event it waits for. Game start and finish events invalidate the
+    cached ongoing games of the Lichess connection.
+
+    ---
+
+    Attributes
+    ----------
+    lichess : Lichess
+        Lichess connection used for opening the event stream
+
+    Methods
+    -------
+    subscribe(callback, event_type=None, event_id=None)
+        Registers a callback for matching events
+    unsubscribe(token)
+        Removes a registered callback
+    wait_for(event_types, event_id=None, timeout=None)
+        Blocks until a matching event arrives
+    start()
+        Starts reading the stream in a background thread
+    run()
+        Reads the stream in the calling thread until stopped
+    stop()
+        Stops reading the stream
+    """
+
+    def __init__(
+        self,
+        lichess,
+        reconnect_delay: float = 0.5,
+        max_reconnect_delay: float = 30.0,
+        history_size: int = 64,
+    ):
+        """
+        Parameters
+        ----------
+        lichess : Lichess
+            Lichess connection used for opening the event stream
+        reconnect_delay : float
+            Initial delay in seconds before reopening a dropped stream
+        max_reconnect_delay : float
+            Upper bound for the reconnect delay in seconds
+        history_size : int
+            Number of recent events kept for late waiters
+        """
+
+        self.lichess = lichess
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self._subscribers = {}
+        self._tokens = {}
+        self._token_counter = itertools.count()
+        self._history = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._response = None
+
+        if hasattr(lichess, "invalidate_cache"):
+            for event_type in ("gameStart", "gameFinish"):
+                self.subscribe(lambda event: lichess.invalidate_cache("playing"), event_type)
+
+    def subscribe(self, callback, event_type: str = None, event_id: str = None) -> int:
+        """Register a callback for matching events
+
+        Parameters
+        ----------
+        callback : Callable[[StreamEvent], None]
+            Called from the reader thread with each matching event
+        event_type : str
+            Only dispatch events of this type, None matches every type
+        event_id : str
+            Only dispatch events for this challenge or game id
+
+        Returns
+        -------
+        int
+            Token that can be given to unsubscribe
+        """
+
+        key = (event_type, event_id)
+        with self._lock:
+            token = next(self._token_counter)
+            self._subscribers.setdefault(key, {})[token] = callback
+            self._tokens[token] = key
+        return token
+
+    def unsubscribe(self, token: int):
+        """Remove a registered callback
+
+        Parameters
+        ----------
+        token : int
+            Token returned by subscribe
+        """
+
+        with self._lock:
+            key = self._tokens.pop(token, None)
+            if key is None:
+                return
+            callbacks = self._subscribers[key]
+            del callbacks[token]
+            if not callbacks:
+                del self._subscribers[key]
+
+    def wait_for(self, event_types, event_id: str = None, timeout: float = None):
+        """Wait for an event of one of the given types
+
+        Recent events are checked first, so an event that arrived just
+        before the call is not missed.
+
+        Parameters
+        ----------
+        event_types : Iterable[str]
+            Event types to wait for
+        event_id : str
+            Only accept events for this challenge or game id
+        timeout : float
+            Seconds to wait, None waits forever
+
+        Returns
+        -------
+            The matching event, or None if the wait timed out
+        """
+
+        received = []
+        arrived = threading.Event()
+
+        def on_event(event):
+            if not arrived.is_set():
+                received.append(event)
+                arrived.set()
+
+        tokens = [self.subscribe(on_event, event_type, event_id) for event_type in event_types]
+        try:
+            # Subscribing before checking the history leaves no gap for the event
+            with self._lock:
+                for past_event in self._history:
+                    if past_event["type"] in event_types and self._matches_id(past_event, event_id):
+                        return past_event
+            if arrived.wait(timeout):
+                return received[0]
+            return None
+        finally:
+            for token in tokens:
+                self.unsubscribe(token)
+
+    def start(self):
+        """Start reading the event stream in a daemon thread"""
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="lichess-event-stream", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """Read the event stream until stopped, reconnecting when it drops"""
+
+        delay = self.reconnect_delay
+        while not self._stopped.is_set():
+            try:
+                self._response = self.lichess.get_event_stream()
+                self._response.raise_for_status()
+                LOG.debug("Connected to Lichess event stream")
+                delay = self.reconnect_delay
+                for line in self._response.iter_lines():
+                    if self._stopped.is_set():
+                        break
+                    self.dispatch(decode_line(line))
+            except Exception:
+                if self._stopped.is_set():
+                    break
+                LOG.exception("Lichess event stream failed")
+            else:
+                LOG.debug("Lichess event stream closed")
+            finally:
+                self._close_response()
+            if self._stopped.wait(delay):
+                break
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def stop(self):
+        """Stop reading the event stream"""
+
+        self._stopped.set()
+        self._close_response()
+
+    def dispatch(self, event: StreamEvent):
+        """Dispatch a decoded event to its subscribers
+
+        Parameters
+        ----------
+        event : StreamEvent
+            Decoded event from the Lichess event stream
+        """
+
+        event_type = event["type"]
+        if event_type == "ping":
+            keys = (("ping", None),)
+        else:
+            keys = ((event_type, event_id(event)), (event_type, None), (None, None))
+        with self._lock:
+            if event_type != "ping":
+                self._history.append(event)
+            callbacks = [
+                callback for key in keys for callback in self._subscribers.get(key, {}).values()
+            ]
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                LOG.exception("Event subscriber failed on {} event".format(event_type))
+
+    def _close_response(self):
+        response = self._response
+        self._response = None
+        if response is not None:
+            response.close()
+
+    @staticmethod
+    def _matches_id(event: StreamEvent, expected_id: str) -> bool:
+        return expected_id is None or event_id(event) == expected_id
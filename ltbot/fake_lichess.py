@@ -0,0 +1,673 @@
+"""Fake Lichess server
+
+Local stand-in for the parts of the Lichess API in ENDPOINTS, used for
+benchmarking the bots without playing real games or hitting the real
+rate limits. Point Lichess or LichessTwitchBot at it by setting the
+Lichess url to the address of the server.
+
+    * ScriptedOpponent - Opponent behaviour for challenges and games
+    * FakeLichessConfig - Network behaviour of the server
+    * FakeLichess - State of the fake accounts, challenges and games
+    * start_fake_lichess - Starts a server in a background thread
+    * main - Runs a server from the command line
+"""
+
+import argparse as ap
+import itertools
+import json
+import logging
+import queue
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+import chess
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between keep-alive lines on idle streams
+KEEP_ALIVE_INTERVAL = 6.0
+
+
+class ScriptedOpponent:
+    """Behaviour of a fake Lichess user
+
+    Parameters
+    ----------
+    accept : bool
+        Whether challenges from the bot are accepted
+    response_delay : float
+        Seconds before a challenge is accepted or declined
+    think_time : float
+        Seconds the opponent takes per move
+    moves : List[str]
+        UCI moves to play in order, random legal moves are played once
+        the list runs out or a listed move is illegal
+    """
+
+    def __init__(
+        self,
+        accept: bool = True,
+        response_delay: float = 0.5,
+        think_time: float = 0.0,
+        moves: Optional[List[str]] = None,
+    ):
+        self.accept = accept
+        self.response_delay = response_delay
+        self.think_time = think_time
+        self.moves = list(moves or [])
+
+    def choose_move(self, board: chess.Board, ply: int) -> Optional[chess.Move]:
+        scripted_index = ply // 2
+        if scripted_index < len(self.moves):
+            move = chess.Move.from_uci(self.moves[scripted_index])
+            if move in board.legal_moves:
+                return move
+        legal_moves = list(board.legal_moves)
+        return random.choice(legal_moves) if legal_moves else None
+
+
+class FakeLichessConfig:
+    """Network behaviour of the fake server
+
+    Parameters
+    ----------
+    latency : float
+        Seconds added to every response
+    jitter : float
+        Upper bound of a random delay added on top of the latency
+    rate_limit_probability : float
+        Probability that a request is answered with 429
+    retry_after : int
+        Retry-After seconds sent with injected 429 responses
+    stream_drop_probability : float
+        Probability that a stream is closed after sending a line
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit_probability: float = 0.0,
+        retry_after: int = 1,
+        stream_drop_probability: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.stream_drop_probability = stream_drop_probability
+
+    def delay(self):
+        seconds = self.latency + random.uniform(0.0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class _Game:
+    def __init__(self, game_id, bot_color, opponent, clock_limit, clock_increment):
+        self.id = game_id
+        self.bot_color = bot_color
+        self.opponent = opponent
+        self.board = chess.Board()
+        self.moves = []
+        self.clock_increment = clock_increment * 1000
+        self.times = {chess.WHITE: clock_limit * 1000, chess.BLACK: clock_limit * 1000}
+        self.turn_started = time.monotonic()
+        self.status = "started"
+        self.winner = None
+        self.streams = []
+        self.lock = threading.Lock()
+
+    def state(self):
+        state = {
+            "type": "gameState",
+            "moves": " ".join(self.moves),
+            "wtime": int(self.times[chess.WHITE]),
+            "btime": int(self.times[chess.BLACK]),
+            "winc": self.clock_increment,
+            "binc": self.clock_increment,
+            "status": self.status,
+        }
+        if self.winner:
+            state["winner"] = self.winner
+        return state
+
+    def full(self, bot_username, opponent_name):
+        players = {
+            self.bot_color: {"id": bot_username.lower(), "name": bot_username, "title": "BOT"},
+            not self.bot_color: {"id": opponent_name.lower(), "name": opponent_name},
+        }
+        return {
+            "type": "gameFull",
+            "id": self.id,
+            "rated": False,
+            "variant": {"key": "standard", "name": "Standard", "short": "Std"},
+            "clock": {"initial": int(self.times[chess.WHITE]), "increment": self.clock_increment},
+            "speed": "blitz",
+            "perf": {"name": "Blitz"},
+            "createdAt": int(time.time() * 1000),
+            "white": players[chess.WHITE],
+            "black": players[chess.BLACK],
+            "initialFen": "startpos",
+            "state": self.state(),
+        }
+
+    def push(self, move):
+        now = time.monotonic()
+        mover = self.board.turn
+        if self.moves:
+            self.times[mover] -= (now - self.turn_started) * 1000
+            self.times[mover] += self.clock_increment
+        self.turn_started = now
+        self.board.push(move)
+        self.moves.append(move.uci())
+        if self.board.is_game_over():
+            outcome = self.board.outcome()
+            self.status = outcome.termination.name.lower()
+            if outcome.winner is not None:
+                self.winner = "white" if outcome.winner else "black"
+
+
+class FakeLichess:
+    """State of the fake Lichess account, challenges and games
+
+    ---
+
+    Attributes
+    ----------
+    username : str
+        Name of the bot account
+    opponents : dict
+        ScriptedOpponent per lower case username, default_opponent is
+        used for everyone else
+    config : FakeLichessConfig
+        Network behaviour of the server
+
+    Methods
+    -------
+    add_incoming_challenge(challenger, clock_limit=600, clock_increment=0)
+        Sends a challenge to the bot on the event stream
+    """
+
+    def __init__(
+        self,
+        username: str = "fakebot",
+        opponents: Optional[dict] = None,
+        default_opponent: Optional[ScriptedOpponent] = None,
+        config: Optional[FakeLichessConfig] = None,
+    ):
+        self.username = username
+        self.opponents = {name.lower(): opponent for name, opponent in (opponents or {}).items()}
+        self.default_opponent = default_opponent or ScriptedOpponent()
+        self.config = config or FakeLichessConfig()
+
+        self.challenges = {}
+        self.games = {}
+        self._event_streams = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_id(self) -> str:
+        return "{:08d}".format(next(self._ids))
+
+    def opponent(self, name: str) -> ScriptedOpponent:
+        return self.opponents.get(name.lower(), self.default_opponent)
+
+    def open_event_stream(self) -> queue.Queue:
+        lines = queue.Queue()
+        with self._lock:
+            self._event_streams.append(lines)
+        return lines
+
+    def close_stream(self, lines: queue.Queue, game_id: Optional[str] = None):
+        with self._lock:
+            streams = self.games[game_id].streams if game_id else self._event_streams
+            if lines in streams:
+                streams.remove(lines)
+
+    def send_event(self, event: dict):
+        with self._lock:
+            streams = list(self._event_streams)
+        for lines in streams:
+            lines.put(event)
+
+    def send_game_update(self, game: _Game, update: dict):
+        with self._lock:
+            streams = list(game.streams)
+        for lines in streams:
+            lines.put(update)
+
+    def profile(self) -> dict:
+        return {"id": self.username.lower(), "username": self.username, "title": "BOT"}
+
+    def playing(self) -> dict:
+        with self._lock:
+            games = [game for game in self.games.values() if game.status == "started"]
+        return {
+            "nowPlaying": [
+                {
+                    "gameId": game.id,
+                    "fullId": game.id,
+                    "isMyTurn": game.board.turn == game.bot_color,
+                }
+                for game in games
+            ]
+        }
+
+    def create_challenge(self, username: str, clock_limit: int, clock_increment: int) -> dict:
+        challenge = self._challenge(self.username, username, clock_limit, clock_increment)
+        opponent = self.opponent(username)
+        with self._lock:
+            self.challenges[challenge["id"]] = challenge
+
+        def respond():
+            if opponent.accept:
+                self.start_game(challenge, bot_color=chess.WHITE)
+            else:
+                with self._lock:
+                    self.challenges.pop(challenge["id"], None)
+                self.send_event({"type": "challengeDeclined", "challenge": challenge})
+
+        timer = threading.Timer(opponent.response_delay, respond)
+        # A server shut down mid-game must not keep the process alive
+        timer.daemon = True
+        timer.start()
+        return {"challenge": challenge}
+
+    def add_incoming_challenge(
+        self, challenger: str, clock_limit: int = 600, clock_increment: int = 0
+    ) -> dict:
+        """Send a challenge to the bot on the event stream
+
+        Parameters
+        ----------
+        challenger : str
+            Name of the challenging user
+        clock_limit : int
+            Initial clock time in seconds
+        clock_increment : int
+            Clock increment in seconds
+
+        Returns
+        -------
+        dict
+            The challenge
+        """
+
+        challenge = self._challenge(challenger, self.username, clock_limit, clock_increment)
+        with self._lock:
+            self.challenges[challenge["id"]] = challenge
+        self.send_event({"type": "challenge", "challenge": challenge})
+        return challenge
+
+    def accept_challenge(self, challenge_id: str) -> bool:
+        with self._lock:
+            challenge = self.challenges.get(challenge_id)
+        if challenge is None:
+            return False
+        self.start_game(challenge, bot_color=chess.BLACK)
+        return True
+
+    def decline_challenge(self, challenge_id: str) -> bool:
+        with self._lock:
+            challenge = self.challenges.pop(challenge_id, None)
+        if challenge is None:
+            return False
+        self.send_event({"type": "challengeDeclined", "challenge": challenge})
+        return True
+
+    def start_game(self, challenge: dict, bot_color: bool):
+        challenger = challenge["challenger"]["name"]
+        opponent_name = challenger if challenger != self.username else challenge["destUser"]["name"]
+        game = _Game(
+            challenge["id"],
+            bot_color,
+            opponent_name,
+            challenge["timeControl"]["limit"],
+            challenge["timeControl"]["increment"],
+        )
+        with self._lock:
+            self.challenges.pop(challenge["id"], None)
+            self.games[game.id] = game
+        self.send_event({"type": "gameStart", "game": {"id": game.id}})
+        if bot_color == chess.BLACK:
+            self._opponent_move(game)
+
+    def open_game_stream(self, game_id: str) -> Optional[queue.Queue]:
+        with self._lock:
+            game = self.games.get(game_id)
+            if game is None:
+                return None
+            lines = queue.Queue()
+            game.streams.append(lines)
+        with game.lock:
+            lines.put(game.full(self.username, game.opponent))
+            if game.status != "started":
+                lines.put(None)
+        return lines
+
+    def game(self, game_id: str) -> Optional[dict]:
+        with self._lock:
+            game = self.games.get(game_id)
+        if game is None:
+            return None
+        with game.lock:
+            return game.full(self.username, game.opponent)
+
+    def make_move(self, game_id: str, uci: str) -> bool:
+        with self._lock:
+            game = self.games.get(game_id)
+        if game is None:
+            return False
+        with game.lock:
+            try:
+                move = chess.Move.from_uci(uci)
+            except ValueError:
+                return False
+            if (
+                game.status != "started"
+                or game.board.turn != game.bot_color
+                or move not in game.board.legal_moves
+            ):
+                return False
+            game.push(move)
+            update = game.state()
+        self.send_game_update(game, update)
+        if game.status == "started":
+            self._opponent_move(game)
+        else:
+            self._finish(game)
+        return True
+
+    def end_game(self, game_id: str, status: str) -> bool:
+        with self._lock:
+            game = self.games.get(game_id)
+        if game is None:
+            return False
+        with game.lock:
+            if game.status != "started":
+                return False
+            game.status = status
+            if status == "resign":
+                game.winner = "black" if game.bot_color == chess.WHITE else "white"
+            update = game.state()
+        self.send_game_update(game, update)
+        self._finish(game)
+        return True
+
+    def chat(self, game_id: str, room: str, text: str) -> bool:
+        with self._lock:
+            game = self.games.get(game_id)
+        if game is None:
+            return False
+        line = {"type": "chatLine", "username": self.username, "text": text, "room": room}
+        self.send_game_update(game, line)
+        return True
+
+    def _opponent_move(self, game: _Game):
+        opponent = self.opponent(game.opponent)
+
+        def play():
+            with game.lock:
+                if game.status != "started" or game.board.turn == game.bot_color:
+                    return
+                move = opponent.choose_move(game.board, len(game.moves))
+                if move is None:
+                    return
+                game.push(move)
+                update = game.state()
+            self.send_game_update(game, update)
+            if game.status != "started":
+                self._finish(game)
+
+        timer = threading.Timer(opponent.think_time, play)
+        # A server shut down mid-game must not keep the process alive
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, game: _Game):
+        self.send_event({"type": "gameFinish", "game": {"id": game.id}})
+        with self._lock:
+            streams = list(game.streams)
+        for lines in streams:
+            lines.put(None)
+
+    def _user(self, name):
+        return {"id": name.lower(), "name": name, "title": "BOT" if name == self.username else None}
+
+    def _challenge(self, challenger, dest_user, clock_limit, clock_increment):
+        return {
+            "id": self.new_id(),
+            "status": "created",
+            "challenger": self._user(challenger),
+            "destUser": self._user(dest_user),
+            "variant": {"key": "standard", "name": "Standard", "short": "Std"},
+            "rated": False,
+            "speed": "blitz",
+            "timeControl": {
+                "type": "clock",
+                "limit": int(clock_limit),
+                "increment": int(clock_increment),
+                "show": "{}+{}".format(int(clock_limit) // 60, clock_increment),
+            },
+            "color": "random",
+            "perf": {"icon": ")", "name": "Blitz"},
+        }
+
+
+ROUTES = [
+    ("GET", re.compile(r"^/api/account$"), "account"),
+    ("GET", re.compile(r"^/api/account/playing$"), "playing"),
+    ("GET", re.compile(r"^/api/stream/event$"), "stream_event"),
+    ("GET", re.compile(r"^/api/bot/game/stream/(\w+)$"), "stream_game"),
+    ("GET", re.compile(r"^/api/bot/game/(\w+)$"), "game"),
+    ("POST", re.compile(r"^/api/bot/game/(\w+)/move/(\w+)$"), "move"),
+    ("POST", re.compile(r"^/api/bot/game/(\w+)/chat$"), "chat"),
+    ("POST", re.compile(r"^/api/bot/game/(\w+)/abort$"), "abort"),
+    ("POST", re.compile(r"^/api/bot/game/(\w+)/resign$"), "resign"),
+    ("POST", re.compile(r"^/api/challenge/(\w+)/accept$"), "accept"),
+    ("POST", re.compile(r"^/api/challenge/(\w+)/decline$"), "decline"),
+    ("POST", re.compile(r"^/api/challenge/(\w+)$"), "challenge"),
+    ("POST", re.compile(r"^/api/bot/account/upgrade$"), "upgrade"),
+]
+
+
+class FakeLichessHandler(BaseHTTPRequestHandler):
+    """Request handler serving the fake Lichess API"""
+
+    protocol_version = "HTTP/1.1"
+    lichess: FakeLichess = None
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def route(self, method: str):
+        path = self.path.split("?")[0]
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        config = self.lichess.config
+        config.delay()
+        if random.random() < config.rate_limit_probability:
+            self.send_json(429, {"error": "Too many requests"}, {"Retry-After": config.retry_after})
+            return
+        getattr(self, "handle_" + name)(*match.groups())
+
+    def read_form(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        return {key: values[0] for key, values in parse_qs(body).items()}
+
+    def send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_ok(self, ok: bool):
+        if ok:
+            self.send_json(200, {"ok": True})
+        else:
+            self.send_json(400, {"error": "Not allowed"})
+
+    def send_stream(self, lines: queue.Queue, on_close):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        config = self.lichess.config
+        try:
+            while True:
+                try:
+                    item = lines.get(timeout=KEEP_ALIVE_INTERVAL)
+                except queue.Empty:
+                    item = {}
+                if item is None:
+                    break
+                line = (json.dumps(item) if item else "").encode("utf-8") + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+                if random.random() < config.stream_drop_probability:
+                    LOG.debug("Dropping stream {}".format(self.path))
+                    self.close_connection = True
+                    return
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            on_close(lines)
+
+    def handle_account(self):
+        self.send_json(200, self.lichess.profile())
+
+    def handle_playing(self):
+        self.send_json(200, self.lichess.playing())
+
+    def handle_stream_event(self):
+        self.send_stream(self.lichess.open_event_stream(), self.lichess.close_stream)
+
+    def handle_stream_game(self, game_id):
+        lines = self.lichess.open_game_stream(game_id)
+        if lines is None:
+            self.send_json(404, {"error": "No such game"})
+            return
+        self.send_stream(lines, lambda lines: self.lichess.close_stream(lines, game_id))
+
+    def handle_game(self, game_id):
+        game = self.lichess.game(game_id)
+        if game is None:
+            self.send_json(404, {"error": "No such game"})
+            return
+        self.send_json(200, game)
+
+    def handle_move(self, game_id, move):
+        self.send_ok(self.lichess.make_move(game_id, move))
+
+    def handle_chat(self, game_id):
+        form = self.read_form()
+        self.send_ok(self.lichess.chat(game_id, form.get("room", "player"), form.get("text", "")))
+
+    def handle_abort(self, game_id):
+        self.send_ok(self.lichess.end_game(game_id, "aborted"))
+
+    def handle_resign(self, game_id):
+        self.send_ok(self.lichess.end_game(game_id, "resign"))
+
+    def handle_accept(self, challenge_id):
+        self.send_ok(self.lichess.accept_challenge(challenge_id))
+
+    def handle_decline(self, challenge_id):
+        self.send_ok(self.lichess.decline_challenge(challenge_id))
+
+    def handle_challenge(self, username):
+        form = self.read_form()
+        self.send_json(
+            200,
+            self.lichess.create_challenge(
+                username, int(form.get("clock.limit", 600)), int(form.get("clock.increment", 0))
+            ),
+        )
+
+    def handle_upgrade(self):
+        self.send_ok(True)
+
+    def log_message(self, format, *args):
+        LOG.debug("Fake Lichess request: " + format % args)
+
+
+def start_fake_lichess(lichess: FakeLichess = None, port: int = 0, host: str = "127.0.0.1"):
+    """Start a fake Lichess server in a daemon thread
+
+    Parameters
+    ----------
+    lichess : FakeLichess
+        State to serve, a default one is created if missing
+    port : int
+        Port to listen on, 0 picks a free port
+    host : str
+        Address to listen on
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server, its url is http://host:server_address[1]/
+    """
+
+    handler = type("Handler", (FakeLichessHandler,), {"lichess": lichess or FakeLichess()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-lichess", daemon=True).start()
+    LOG.info("Fake Lichess listening on http://{}:{}/".format(host, server.server_address[1]))
+    return server
+
+
+def main():
+    parser = ap.ArgumentParser(description="Runs a fake Lichess server for benchmarking")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--username", default="fakebot", help="name of the bot account")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added per response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds")
+    parser.add_argument("--rate_limit", type=float, default=0.0, help="probability of a 429")
+    parser.add_argument("--stream_drop", type=float, default=0.0, help="probability of a drop")
+    parser.add_argument("--think_time", type=float, default=0.0, help="opponent seconds per move")
+    parser.add_argument("--decline", action="store_true", help="decline challenges from the bot")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    lichess = FakeLichess(
+        username=args.username,
+        default_opponent=ScriptedOpponent(accept=not args.decline, think_time=args.think_time),
+        config=FakeLichessConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            rate_limit_probability=args.rate_limit,
+            stream_drop_probability=args.stream_drop,
+        ),
+    )
+    server = start_fake_lichess(lichess, args.port, args.host)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Flood control
+
+Per user and global budgets for chat commands, so a few viewers cannot
+spend the Twitch send budget of the bot.
+
+    * FloodControl - Per user and global command rate limits with bounded memory
+"""
+
+import collections
+import time
+
+from .scheduler import TokenBucket
+
+# Commands per second and burst size for every user and for the whole chat
+DEFAULT_USER_LIMIT = (0.1, 3)
+DEFAULT_GLOBAL_LIMIT = (0.5, 5)
+
+# Users tracked at most, the least recently seen are forgotten first
+DEFAULT_MAX_USERS = 10000
+
+
+class FloodControl:
+    """Per user and global command rate limits with bounded memory
+
+    Every user has a token bucket kept as a single number, the time at
+    which the bucket will be full again. Users are kept in least recently
+    used order, entries whose bucket is full again are dropped as they
+    come up, and the least recently seen user is forgotten when the table
+    is full. Memory therefore stays flat however many users chat. All
+    users share a global token bucket on top.
+
+    Not thread safe, the bot actor is the only caller.
+
+    ---
+
+    Methods
+    -------
+    allow(user_id, now=None)
+        Takes a token for a command of the user if both budgets allow it
+    """
+
+    def __init__(
+        self,
+        user_limit: tuple = DEFAULT_USER_LIMIT,
+        global_limit: tuple = DEFAULT_GLOBAL_LIMIT,
+        max_users: int = DEFAULT_MAX_USERS,
+    ):
+        """
+        Parameters
+        ----------
+        user_limit : tuple
+            Commands per second and burst size for every user
+        global_limit : tuple
+            Commands per second and burst size for all users together
+        max_users : int
+            Users tracked at most
+        """
+
+        rate, burst = user_limit
+        self._interval = 1.0 / rate
+        # A bucket full again at most this far ahead still has a token
+        self._tolerance = (burst - 1) * self._interval
+        self._global = TokenBucket(*global_limit)
+        self.max_users = max_users
+        self._users = collections.OrderedDict()
+
+    def __len__(self):
+        """Number of tracked users"""
+
+        return len(self._users)
+
+    def allow(self, user_id: str, now: float = None) -> bool:
+        """Take a token for a command of the user if both budgets allow it
+
+        Parameters
+        ----------
+        user_id : str
+            Twitch user id of the sender
+        now : float
+            Current time.monotonic(), read if not given
+
+        Returns
+        -------
+        bool
+            True if the command may be handled
+        """
+
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+
+        full_at = max(self._users.get(user_id, now), now)
+        if full_at - now > self._tolerance or self._global.wait_time(now) > 0.0:
+            return False
+        self._global.take()
+
+        self._users[user_id] = full_at + self._interval
+        self._users.move_to_end(user_id)
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return True
+
+    def _expire(self, now: float):
+        # An entry becomes full again at most a burst after it was last
+        # used, so the least recently used entries expire first
+        users = self._users
+        while users:
+            user_id, full_at = next(iter(users.items()))
+            if full_at > now:
+                return
+            del users[user_id]
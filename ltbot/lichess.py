@@ -1,4 +1,7 @@
+import asyncio
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
 from urllib3.exceptions import ProtocolError
@@ -12,6 +15,28 @@ except ImportError:
 
 import backoff
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    from .cache import TTLCache
+    from .metrics import REGISTRY
+    from .scheduler import Priority, RequestScheduler, retry_after_seconds
+except ImportError:
+    # Imported as a top-level module by lichess_bot
+    from cache import TTLCache
+    from metrics import REGISTRY
+    from scheduler import Priority, RequestScheduler, retry_after_seconds
+
 ENDPOINTS = {
     "profile": "/api/account",
     "playing": "/api/account/playing",
@@ -28,91 +53,403 @@ ENDPOINTS = {
     "resign": "/api/bot/game/{}/resign",
 }
 
+ENDPOINT_PRIORITIES = {
+    "move": Priority.MOVE,
+    "abort": Priority.GAME,
+    "resign": Priority.GAME,
+    "game": Priority.GAME,
+    "challenge": Priority.CHALLENGE,
+    "accept": Priority.CHALLENGE,
+    "decline": Priority.CHALLENGE,
+    "chat": Priority.CHAT,
+}
+
+# Seconds that cached responses stay valid, per endpoint
+CACHE_TTLS = {
+    "profile": 300,
+    "playing": 5,
+}
+
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "lichess_request_seconds", "Latency of Lichess API requests", ("endpoint",)
+)
+REQUEST_WAIT_SECONDS = REGISTRY.histogram(
+    "lichess_request_wait_seconds", "Time Lichess requests waited for the scheduler", ("endpoint",)
+)
+REQUESTS_TOTAL = REGISTRY.counter(
+    "lichess_requests_total", "Lichess API responses by status code", ("endpoint", "status")
+)
+RETRIES_TOTAL = REGISTRY.counter(
+    "lichess_request_retries_total", "Retried Lichess API requests", ("endpoint",)
+)
+STREAM_CONNECT_SECONDS = REGISTRY.histogram(
+    "lichess_stream_connect_seconds", "Time to open a Lichess stream", ("stream",)
+)
+STREAM_CONNECTS_TOTAL = REGISTRY.counter(
+    "lichess_stream_connects_total", "Opened Lichess streams by status code", ("stream", "status")
+)
+STREAM_BYTES_TOTAL = REGISTRY.counter(
+    "lichess_stream_bytes_total", "Bytes received from Lichess streams", ("stream",)
+)
+
+
+def count_retry(details):
+    RETRIES_TOTAL.inc(details["kwargs"].get("endpoint"))
+
+
+class MeteredStream:
+    """Streaming response that counts the bytes of the lines read from it"""
+
+    def __init__(self, response, stream):
+        self.response = response
+        self.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_lines(self, *args, **kwargs):
+        for line in self.response.iter_lines(*args, **kwargs):
+            # Count the stripped newline as well
+            STREAM_BYTES_TOTAL.inc(self.stream, amount=len(line) + 1)
+            yield line
+
+
+def is_final(exception):
+    # Rate limited requests are retried once the scheduler cooldown is over
+    return (
+        isinstance(exception, HTTPError)
+        and exception.response.status_code < 500
+        and exception.response.status_code != 429
+    )
+
+
+def new_session(pool_maxsize=16):
+    session = requests.Session()
+    # Keep enough pooled connections alive for concurrent game streams
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 # docs: https://lichess.org/api
 class Lichess:
-    def __init__(self, token, url, version):
+    def __init__(self, token, url, version, scheduler=None, session=None):
         self.version = version
+        self.scheduler = scheduler or RequestScheduler()
+        self.cache = TTLCache()
+        self.cache_ttls = CACHE_TTLS
         self.header = {"Authorization": "Bearer {}".format(token)}
         self.baseUrl = url
-        self.session = requests.Session()
-        self.session.headers.update(self.header)
+        # The session may pool connections for several accounts, so the
+        # account headers are sent with each request
+        self.session = session or new_session()
         self.set_user_agent("?")
 
-    def is_final(exception):
-        return isinstance(exception, HTTPError) and exception.response.status_code < 500
+    def __getstate__(self):
+        # The scheduler, cache and session hold locks and sockets, a copy
+        # sent to a game process builds its own. Its scheduler uses the
+        # budget the process shares, see use_shared_budget
+        state = self.__dict__.copy()
+        for name in ("scheduler", "cache", "session"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.scheduler = RequestScheduler()
+        self.cache = TTLCache()
+        self.session = new_session()
 
     @backoff.on_exception(
-        backoff.constant,
+        backoff.expo,
         (RemoteDisconnected, ConnectionError, ProtocolError, HTTPError, ReadTimeout),
         max_time=60,
-        interval=0.1,
+        factor=0.1,
+        max_value=5,
         giveup=is_final,
+        on_backoff=count_retry,
     )
-    def api_get(self, path):
-        url = urljoin(self.baseUrl, path)
-        response = self.session.get(url, timeout=2)
-        response.raise_for_status()
-        return response.json()
+    def api_get(self, path, endpoint=None):
+        return self.request("GET", path, endpoint)
 
     @backoff.on_exception(
-        backoff.constant,
+        backoff.expo,
         (RemoteDisconnected, ConnectionError, ProtocolError, HTTPError, ReadTimeout),
         max_time=60,
-        interval=0.1,
+        factor=0.1,
+        max_value=5,
         giveup=is_final,
+        on_backoff=count_retry,
     )
-    def api_post(self, path, data=None):
+    def api_post(self, path, data=None, endpoint=None):
+        return self.request("POST", path, endpoint, data=data)
+
+    def request(self, method, path, endpoint, data=None):
+        start = time.monotonic()
+        self.scheduler.acquire(endpoint, ENDPOINT_PRIORITIES.get(endpoint, Priority.BULK))
+        sent = time.monotonic()
+        REQUEST_WAIT_SECONDS.observe(endpoint, value=sent - start)
         url = urljoin(self.baseUrl, path)
-        response = self.session.post(url, data=data, timeout=2)
+        try:
+            response = self.session.request(method, url, data=data, headers=self.header, timeout=2)
+        except Exception as exception:
+            REQUESTS_TOTAL.inc(endpoint, type(exception).__name__)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(endpoint, value=time.monotonic() - sent)
+        REQUESTS_TOTAL.inc(endpoint, str(response.status_code))
+        self.check_rate_limit(response)
         response.raise_for_status()
         return response.json()
 
+    def open_stream(self, path, stream, timeout=None):
+        start = time.monotonic()
+        url = urljoin(self.baseUrl, path)
+        try:
+            response = self.session.get(url, headers=self.header, stream=True, timeout=timeout)
+        except Exception as exception:
+            STREAM_CONNECTS_TOTAL.inc(stream, type(exception).__name__)
+            raise
+        STREAM_CONNECT_SECONDS.observe(stream, value=time.monotonic() - start)
+        STREAM_CONNECTS_TOTAL.inc(stream, str(response.status_code))
+        return MeteredStream(response, stream)
+
+    def check_rate_limit(self, response):
+        if response.status_code == 429:
+            self.scheduler.cooldown(retry_after_seconds(response.headers))
+
     def get_game(self, game_id):
-        return self.api_get(ENDPOINTS["game"].format(game_id))
+        return self.api_get(ENDPOINTS["game"].format(game_id), endpoint="game")
 
     def upgrade_to_bot_account(self):
-        return self.api_post(ENDPOINTS["upgrade"])
+        self.invalidate_cache("profile")
+        return self.api_post(ENDPOINTS["upgrade"], endpoint="upgrade")
 
     def make_move(self, game_id, move):
-        return self.api_post(ENDPOINTS["move"].format(game_id, move))
+        return self.api_post(ENDPOINTS["move"].format(game_id, move), endpoint="move")
 
     def chat(self, game_id, room, text):
         payload = {"room": room, "text": text}
-        return self.api_post(ENDPOINTS["chat"].format(game_id), data=payload)
+        return self.api_post(ENDPOINTS["chat"].format(game_id), data=payload, endpoint="chat")
 
     def abort(self, game_id):
-        return self.api_post(ENDPOINTS["abort"].format(game_id))
+        return self.api_post(ENDPOINTS["abort"].format(game_id), endpoint="abort")
 
     def get_event_stream(self):
-        url = urljoin(self.baseUrl, ENDPOINTS["stream_event"])
-        return requests.get(url, headers=self.header, stream=True, timeout=10)
+        return self.open_stream(ENDPOINTS["stream_event"], "stream_event", timeout=10)
 
     def get_game_stream(self, game_id):
-        url = urljoin(self.baseUrl, ENDPOINTS["stream"].format(game_id))
-        return requests.get(url, headers=self.header, stream=True)
+        return self.open_stream(ENDPOINTS["stream"].format(game_id), "stream")
 
     def create_challenge(self, username, clock_limit=600, clock_increment=0):
         payload = {"clock.limit": clock_limit, "clock.increment": clock_increment}
-        return self.api_post(ENDPOINTS["challenge"].format(username), data=payload)
+        return self.api_post(
+            ENDPOINTS["challenge"].format(username), data=payload, endpoint="challenge"
+        )
 
     def accept_challenge(self, challenge_id):
-        return self.api_post(ENDPOINTS["accept"].format(challenge_id))
+        return self.api_post(ENDPOINTS["accept"].format(challenge_id), endpoint="accept")
 
     def decline_challenge(self, challenge_id):
-        return self.api_post(ENDPOINTS["decline"].format(challenge_id))
+        return self.api_post(ENDPOINTS["decline"].format(challenge_id), endpoint="decline")
 
     def get_profile(self):
-        profile = self.api_get(ENDPOINTS["profile"])
+        profile = self.cached_get("profile")
         self.set_user_agent(profile["username"])
         return profile
 
     def get_ongoing_games(self):
-        ongoing_games = self.api_get(ENDPOINTS["playing"])["nowPlaying"]
+        ongoing_games = self.cached_get("playing")["nowPlaying"]
         return ongoing_games
 
+    def cached_get(self, endpoint):
+        if endpoint not in self.cache_ttls:
+            return self.api_get(ENDPOINTS[endpoint], endpoint=endpoint)
+        return self.cache.get_or_load(
+            endpoint,
+            lambda: self.api_get(ENDPOINTS[endpoint], endpoint=endpoint),
+            self.cache_ttls[endpoint],
+        )
+
+    def invalidate_cache(self, endpoint=None):
+        self.cache.invalidate(endpoint)
+
     def resign(self, game_id):
-        self.api_post(ENDPOINTS["resign"].format(game_id))
+        self.api_post(ENDPOINTS["resign"].format(game_id), endpoint="resign")
+
+    def set_user_agent(self, username):
+        self.header.update({"User-Agent": "lichess-bot/{} user:{}".format(self.version, username)})
+
+
+def is_final_async(exception):
+    return (
+        httpx is not None
+        and isinstance(exception, httpx.HTTPStatusError)
+        and exception.response.status_code < 500
+        and exception.response.status_code != 429
+    )
+
+
+# Exceptions from httpx that are worth retrying, empty if httpx is missing
+ASYNC_RETRY_EXCEPTIONS = (httpx.TransportError, httpx.HTTPStatusError) if httpx else ()
+
+
+class AsyncLichess:
+    """Asyncio variant of Lichess
+
+    All requests and streams share one pooled httpx client which keeps
+    connections alive between calls, and uses HTTP/2 when the h2
+    package is installed so that streams and posts are multiplexed over
+    a single connection.
+    """
+
+    def __init__(self, token, url, version, max_connections=20, scheduler=None):
+        if httpx is None:
+            raise ImportError("AsyncLichess requires the httpx package")
+        self.version = version
+        self.scheduler = scheduler or RequestScheduler()
+        self.header = {"Authorization": "Bearer {}".format(token)}
+        self.baseUrl = url
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            headers=self.header,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(2, read=None),
+        )
+        self.set_user_agent("?")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    @backoff.on_exception(
+        backoff.expo,
+        ASYNC_RETRY_EXCEPTIONS,
+        max_time=60,
+        factor=0.1,
+        max_value=5,
+        giveup=is_final_async,
+        on_backoff=count_retry,
+    )
+    async def api_get(self, path, endpoint=None):
+        return await self.request("GET", path, endpoint)
+
+    @backoff.on_exception(
+        backoff.expo,
+        ASYNC_RETRY_EXCEPTIONS,
+        max_time=60,
+        factor=0.1,
+        max_value=5,
+        giveup=is_final_async,
+        on_backoff=count_retry,
+    )
+    async def api_post(self, path, data=None, endpoint=None):
+        return await self.request("POST", path, endpoint, data=data)
+
+    async def request(self, method, path, endpoint, data=None):
+        start = time.monotonic()
+        await self.acquire(endpoint)
+        sent = time.monotonic()
+        REQUEST_WAIT_SECONDS.observe(endpoint, value=sent - start)
+        try:
+            response = await self.client.request(method, path, data=data, timeout=2)
+        except Exception as exception:
+            REQUESTS_TOTAL.inc(endpoint, type(exception).__name__)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(endpoint, value=time.monotonic() - sent)
+        REQUESTS_TOTAL.inc(endpoint, str(response.status_code))
+        self.check_rate_limit(response)
+        response.raise_for_status()
+        return response.json()
+
+    async def acquire(self, endpoint):
+        priority = ENDPOINT_PRIORITIES.get(endpoint, Priority.BULK)
+        wait = self.scheduler.reserve(endpoint, priority)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.scheduler.reserve(endpoint, priority)
+
+    def check_rate_limit(self, response):
+        if response.status_code == 429:
+            self.scheduler.cooldown(retry_after_seconds(response.headers))
+
+    async def get_game(self, game_id):
+        return await self.api_get(ENDPOINTS["game"].format(game_id), endpoint="game")
+
+    async def upgrade_to_bot_account(self):
+        return await self.api_post(ENDPOINTS["upgrade"], endpoint="upgrade")
+
+    async def make_move(self, game_id, move):
+        return await self.api_post(ENDPOINTS["move"].format(game_id, move), endpoint="move")
+
+    async def chat(self, game_id, room, text):
+        payload = {"room": room, "text": text}
+        return await self.api_post(ENDPOINTS["chat"].format(game_id), data=payload, endpoint="chat")
+
+    async def abort(self, game_id):
+        return await self.api_post(ENDPOINTS["abort"].format(game_id), endpoint="abort")
+
+    async def stream_lines(self, path, stream, timeout=None):
+        """Yields the raw lines of an NDJSON stream, empty lines are keep-alives"""
+
+        start = time.monotonic()
+        async with self.client.stream(
+            "GET", path, timeout=httpx.Timeout(2, read=timeout)
+        ) as response:
+            STREAM_CONNECT_SECONDS.observe(stream, value=time.monotonic() - start)
+            STREAM_CONNECTS_TOTAL.inc(stream, str(response.status_code))
+            response.raise_for_status()
+            buffer = b""
+            async for chunk in response.aiter_bytes():
+                STREAM_BYTES_TOTAL.inc(stream, amount=len(chunk))
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    yield line
+            if buffer:
+                yield buffer
+
+    def get_event_stream(self):
+        return self.stream_lines(ENDPOINTS["stream_event"], "stream_event", timeout=10)
+
+    def get_game_stream(self, game_id):
+        return self.stream_lines(ENDPOINTS["stream"].format(game_id), "stream")
+
+    async def create_challenge(self, username, clock_limit=600, clock_increment=0):
+        payload = {"clock.limit": clock_limit, "clock.increment": clock_increment}
+        return await self.api_post(
+            ENDPOINTS["challenge"].format(username), data=payload, endpoint="challenge"
+        )
+
+    async def accept_challenge(self, challenge_id):
+        return await self.api_post(ENDPOINTS["accept"].format(challenge_id), endpoint="accept")
+
+    async def decline_challenge(self, challenge_id):
+        return await self.api_post(ENDPOINTS["decline"].format(challenge_id), endpoint="decline")
+
+    async def get_profile(self):
+        profile = await self.api_get(ENDPOINTS["profile"], endpoint="profile")
+        self.set_user_agent(profile["username"])
+        return profile
+
+    async def get_ongoing_games(self):
+        ongoing_games = (await self.api_get(ENDPOINTS["playing"], endpoint="playing"))["nowPlaying"]
+        return ongoing_games
+
+    async def resign(self, game_id):
+        await self.api_post(ENDPOINTS["resign"].format(game_id), endpoint="resign")
 
     def set_user_agent(self, username):
         self.header.update({"User-Agent": "lichess-bot/{} user:{}".format(self.version, username)})
-        self.session.headers.update(self.header)
+        self.client.headers.update(self.header)
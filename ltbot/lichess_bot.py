@@ -1,10 +1,8 @@
 import argparse
 import chess
 from chess.variant import find_variant
-import chess.polyglot
 import engine_wrapper
 import model
-import json
 import lichess
 import logging
 import multiprocessing
@@ -14,9 +12,21 @@ import signal
 import sys
 import time
 import backoff
-import threading
+from analysis_cache import open_analysis_cache, required_depth
+from board_sync import release_board, resume_board
+from challenge_queue import ChallengeQueue
+from concurrent.futures import ThreadPoolExecutor
 from config import load_config
+from control_bus import ControlBus
 from conversation import Conversation, ChatLine
+from engine_pool import acquire_engine, init_engine_pool, release_engine
+from event_stream import EventStreamHub
+from metrics import REGISTRY, collect_metrics, forward_metrics, start_metrics_server
+from move_overhead import MoveOverhead
+from ponder import PonderManager
+from polyglot_book import open_book, preload_books
+from scheduler import SharedBudget, use_shared_budget
+from stream_events import decode_line
 from functools import partial
 from requests.exceptions import (
     ChunkedEncodingError,
@@ -38,6 +48,13 @@ except ImportError:
 
 __version__ = "1.1.4"
 
+# Seconds between checks for termination while no control event arrives
+CONTROL_POLL_INTERVAL = 1.0
+
+ACCEPT_LATENCY_SECONDS = REGISTRY.histogram(
+    "ltbot_challenge_accept_seconds", "Time from a challenge event to its accept request"
+)
+
 terminated = False
 
 
@@ -62,19 +79,35 @@ def upgrade_account(li):
     return True
 
 
-def watch_control_stream(control_queue, li):
-    while not terminated:
-        try:
-            response = li.get_event_stream()
-            lines = response.iter_lines()
-            for line in lines:
-                if line:
-                    event = json.loads(line.decode("utf-8"))
-                    control_queue.put_nowait(event)
-                else:
-                    control_queue.put_nowait({"type": "ping"})
-        except:
-            pass
+def accept_challenge(li, chlng, queued, control_queue):
+    try:
+        li.accept_challenge(chlng.id)
+        ACCEPT_LATENCY_SECONDS.observe(value=time.monotonic() - queued)
+        return
+    except (HTTPError, ReadTimeout) as exception:
+        if (
+            isinstance(exception, HTTPError) and exception.response.status_code == 404
+        ):  # ignore missing challenge
+            logger.info("    Skip missing {}".format(chlng))
+    except Exception:
+        logger.exception("Failed to accept {}".format(chlng))
+    control_queue.put_nowait({"type": "local_accept_failed", "challenge": chlng})
+
+
+def game_failed(control_queue, game_id, exception):
+    logger.error(
+        "Game {} failed".format(game_id),
+        exc_info=(type(exception), exception, exception.__traceback__),
+    )
+    control_queue.put_nowait({"type": "local_game_done"})
+
+
+def init_game_process(engine_factory, warm_engines, engine_options, metrics_queue, budget):
+    # Game processes measure moves and pondering, the dispatcher serves their metrics
+    forward_metrics(metrics_queue)
+    # Copies of the Lichess client sent to this process schedule with the shared budget
+    use_shared_budget(budget)
+    init_engine_pool(engine_factory, warm_engines, engine_options)
 
 
 def start(li, user_profile, engine_factory, config):
@@ -82,16 +115,50 @@ def start(li, user_profile, engine_factory, config):
     max_games = challenge_config.get("concurrency", 1)
     logger.info("You're now connected to {} and awaiting challenges.".format(config["url"]))
     manager = multiprocessing.Manager()
-    challenge_queue = manager.list()
-    control_queue = manager.Queue()
-    control_stream = multiprocessing.Process(target=watch_control_stream, args=[control_queue, li])
-    control_stream.start()
+    # Game conversations show the queue, they read the list the queue publishes to
+    challenge_list = manager.list()
+    challenge_queue = ChallengeQueue(
+        challenge_config.get("sort_by", "best"),
+        challenge_config.get("max_queue_age"),
+        challenge_list,
+    )
+    # The event stream is read by a thread of this process, events are never pickled
+    control_queue = ControlBus()
+    control_stream = EventStreamHub(li)
+    control_stream.subscribe(control_queue.put_nowait)
+    control_stream.subscribe(control_queue.put_nowait, "ping")
+    polyglot_cfg = config["engine"].get("polyglot", {})
+    if polyglot_cfg.get("enabled"):
+        # Map the books once, the game processes share them
+        preload_books(polyglot_cfg.get("book", {}))
     busy_processes = 0
     queued_processes = 0
 
-    with logging_pool.LoggingPool(max_games + 1) as pool:
+    # Every game process keeps its engines running between games
+    warm_engines = config["engine"].get("warm_engines", 1)
+    engine_options = {}
+    if config["engine"]["protocol"] == "uci":
+        engine_options = {
+            name: value
+            for name, value in (config["engine"].get("uci_options") or {}).items()
+            if name != "go_commands"
+        }
+    metrics_queue = multiprocessing.Queue()
+    collect_metrics(metrics_queue)
+    with logging_pool.LoggingPool(
+        max_games + 1,
+        initializer=init_game_process,
+        initargs=(engine_factory, warm_engines, engine_options, metrics_queue, li.scheduler.shared),
+    ) as pool:
+        # Started after the game processes are forked, so they do not inherit the reader
+        control_stream.start()
+        # Accepts of a burst of challenges run concurrently, up to the free game slots
+        accept_executor = ThreadPoolExecutor(max_workers=max_games, thread_name_prefix="accept")
         while not terminated:
-            event = control_queue.get()
+            item = control_queue.get(CONTROL_POLL_INTERVAL)
+            if item is None:
+                continue
+            received, event = item
             if event["type"] == "terminated":
                 break
             elif event["type"] == "local_game_done":
@@ -101,14 +168,14 @@ def start(li, user_profile, engine_factory, config):
                         queued_processes, busy_processes
                     )
                 )
+            elif event["type"] == "local_accept_failed":
+                queued_processes -= 1
+            elif event["type"] in ("challengeCanceled", "challengeDeclined"):
+                challenge_queue.remove(event["challenge"]["id"])
             elif event["type"] == "challenge":
                 chlng = model.Challenge(event["challenge"])
                 if chlng.is_supported(challenge_config):
-                    challenge_queue.append(chlng)
-                    if challenge_config.get("sort_by", "best") == "best":
-                        list_c = list(challenge_queue)
-                        list_c.sort(key=lambda c: -c.score())
-                        challenge_queue = list_c
+                    challenge_queue.push(chlng, received)
                 else:
                     try:
                         li.decline_challenge(chlng.id)
@@ -129,61 +196,55 @@ def start(li, user_profile, engine_factory, config):
                     )
                 )
                 game_id = event["game"]["id"]
+                # Finished games are reported by the result handler thread of the pool,
+                # failed ones as well so their process slot is freed
                 pool.apply_async(
                     play_game,
-                    [
-                        li,
-                        game_id,
-                        control_queue,
-                        engine_factory,
-                        user_profile,
-                        config,
-                        challenge_queue,
-                    ],
+                    [li, game_id, engine_factory, user_profile, config, challenge_list],
+                    callback=lambda result: control_queue.put_nowait({"type": "local_game_done"}),
+                    error_callback=partial(game_failed, control_queue, game_id),
                 )
-            while (
-                queued_processes + busy_processes
-            ) < max_games and challenge_queue:  # keep processing the queue until empty or max_games is reached
-                chlng = challenge_queue.pop(0)
-                try:
-                    logger.info("    Accept {}".format(chlng))
-                    queued_processes += 1
-                    response = li.accept_challenge(chlng.id)
-                    logger.info(
-                        "--- Process Queue. Total Queued: {}. Total Used: {}".format(
-                            queued_processes, busy_processes
-                        )
+            # keep processing the queue until empty or max_games is reached
+            while queued_processes + busy_processes < max_games:
+                item = challenge_queue.pop()
+                if item is None:
+                    break
+                chlng, queued = item
+                logger.info("    Accept {}".format(chlng))
+                queued_processes += 1
+                accept_executor.submit(accept_challenge, li, chlng, queued, control_queue)
+                logger.info(
+                    "--- Process Queue. Total Queued: {}. Total Used: {}".format(
+                        queued_processes, busy_processes
                     )
-                except (HTTPError, ReadTimeout) as exception:
-                    if (
-                        isinstance(exception, HTTPError) and exception.response.status_code == 404
-                    ):  # ignore missing challenge
-                        logger.info("    Skip missing {}".format(chlng))
-                    queued_processes -= 1
+                )
+            challenge_queue.publish()
 
     logger.info("Terminated")
-    control_stream.terminate()
-    control_stream.join()
-
-
-ponder_results = {}
+    accept_executor.shutdown(wait=False)
+    control_stream.stop()
 
 
-@backoff.on_exception(backoff.expo, BaseException, max_time=600, giveup=is_final)
-def play_game(li, game_id, control_queue, engine_factory, user_profile, config, challenge_queue):
+@backoff.on_exception(backoff.expo, Exception, max_time=600, giveup=is_final)
+def play_game(li, game_id, engine_factory, user_profile, config, challenge_queue):
+    # Ongoing games cached before the game started would not list it, the
+    # reconnects of the game share the ones loaded from here on
+    li.invalidate_cache("playing")
     response = li.get_game_stream(game_id)
     lines = response.iter_lines()
 
     # Initial response of stream will be the full game info. Store it
-    initial_state = json.loads(next(lines).decode("utf-8"))
+    initial_state = decode_line(next(lines))
     game = model.Game(
-        initial_state,
+        initial_state.raw,
         user_profile["username"],
         li.baseUrl,
         config.get("abort_time", 20),
     )
-    board = setup_board(game)
-    engine = engine_factory(board)
+    # A retry after a dropped stream resumes the board from its last checkpoint
+    board_sync = resume_board(game.id, initial_board(game), game.state["moves"])
+    board = board_sync.board
+    engine = acquire_engine(engine_factory, board)
     conversation = Conversation(game, engine, li, __version__, challenge_queue)
 
     logger.info("+++ {}".format(game))
@@ -191,19 +252,23 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
     engine_cfg = config["engine"]
     is_uci = engine_cfg["protocol"] == "uci"
     is_uci_ponder = is_uci and engine_cfg.get("uci_ponder", False)
-    move_overhead = config.get("move_overhead", 1000)
+    # Adapts to the measured latency of the moves of this game
+    move_overhead = MoveOverhead.from_config(config)
     polyglot_cfg = engine_cfg.get("polyglot", {})
     book_cfg = polyglot_cfg.get("book", {})
+    cache_cfg = engine_cfg.get("analysis_cache", {})
+    analysis_cache = None
+    if cache_cfg.get("enabled"):
+        analysis_cache = open_analysis_cache(cache_cfg)
+    min_depth = required_depth(cache_cfg, initial_state.speed)
 
-    ponder_thread = None
+    ponder = PonderManager(engine, game.id)
     deferredFirstMove = False
 
-    ponder_uci = None
-
-    def ponder_thread_func(game, engine, board, wtime, btime, winc, binc):
-        global ponder_results
-        best_move, ponder_move = engine.search_with_ponder(board, wtime, btime, winc, binc, True)
-        ponder_results[game.id] = (best_move, ponder_move)
+    def make_move(move):
+        move_overhead.move_sent(len(board_sync.moves))
+        li.make_move(game.id, move)
+        move_overhead.move_acknowledged()
 
     engine.set_time_control(game)
 
@@ -211,9 +276,9 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
         while not terminated:
             try:
                 if not polyglot_cfg.get("enabled") or not play_first_book_move(
-                    game, engine, board, li, book_cfg
+                    game, engine, board, make_move, book_cfg
                 ):
-                    if not play_first_move(game, engine, board, li):
+                    if not play_first_move(game, engine, board, make_move):
                         deferredFirstMove = True
                 break
             except (HTTPError) as exception:
@@ -228,43 +293,40 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
             wtime = game.state["wtime"]
             btime = game.state["btime"]
             if board.turn == chess.WHITE:
-                wtime = max(0, wtime - move_overhead)
+                wtime = max(0, wtime - move_overhead.milliseconds())
             else:
-                btime = max(0, btime - move_overhead)
+                btime = max(0, btime - move_overhead.milliseconds())
             if (
                 polyglot_cfg.get("enabled")
                 and len(moves) <= polyglot_cfg.get("max_depth", 8) * 2 - 1
             ):
                 book_move = get_book_move(board, book_cfg)
             if book_move == None:
-                logger.info("Searching for wtime {} btime {}".format(wtime, btime))
-                best_move, ponder_move = engine.search_with_ponder(
-                    board, wtime, btime, game.state["winc"], game.state["binc"]
+                best_move, ponder_move = search_move(
+                    engine,
+                    board,
+                    wtime,
+                    btime,
+                    game.state["winc"],
+                    game.state["binc"],
+                    analysis_cache,
+                    min_depth,
                 )
-                engine.print_stats()
             else:
                 best_move = book_move
 
             if is_uci_ponder and not (ponder_move is None):
-                ponder_board = board.copy()
-                ponder_board.push(best_move)
-                ponder_board.push(ponder_move)
-                ponder_uci = ponder_move.uci()
                 logger.info("Pondering for wtime {} btime {}".format(wtime, btime))
-                ponder_thread = threading.Thread(
-                    target=ponder_thread_func,
-                    args=(
-                        game,
-                        engine,
-                        ponder_board,
-                        wtime,
-                        btime,
-                        game.state["winc"],
-                        game.state["binc"],
-                    ),
+                ponder.start(
+                    board,
+                    best_move,
+                    ponder_move,
+                    wtime,
+                    btime,
+                    game.state["winc"],
+                    game.state["binc"],
                 )
-                ponder_thread.start()
-            li.make_move(game.id, best_move)
+            make_move(best_move)
 
     while not terminated:
         try:
@@ -272,14 +334,15 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
         except (StopIteration):
             break
         try:
-            upd = json.loads(binary_chunk.decode("utf-8")) if binary_chunk else None
-            u_type = upd["type"] if upd else "ping"
+            upd = decode_line(binary_chunk)
+            u_type = upd.type
             if u_type == "chatLine":
                 conversation.react(ChatLine(upd), game)
             elif u_type == "gameState":
                 game.state = upd
-                moves = upd["moves"].split()
-                board = update_board(board, moves[-1])
+                board_sync.update(upd.moves)
+                moves = board_sync.moves
+                move_overhead.state_received(len(moves))
                 if not board.is_game_over() and is_engine_move(game, moves):
                     if config.get("fake_think_time") and len(moves) > 9:
                         delay = min(game.clock_initial, game.my_remaining_seconds()) * 0.015
@@ -290,26 +353,21 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
                     book_move = None
                     best_move = None
                     ponder_move = None
-                    if not (ponder_thread is None):
-                        move_uci = moves[-1]
-                        if ponder_uci == move_uci:
-                            engine.engine.ponderhit()
-                            ponder_thread.join()
-                            ponder_thread = None
-                            best_move, ponder_move = ponder_results[game.id]
+                    if ponder.pondering:
+                        # A missed ponder search is stopped, the next search waits for it
+                        ponder_result = ponder.resolve(moves[-1])
+                        if ponder_result is not None:
+                            best_move, ponder_move = ponder_result
                             engine.print_stats()
-                        else:
-                            engine.engine.stop()
-                            ponder_thread.join()
-                            ponder_thread = None
-                        ponder_uci = None
+                            if analysis_cache is not None:
+                                analysis_cache.store(board, engine, best_move, ponder_move)
 
-                    wtime = upd["wtime"]
-                    btime = upd["btime"]
+                    wtime = upd.wtime
+                    btime = upd.btime
                     if board.turn == chess.WHITE:
-                        wtime = max(0, wtime - move_overhead)
+                        wtime = max(0, wtime - move_overhead.milliseconds())
                     else:
-                        btime = max(0, btime - move_overhead)
+                        btime = max(0, btime - move_overhead.milliseconds())
 
                     if not deferredFirstMove:
                         if (
@@ -319,11 +377,17 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
                             book_move = get_book_move(board, book_cfg)
                         if best_move == None:
                             if book_move == None:
-                                logger.info("Searching for wtime {} btime {}".format(wtime, btime))
-                                best_move, ponder_move = engine.search_with_ponder(
-                                    board, wtime, btime, upd["winc"], upd["binc"]
+                                ponder.join()
+                                best_move, ponder_move = search_move(
+                                    engine,
+                                    board,
+                                    wtime,
+                                    btime,
+                                    upd["winc"],
+                                    upd["binc"],
+                                    analysis_cache,
+                                    min_depth,
                                 )
-                                engine.print_stats()
                             else:
                                 best_move = book_move
                         else:
@@ -332,30 +396,22 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
                                 ponder_move = None
 
                         if is_uci_ponder and not (ponder_move is None):
-                            ponder_board = board.copy()
-                            ponder_board.push(best_move)
-                            ponder_board.push(ponder_move)
-                            ponder_uci = ponder_move.uci()
                             logger.info("Pondering for wtime {} btime {}".format(wtime, btime))
-                            ponder_thread = threading.Thread(
-                                target=ponder_thread_func,
-                                args=(
-                                    game,
-                                    engine,
-                                    ponder_board,
-                                    wtime,
-                                    btime,
-                                    upd["winc"],
-                                    upd["binc"],
-                                ),
+                            ponder.start(
+                                board,
+                                best_move,
+                                ponder_move,
+                                wtime,
+                                btime,
+                                upd["winc"],
+                                upd["binc"],
                             )
-                            ponder_thread.start()
-                        li.make_move(game.id, best_move)
+                        make_move(best_move)
                     else:
                         if not polyglot_cfg.get("enabled") or not play_first_book_move(
-                            game, engine, board, li, book_cfg
+                            game, engine, board, make_move, book_cfg
                         ):
-                            play_first_move(game, engine, board, li)
+                            play_first_move(game, engine, board, make_move)
                         deferredFirstMove = False
                 if board.turn == chess.WHITE:
                     game.ping(
@@ -398,36 +454,45 @@ def play_game(li, game_id, control_queue, engine_factory, user_profile, config,
 
     logger.info("--- {} Game over".format(game.url()))
     engine.engine.stop()
-    engine.quit()
-    if not (ponder_thread is None):
-        ponder_thread.join()
-        ponder_thread = None
-
-    # This can raise queue.NoFull, but that should only happen if we're not processing
-    # events fast enough and in this case I believe the exception should be raised
-    control_queue.put_nowait({"type": "local_game_done"})
-
-
-def play_first_move(game, engine, board, li):
+    ponder.close()
+    release_engine(engine, board)
+    release_board(game.id)
+
+
+def search_move(engine, board, wtime, btime, winc, binc, analysis_cache, min_depth):
+    if analysis_cache is not None:
+        cached = analysis_cache.lookup(board, min_depth)
+        if cached is not None:
+            logger.info("Playing cached analysis of depth {} or more".format(min_depth))
+            return cached
+    logger.info("Searching for wtime {} btime {}".format(wtime, btime))
+    best_move, ponder_move = engine.search_with_ponder(board, wtime, btime, winc, binc)
+    engine.print_stats()
+    if analysis_cache is not None:
+        analysis_cache.store(board, engine, best_move, ponder_move)
+    return best_move, ponder_move
+
+
+def play_first_move(game, engine, board, make_move):
     moves = game.state["moves"].split()
     if is_engine_move(game, moves):
         # need to hardcode first movetime since Lichess has 30 sec limit.
         best_move = engine.first_search(board, 10000)
         engine.print_stats()
-        li.make_move(game.id, best_move)
+        make_move(best_move)
         return True
     return False
 
 
-def play_first_book_move(game, engine, board, li, config):
+def play_first_book_move(game, engine, board, make_move, config):
     moves = game.state["moves"].split()
     if is_engine_move(game, moves):
         book_move = get_book_move(board, config)
         if book_move:
-            li.make_move(game.id, book_move)
+            make_move(book_move)
             return True
         else:
-            return play_first_move(game, engine, board, li)
+            return play_first_move(game, engine, board, make_move)
     return False
 
 
@@ -440,18 +505,15 @@ def get_book_move(board, config):
         else:
             return None
 
-    with chess.polyglot.open_reader(book) as reader:
-        try:
-            selection = config.get("selection", "weighted_random")
-            if selection == "weighted_random":
-                move = reader.weighted_choice(board).move()
-            elif selection == "uniform_random":
-                move = reader.choice(board, minimum_weight=config.get("min_weight", 1)).move()
-            elif selection == "best_move":
-                move = reader.find(board, minimum_weight=config.get("min_weight", 1)).move()
-        except IndexError:
-            # python-chess raises "IndexError" if no entries found
-            move = None
+    reader = open_book(book, config.get("min_weight", 1))
+    selection = config.get("selection", "weighted_random")
+    move = None
+    if selection == "weighted_random":
+        move = reader.weighted_choice(board)
+    elif selection == "uniform_random":
+        move = reader.choice(board)
+    elif selection == "best_move":
+        move = reader.best_move(board)
 
     if move is not None:
         logger.info("Got move {} from book {}".format(move, book))
@@ -459,19 +521,13 @@ def get_book_move(board, config):
     return move
 
 
-def setup_board(game):
+def initial_board(game):
     if game.variant_name.lower() == "chess960":
-        board = chess.Board(game.initial_fen, chess960=True)
+        return chess.Board(game.initial_fen, chess960=True)
     elif game.variant_name == "From Position":
-        board = chess.Board(game.initial_fen)
-    else:
-        VariantBoard = find_variant(game.variant_name)
-        board = VariantBoard()
-    moves = game.state["moves"].split()
-    for move in moves:
-        board = update_board(board, move)
-
-    return board
+        return chess.Board(game.initial_fen)
+    VariantBoard = find_variant(game.variant_name)
+    return VariantBoard()
 
 
 def is_white_to_move(game, moves):
@@ -482,12 +538,6 @@ def is_engine_move(game, moves):
     return game.is_white == is_white_to_move(game, moves)
 
 
-def update_board(board, move):
-    uci_move = chess.Move.from_uci(move)
-    board.push(uci_move)
-    return board
-
-
 def intro():
     return (
         r"""
@@ -525,6 +575,14 @@ if __name__ == "__main__":
     enable_color_logging(debug_lvl=logging.DEBUG if args.v else logging.INFO)
     logger.info(intro())
     CONFIG = load_config(args.config or "./config.yml")
+    metrics_cfg = CONFIG.get("metrics", {})
+    if metrics_cfg.get("enabled", False):
+        start_metrics_server(
+            port=metrics_cfg.get("port", 9108),
+            host=metrics_cfg.get("host", "127.0.0.1"),
+        )
+    # The game processes stay within one request budget and 429 cooldown with this one
+    use_shared_budget(SharedBudget())
     li = lichess.Lichess(CONFIG["token"], CONFIG["url"], __version__)
 
     user_profile = li.get_profile()
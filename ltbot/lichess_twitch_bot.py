@@ -1,18 +1,32 @@
-import collections
 import enum
-import json
 import logging
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from requests import get
+import chess
 from irc.bot import SingleServerIRCBot
 from irc.client import ServerConnection, Event
+from requests import Session
 
 from . import Lichess
+from .actor import Actor, ChatCommand, GameStreamClosed, GameUpdate, LichessResult, TimerFired
+from .chat_log import ChatRecorder
+from .commands import Command, CommandRouter
+from .event_stream import EventStreamHub
+from .flood import DEFAULT_GLOBAL_LIMIT, DEFAULT_MAX_USERS, DEFAULT_USER_LIMIT, FloodControl
+from .metrics import REGISTRY
+from .move_vote import LegalMoveIndex
+from .stream_events import MoveTracker, decode_line
+from .twitch import CHANNEL_ID_CACHE_FILE, MessagePriority, MessageQueue, get_channel_id
+from .vote import VoteTally
 
 
 LOG = logging.getLogger(__name__)
 
+DROPPED_COMMANDS_TOTAL = REGISTRY.counter(
+    "ltbot_dropped_commands_total", "Chat commands dropped by flood control", ("command",)
+)
+
 
 class BotState(enum.Enum):
     IDLE = 0
@@ -21,10 +35,12 @@ class BotState(enum.Enum):
     PLAY_MOVE = 3
 
 
-class LichessTwitchBot(SingleServerIRCBot):
-    """A Twitch bot that can play chess on Lichess
+class ChannelBot:
+    """Plays chess on Lichess with the chat of one Twitch channel
 
-    Manages Lichess and Twitch connections.
+    Manages the Lichess connection of one channel. The IRC connection and
+    the outgoing message queue belong to the owner of the channel, so one
+    connection can serve many channels.
 
     ---
 
@@ -39,19 +55,27 @@ class LichessTwitchBot(SingleServerIRCBot):
     -------
     upgrade_lichess_account()
         Upgrades the connected Lichess account to bot
-    on_welcome(connection: ServerConnection, event: Event)
-        Callback for when the bot joins the Twitch chat
     on_pubmsg(connection: ServerConnection, event: Event)
         Callback for when a chat message is received in the Twitch chat
-    send_message(message: str)
-        Sends a message to the Twitch chat
+    send_message(message: str, priority=MessagePriority.NORMAL, coalesce_key=None)
+        Queues a message for the Twitch chat
+    chat_command_handle(message: ChatCommand)
+        Handles a chat command according to the bot state
+    lichess_call(request: str, args: tuple, function, *function_args)
+        Runs a Lichess request on a worker thread and sends the result to the actor
     start()
-        Starts the bot
+        Starts the Lichess event stream and the bot actor
     stop()
-        Stops the bot
+        Stops the Lichess event stream and the bot actor
     """
 
-    def __init__(self, configuration: dict, version: str):
+    def __init__(
+        self,
+        configuration: dict,
+        version: str,
+        message_queue: MessageQueue,
+        lichess_session: Session = None,
+    ):
         """
         Parameters
         ----------
@@ -59,6 +83,11 @@ class LichessTwitchBot(SingleServerIRCBot):
             Dictionary with Twitch and Lichess configuration
         version : str
             String representation of bot version
+        message_queue : MessageQueue
+            Queue for the messages to the Twitch chat
+        lichess_session : Session
+            Pooled HTTP session shared with other channels, by default the
+            channel has its own
         """
 
         self.configuration = configuration
@@ -70,47 +99,113 @@ class LichessTwitchBot(SingleServerIRCBot):
         self.TOKEN = configuration["twitch"]["token"]
         self.CHANNEL = "#{}".format(configuration["twitch"]["owner"].lower())
 
-        url = f"https://api.twitch.tv/kraken/users?login={self.USERNAME}"
-        headers = {
-            "Client-ID": self.CLIENT_ID,
-            "Accept": "application/vnd.twitchtv.v5+json",
-        }
-        resp = get(url, headers=headers).json()
-        self.channel_id = resp["users"][0]["_id"]
+        # Look up the channel id while the Lichess profile is fetched
+        self._channel_id = configuration["twitch"].get("channel_id")
+        self._channel_id_future = None
+        if self._channel_id is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._channel_id_future = executor.submit(
+                get_channel_id,
+                self.USERNAME,
+                self.CLIENT_ID,
+                configuration["twitch"].get("channel_id_cache", CHANNEL_ID_CACHE_FILE),
+            )
+            executor.shutdown(wait=False)
 
-        super().__init__(
-            [(self.HOST, self.PORT, f"oauth:{self.TOKEN}")],
-            self.USERNAME,
-            self.USERNAME,
-        )
+        self.message_queue = message_queue
+        chat_log = configuration["twitch"].get("chat_log")
+        self.chat_recorder = ChatRecorder(chat_log) if chat_log else None
 
         self.lichess_bot = Lichess(
             token=configuration["lichess"]["token"],
             url=configuration["lichess"]["url"],
             version=version,
+            session=lichess_session,
         )
         user_profile = self.lichess_bot.get_profile()
         LOG.info("Connected user {} to lichess".format(user_profile["username"]))
+        self.lichess_user_id = user_profile["id"]
+        self.lichess_events = EventStreamHub(self.lichess_bot)
+        # Lichess requests block, so they never run on the IRC reactor thread
+        self.lichess_executor = ThreadPoolExecutor(
+            max_workers=configuration["lichess"].get("workers", 4),
+            thread_name_prefix="lichess",
+        )
 
         self.challenge_vote_time = configuration["challenge_vote_time"]
+        self.challenge_response_time = configuration.get("challenge_response_time", 60)
+        self.move_vote_time = configuration.get("move_vote_time", 15)
+
+        commands = {"move_vote": "!move", **configuration["command"]}
 
-        self.challenge_parameters_command = configuration["command"]["challenge_parameters"]
-        self.challenge_start_command = configuration["command"]["challenge_start"]
-        self.challenge_vote_command = "{} ".format(configuration["command"]["challenge_vote"])
-        self.clock_limit_command = "{} ".format(configuration["command"]["clock_limit"])
-        self.clock_increment_command = "{} ".format(configuration["command"]["clock_increment"])
+        self.challenge_parameters_command = commands["challenge_parameters"]
+        self.challenge_start_command = commands["challenge_start"]
+        self.challenge_vote_command = "{} ".format(commands["challenge_vote"])
+        self.clock_limit_command = "{} ".format(commands["clock_limit"])
+        self.clock_increment_command = "{} ".format(commands["clock_increment"])
+        self.move_vote_command = "{} ".format(commands["move_vote"])
+        self.command_router = CommandRouter(commands)
 
         self.clock_limit_limits = (60, 10800)
         self.clock_increment_limits = (0, 60)
         self.clock_limit = configuration["lichess"]["initial_clock_limit"]
         self.clock_increment = configuration["lichess"]["initial_clock_increment"]
 
-        self.vote_dict = {}
+        flood_configuration = configuration.get("flood_control", {})
+        self.flood_control = FloodControl(
+            user_limit=(
+                flood_configuration.get("user_rate", DEFAULT_USER_LIMIT[0]),
+                flood_configuration.get("user_burst", DEFAULT_USER_LIMIT[1]),
+            ),
+            global_limit=(
+                flood_configuration.get("global_rate", DEFAULT_GLOBAL_LIMIT[0]),
+                flood_configuration.get("global_burst", DEFAULT_GLOBAL_LIMIT[1]),
+            ),
+            max_users=flood_configuration.get("max_users", DEFAULT_MAX_USERS),
+        )
+
+        self.votes = VoteTally()
         self.bot_state = BotState.IDLE
         self.challenge_id = None
+        self.bot_color = None
+        self.legal_moves = None
+        # Timers of earlier move votes carry an older number and are ignored
+        self.move_vote_number = 0
+
+        # The bot state is only changed on the actor thread
+        self.timers = {
+            "challenge_vote": self.challenge_vote_finish,
+            "move_vote": self.move_vote_finish,
+        }
+        self.lichess_results = {
+            "create_challenge": self.challenge_created,
+            "challenge_response": self.challenge_response_handle,
+            "make_move": self.move_played,
+        }
+        self.actor = Actor(
+            {
+                ChatCommand: self.chat_command_handle,
+                TimerFired: lambda message: self.timers[message.timer](*message.args),
+                LichessResult: lambda message: self.lichess_results[message.request](
+                    *message.args, message.future
+                ),
+                GameUpdate: self.game_state_handle,
+                GameStreamClosed: self.game_stream_closed,
+            },
+            state=lambda: self.bot_state.name,
+            name="ltbot",
+        )
 
         LOG.debug("ltbot initialized")
 
+    @property
+    def channel_id(self) -> str:
+        """Twitch channel id of the bot, waits for the lookup if still running"""
+
+        if self._channel_id is None:
+            self._channel_id = self._channel_id_future.result()
+        return self._channel_id
+
     def upgrade_lichess_account(self) -> bool:
         """Upgrade Lichess account to bot account
 
@@ -126,198 +221,503 @@ class LichessTwitchBot(SingleServerIRCBot):
         LOG.info("Succesfully upgraded Lichess account to bot")
         return True
 
-    def on_welcome(self, connection: ServerConnection, event: Event):
-        """Callback for when connection has been established
+    def on_pubmsg(self, connection: ServerConnection, event: Event):
+        """Callback for when message is received
 
-        Joins the Twitch chat and sends a message to confirm
-        connection.
+        Reads the message and sends it to the bot actor if it is a command.
+        Messages that are not commands are dropped before the tags are parsed.
 
         Parameters
-        ----------
         connection : ServerConnection
             Connection to Twitch server
         event : Event
             Event object for connection
+        ----------
         """
 
-        for req in ("membership", "tags", "commands"):
-            connection.cap("REQ", f":twitch.tv/{req}")
+        if self.chat_recorder is not None:
+            self.chat_recorder.record(event)
 
-        connection.join(self.CHANNEL)
-        self.send_message("Connected")
-        LOG.info(f"Connected user {self.USERNAME} to twitch channel {self.CHANNEL[1:]}.")
+        message = event.arguments[0]
+        command = self.command_router.route(message)
+        if command is None:
+            return
 
-    def on_pubmsg(self, connection: ServerConnection, event: Event):
-        """Callback for when message is received
+        tags = {kvpair["key"]: kvpair["value"] for kvpair in event.tags}
+        user = {"name": tags["display-name"], "id": tags["user-id"]}
+        self.actor.send(ChatCommand(user, command))
+
+        LOG.debug(f"Message from {user['name']}: {message}")
 
-        Reads the message and handles it if needed.
+    def chat_command_handle(self, message: ChatCommand):
+        """Handles a chat command according to the bot state
 
         Parameters
-        connection : ServerConnection
-            Connection to Twitch server
-        event : Event
-            Event object for connection
         ----------
+        message : ChatCommand
+            Sender and command of the chat message
         """
 
-        tags = {kvpair["key"]: kvpair["value"] for kvpair in event.tags}
-        user = {"name": tags["display-name"], "id": tags["user-id"]}
-        message = event.arguments[0]
-
+        user, command = message
         if self.bot_state == BotState.IDLE:
-            self.idle_handle_message(user["name"], message)
+            # Idle commands are answered in chat, so they are rate limited
+            if self.flood_control.allow(user["id"]):
+                self.idle_handle_message(user["name"], command)
+            else:
+                DROPPED_COMMANDS_TOTAL.inc(command.name)
         elif self.bot_state == BotState.CHALLENGE_VOTE:
-            self.challenge_vote_handle_message(user["name"], message)
+            self.challenge_vote_handle_message(user, command)
         elif self.bot_state == BotState.WAIT_FOR_OPPONENT:
             LOG.info("WAIT_FOR_OPPONENT")
         elif self.bot_state == BotState.PLAY_MOVE:
-            LOG.info("PLAY_MOVE")
+            self.move_vote_handle_message(user, command)
 
-        LOG.info(f"Message from {user['name']}: {message}")
-
-    def idle_handle_message(self, user: str, message: str):
-        """Handles the incoming message when idling.
+    def idle_handle_message(self, user: str, command: Command):
+        """Handles the incoming command when idling.
 
         Parameters
         ----------
         user : str
             The sender of the message
-        message : str
-            The user's message
+        command : Command
+            The command in the user's message
         """
 
-        if message == self.challenge_start_command:
-            # print("game id: ", self.lichess_bot.create_challenge("erik1993", 660, 10)["challenge"]["id"])
-            # self.challenge_response_handle()
-            # self.bot_state = BotState.CHALLENGE_VOTE
+        if command.name == "challenge_start":
             LOG.debug("Starting Lichess challenge vote.")
             self.challenge_vote_start()
-        elif message.startswith(self.clock_limit_command):
-            self.clock_limit_handle_request(message)
-        elif message.startswith(self.clock_increment_command):
-            self.clock_increment_handle_request(message)
-        elif message == self.challenge_parameters_command:
+        elif command.name == "clock_limit":
+            self.clock_limit_handle_request(command.argument)
+        elif command.name == "clock_increment":
+            self.clock_increment_handle_request(command.argument)
+        elif command.name == "challenge_parameters":
             LOG.info("Challenge parameters requested from user {}".format(user))
             self.send_message(
                 "@{} Clock limit: {}, Clock increment: {}".format(
                     user, self.clock_limit, self.clock_increment
-                )
+                ),
+                MessagePriority.LOW,
             )
 
     def challenge_vote_start(self):
         """Starts a vote for who to challenge on Lichess
 
         Starts a vote in Twitch chat for who to challenge on Lichess by resetting the
-        votes dictionary, updating the bot state and starting a timer. Announces in
+        vote tally, updating the bot state and starting a timer. Announces in
         Twitch chat that a vote has started.
         """
 
-        self.vote_dict = {}
+        self.votes = VoteTally()
         self.bot_state = BotState.CHALLENGE_VOTE
-        threading.Timer(self.challenge_vote_time, self.challenge_vote_finish).start()
+        self.actor.send_after(self.challenge_vote_time, TimerFired("challenge_vote"))
         LOG.info("Started vote for who to challenge on Lichess.")
         self.send_message(
             "Starting a vote for who to challenge on Lichess. "
-            "Type {}<lichess username> to vote.".format(self.challenge_vote_command)
+            "Type {}<lichess username> to vote.".format(self.challenge_vote_command),
+            MessagePriority.HIGH,
         )
 
-    def challenge_vote_handle_message(self, user: str, message: str):
-        """Handles the incoming message when voting for who to challenge on Lichess
+    def challenge_vote_handle_message(self, user: dict, command: Command):
+        """Handles the incoming command when voting for who to challenge on Lichess
+
+        Votes are counted per Twitch user id, so a user that changes display
+        name still has a single vote.
 
         Parameters
         ----------
-        user : str
-            The sender of the message
-        message : str
-            The user's message
+        user : dict
+            Name and id of the sender of the message
+        command : Command
+            The command in the user's message
         """
 
-        if len(message) > len(self.challenge_vote_command) and message.startswith(
-            self.challenge_vote_command
-        ):
-            vote = message[len(self.challenge_vote_command) :]
-            if user in self.vote_dict:
-                self.vote_dict[user] = vote
-                LOG.info("User {} changed their vote to {}.".format(user, vote))
-            else:
-                self.vote_dict[user] = vote
-                LOG.info("User {} voted for {}.".format(user, vote))
+        if command.name == "challenge_vote" and command.argument:
+            # Lichess usernames are case insensitive
+            vote = command.argument.lower()
+            previous = self.votes.vote(user["id"], vote)
+            if previous is None:
+                LOG.info("User {} voted for {}.".format(user["name"], vote))
+            elif previous != vote:
+                LOG.info("User {} changed their vote to {}.".format(user["name"], vote))
+
+    def vote_standings(self, count: int = 3) -> str:
+        """Describes the leading options of the running challenge vote
+
+        Parameters
+        ----------
+        count : int
+            Number of options to include
+
+        Returns
+        -------
+        str
+            The leading options and their votes
+        """
+
+        return ", ".join("{} ({})".format(option, votes) for option, votes in self.votes.top(count))
 
     def challenge_vote_finish(self):
         """Ends the vote for who to challenge on Lichess
 
-        Stops accepting votes for who to challenge and finds out who won. Announces the
-        results in Twitch chat.
+        Stops accepting votes for who to challenge and finds out who won. The
+        challenge is sent from a Lichess worker thread. Announces the results
+        in Twitch chat.
         """
 
         LOG.info("Challenge vote finished.")
-        if len(self.vote_dict) > 0:
-            winner, count = collections.Counter(self.vote_dict.values()).most_common(1)[0]
+        leader = self.votes.leader()
+        if leader is not None:
+            winner, count = leader
             LOG.info("Winner is {} with {} vote(s).".format(winner, count))
+            LOG.debug("Challenge vote standings: {}".format(self.vote_standings()))
             self.bot_state = BotState.WAIT_FOR_OPPONENT
-            response = self.lichess_bot.create_challenge(
-                winner, self.clock_limit, self.clock_increment
-            )
-            self.challenge_id = response["challenge"]["id"]
-            self.send_message(
-                "Challenged {} to a game on Lichess, waiting for answer.".format(winner)
+            self.lichess_call(
+                "create_challenge",
+                (winner,),
+                self.lichess_bot.create_challenge,
+                winner,
+                self.clock_limit,
+                self.clock_increment,
             )
-            self.challenge_response_handle()
         else:
             self.bot_state = BotState.IDLE
             LOG.info("No votes for who to challenge, bot will idle.")
             self.send_message(
                 "No votes were registered, type {} to start a new vote.".format(
                     self.challenge_start_command
-                )
+                ),
+                MessagePriority.HIGH,
+            )
+
+    def challenge_created(self, username: str, future: Future):
+        """Handles the created challenge and waits for the answer
+
+        Parameters
+        ----------
+        username : str
+            The challenged Lichess user
+        future : Future
+            The finished create_challenge request
+        """
+
+        try:
+            self.challenge_id = future.result()["challenge"]["id"]
+        except Exception:
+            LOG.exception("Failed to challenge {}.".format(username))
+            self.bot_state = BotState.IDLE
+            self.send_message(
+                "Failed to challenge {}, type {} to start a new challenge.".format(
+                    username, self.challenge_start_command
+                ),
+                MessagePriority.HIGH,
             )
+            return
+
+        self.send_message(
+            "Challenged {} to a game on Lichess, waiting for answer.".format(username),
+            MessagePriority.HIGH,
+        )
+        self.lichess_call(
+            "challenge_response",
+            (),
+            self.lichess_events.wait_for,
+            ("gameStart", "challengeDeclined", "challengeCanceled"),
+            self.challenge_id,
+            self.challenge_response_time,
+        )
 
-    def challenge_response_handle(self):
-        """Handles the response from the challenged Lichess user"""
+    def challenge_response_handle(self, future: Future):
+        """Handles the response from the challenged Lichess user
+
+        Parameters
+        ----------
+        future : Future
+            The finished wait on the shared Lichess event stream for the
+            challenged user to accept or decline the challenge
+        """
+
+        try:
+            event = future.result()
+        except Exception:
+            LOG.exception(
+                "Failed to wait for the answer to challenge {}.".format(self.challenge_id)
+            )
+            self.bot_state = BotState.IDLE
+            self.send_message(
+                "Failed to get an answer to the challenge, type {} to start a new challenge.".format(
+                    self.challenge_start_command
+                ),
+                MessagePriority.HIGH,
+            )
+            return
 
-        response = self.lichess_bot.get_event_stream()
-        print(response.text)
-        response_deserialized = json.loads(next(response.iter_lines()))
-        print(response_deserialized)
-        if response_deserialized["type"] == "gameStart":
+        if event is not None and event["type"] == "gameStart":
             # Challenge accepted
-            self.challenge_id = response_deserialized["game"]["id"]
-            response = self.lichess_bot.get_game_stream(self.challenge_id)
-            lines = response.iter_lines()
-            line = next(lines)
-            response_deserialized = json.loads(line)
-            print(response_deserialized)
-        elif response_deserialized["type"] == "challengeDeclined":
+            self.challenge_id = event["game"]["id"]
+            LOG.info("Challenge accepted, game {} started.".format(self.challenge_id))
+            self.send_message(
+                "Challenge accepted, vote for moves with {}<move>.".format(self.move_vote_command),
+                MessagePriority.HIGH,
+            )
+            threading.Thread(
+                target=self.game_handle,
+                args=(self.challenge_id,),
+                name="game-{}".format(self.challenge_id),
+                daemon=True,
+            ).start()
+        elif event is not None and event["type"] == "challengeDeclined":
             # Challenge declined
-            dest_user = response_deserialized["challenge"]["destUser"]["id"]
+            dest_user = event["challenge"]["destUser"]["id"]
             LOG.info("User {} declined the challenge, idling bot.".format(dest_user))
             self.bot_state = BotState.IDLE
             self.send_message(
                 "Challenged user {} declined the challenge, type {} to start a new challenge.".format(
                     dest_user, self.challenge_start_command
-                )
+                ),
+                MessagePriority.HIGH,
             )
         else:
             # Challenged timed out
             LOG.info("Challenge timed out.")
+            self.bot_state = BotState.IDLE
             self.send_message(
                 "No response from challenged user, type {} to start a new challenge.".format(
                     self.challenge_start_command
-                )
+                ),
+                MessagePriority.HIGH,
+            )
+
+    def game_handle(self, game_id: str):
+        """Follows a Lichess game stream
+
+        Runs on its own thread and only reads the stream. Every game state
+        is sent to the bot actor together with the position after its moves.
+
+        Parameters
+        ----------
+        game_id : str
+            Id of the Lichess game
+        """
+
+        try:
+            response = self.lichess_bot.get_game_stream(game_id)
+        except Exception:
+            LOG.exception("Failed to open game stream for {}.".format(game_id))
+            self.actor.send(GameStreamClosed(game_id))
+            return
+
+        try:
+            lines = response.iter_lines()
+            game_full = decode_line(next(lines))
+            color = (
+                chess.WHITE if game_full.white.get("id") == self.lichess_user_id else chess.BLACK
             )
+            if game_full.initialFen in (None, "startpos"):
+                initial_board = chess.Board()
+            else:
+                initial_board = chess.Board(game_full.initialFen)
+            board = initial_board.copy()
+            move_tracker = MoveTracker()
+
+            game_state = game_full.state
+            while game_state is not None:
+                new_moves = move_tracker.update(game_state.moves)
+                if move_tracker.reset:
+                    board = initial_board.copy()
+                for move in new_moves:
+                    board.push_uci(move)
+
+                self.actor.send(GameUpdate(game_id, color, board.copy(), game_state))
+                if game_state.status != "started":
+                    return
+
+                game_state = None
+                for line in lines:
+                    event = decode_line(line)
+                    if event.type == "gameState":
+                        game_state = event
+                        break
+        except Exception:
+            LOG.exception("Game stream for {} failed.".format(game_id))
+        finally:
+            response.close()
+        self.actor.send(GameStreamClosed(game_id))
+
+    def game_state_handle(self, update: GameUpdate):
+        """Handles a new state of the game
+
+        Finishes the game when it is over, otherwise starts a move vote on
+        the bot's turn. A repeated state of the same position, like one
+        for a draw offer, keeps the running vote.
+
+        Parameters
+        ----------
+        update : GameUpdate
+            Game id, bot color, position and state of the game
+        """
+
+        self.bot_color = update.color
+        if update.state.status != "started":
+            self.game_finish(update.state)
+        elif update.board.turn == self.bot_color:
+            if (
+                self.bot_state == BotState.PLAY_MOVE
+                and self.legal_moves is not None
+                and self.legal_moves.board.fen() == update.board.fen()
+            ):
+                return
+            self.move_vote_start(update.game_id, update.board)
 
-    def clock_limit_handle_request(self, message: str):
+    def game_stream_closed(self, message: GameStreamClosed):
+        """Idles the bot when a game stream closes before the game is over
+
+        Parameters
+        ----------
+        message : GameStreamClosed
+            Id of the Lichess game
+        """
+
+        game_id = message.game_id
+        if game_id == self.challenge_id and self.bot_state != BotState.IDLE:
+            LOG.info("Game stream for {} closed.".format(game_id))
+            self.bot_state = BotState.IDLE
+            self.legal_moves = None
+
+    def game_finish(self, game_state):
+        """Announces the result of the game and idles the bot
+
+        Parameters
+        ----------
+        game_state : GameState
+            Last state of the game
+        """
+
+        self.bot_state = BotState.IDLE
+        self.legal_moves = None
+        if game_state.winner is None:
+            result = "Game over ({})".format(game_state.status)
+        elif (game_state.winner == "white") == (self.bot_color == chess.WHITE):
+            result = "We won ({})".format(game_state.status)
+        else:
+            result = "We lost ({})".format(game_state.status)
+        LOG.info("Game {} finished: {}.".format(self.challenge_id, result))
+        self.send_message(
+            "{}, type {} to start a new challenge.".format(result, self.challenge_start_command),
+            MessagePriority.HIGH,
+        )
+
+    def move_vote_start(self, game_id: str, board: chess.Board):
+        """Starts a vote for the next move
+
+        Indexes every legal move of the position so that each vote is a
+        single lookup, resets the vote tally and starts a timer.
+
+        Parameters
+        ----------
+        game_id : str
+            Id of the Lichess game
+        board : chess.Board
+            Position to vote for a move in
+        """
+
+        self.legal_moves = LegalMoveIndex(board)
+        self.votes.clear()
+        self.bot_state = BotState.PLAY_MOVE
+        self.move_vote_number += 1
+        self.actor.send_after(
+            self.move_vote_time, TimerFired("move_vote", (game_id, self.move_vote_number))
+        )
+        LOG.info("Started vote for move in game {}.".format(game_id))
+        self.send_message(
+            "Vote for the next move with {}<move>.".format(self.move_vote_command),
+            MessagePriority.HIGH,
+        )
+
+    def move_vote_handle_message(self, user: dict, command: Command):
+        """Handles the incoming command when voting for the next move
+
+        Parameters
+        ----------
+        user : dict
+            Name and id of the sender of the message
+        command : Command
+            The command in the user's message
+        """
+
+        if command.name == "move_vote":
+            move = self.legal_moves.get(command.argument.strip())
+            if move is not None:
+                self.votes.vote(user["id"], move)
+
+    def move_vote_finish(self, game_id: str, vote_number: int):
+        """Ends the vote for the next move and plays the winning move
+
+        Starts a new vote if nobody voted.
+
+        Parameters
+        ----------
+        game_id : str
+            Id of the Lichess game
+        vote_number : int
+            Number of the vote the timer was started for, the timers of
+            earlier votes are ignored
+        """
+
+        if self.bot_state != BotState.PLAY_MOVE or vote_number != self.move_vote_number:
+            return
+        leader = self.votes.leader()
+        board = self.legal_moves.board
+        if leader is None:
+            LOG.info("No votes for move, restarting vote.")
+            self.move_vote_start(game_id, board)
+            return
+        move, count = leader
+        san = board.san(move)
+        LOG.info("Playing {} with {} vote(s).".format(san, count))
+        self.bot_state = BotState.WAIT_FOR_OPPONENT
+        self.lichess_call(
+            "make_move",
+            (game_id, board, san),
+            self.lichess_bot.make_move,
+            game_id,
+            move.uci(),
+        )
+
+    def move_played(self, game_id: str, board: chess.Board, san: str, future: Future):
+        """Announces the played move, or votes again if Lichess refused it
+
+        Parameters
+        ----------
+        game_id : str
+            Id of the Lichess game
+        board : chess.Board
+            Position the move was played in
+        san : str
+            The played move
+        future : Future
+            The finished make_move request
+        """
+
+        try:
+            future.result()
+        except Exception:
+            LOG.exception("Failed to play {} in game {}.".format(san, game_id))
+            if self.bot_state == BotState.WAIT_FOR_OPPONENT and game_id == self.challenge_id:
+                self.move_vote_start(game_id, board)
+            return
+        self.send_message("Played {}.".format(san), MessagePriority.HIGH)
+
+    def clock_limit_handle_request(self, value: str):
         """Handles the request to update the clock limit
 
         Parameters
         ----------
-        message : str
-            The user's message
+        value : str
+            The requested clock limit
         """
 
         try:
-            new_clock_limit = int(message[len(self.clock_limit_command) :])
-            print(new_clock_limit)
+            new_clock_limit = int(value)
             if (
                 self.clock_limit_limits[0] <= new_clock_limit
                 and new_clock_limit <= self.clock_limit_limits[1]
@@ -325,66 +725,192 @@ class LichessTwitchBot(SingleServerIRCBot):
             ):
                 self.clock_limit = new_clock_limit
                 LOG.info("Set new clock limit to {}.".format(self.clock_limit))
-                self.send_message("New clock limit set to {}.".format(self.clock_limit))
+                self.send_message(
+                    "New clock limit set to {}.".format(self.clock_limit),
+                    MessagePriority.LOW,
+                    coalesce_key="clock_limit",
+                )
             else:
                 LOG.info("Clock limit outside limits.")
                 self.send_message(
                     "Couldn't update clock limit, make sure the new value is between {} and {}.".format(
                         self.clock_limit_limits[0], self.clock_limit_limits[1]
                     )
-                    + " Also make sure it is divisible by 60 or is exactly 15, 30, 45 or 90."
+                    + " Also make sure it is divisible by 60 or is exactly 15, 30, 45 or 90.",
+                    MessagePriority.LOW,
+                    coalesce_key="clock_limit",
                 )
         except:
             LOG.exception("Failed to update clock limit.")
             self.send_message(
                 "Failed to update clock limit, did you use the command correctly? "
-                "It should be {}<new clock limit>".format(self.clock_limit_command)
+                "It should be {}<new clock limit>".format(self.clock_limit_command),
+                MessagePriority.LOW,
+                coalesce_key="clock_limit",
             )
 
-    def clock_increment_handle_request(self, message: str):
+    def clock_increment_handle_request(self, value: str):
         """Handles the request to update the clock increment
 
         Parameters
         ----------
-        message : str
-            The user's message
+        value : str
+            The requested clock increment
         """
         try:
-            new_clock_increment = int(message[len(self.clock_increment_command) :])
+            new_clock_increment = int(value)
             if (
                 self.clock_increment_limits[0] <= new_clock_increment
                 and new_clock_increment <= self.clock_increment_limits[1]
             ):
                 self.clock_increment = new_clock_increment
                 LOG.info("Set new clock increment to {}.".format(self.clock_increment))
-                self.send_message("New clock increment set to {}.".format(self.clock_increment))
+                self.send_message(
+                    "New clock increment set to {}.".format(self.clock_increment),
+                    MessagePriority.LOW,
+                    coalesce_key="clock_increment",
+                )
             else:
                 LOG.info("Given clock increment outside limits.")
                 self.send_message(
                     "Couldn't update clock increment, make sure the new value is between {} and {}.".format(
                         self.clock_increment_limits[0], self.clock_increment_limits[1]
-                    )
+                    ),
+                    MessagePriority.LOW,
+                    coalesce_key="clock_increment",
                 )
         except:
             LOG.exception("Failed to update clock increment.")
             self.send_message(
                 "Failed to update clock increment, did you use the command correctly? "
-                "It should be {}<new clock increment>".format(self.clock_increment_command)
+                "It should be {}<new clock increment>".format(self.clock_increment_command),
+                MessagePriority.LOW,
+                coalesce_key="clock_increment",
             )
 
-    def send_message(self, message: str):
+    def send_message(
+        self,
+        message: str,
+        priority: MessagePriority = MessagePriority.NORMAL,
+        coalesce_key: str = None,
+    ):
         """Sends message to chat
 
-        Sends a message to chat and logs it.
+        Queues a message for the chat and logs it. The message is sent
+        from the message queue thread within the Twitch rate limits.
 
         Parameters
         ----------
         message : str
             The message to send
+        priority : MessagePriority
+            Messages with higher priority are sent first
+        coalesce_key : str
+            Waiting messages with the same key are replaced by this one
         """
 
         LOG.debug("Sending message: {}".format(message))
-        self.connection.privmsg(self.CHANNEL, message)
+        self.message_queue.put(self.CHANNEL, message, priority, coalesce_key)
+
+    def lichess_call(self, request: str, args: tuple, function, *function_args):
+        """Runs a Lichess request on a worker thread
+
+        The IRC reactor keeps answering PINGs and reading chat while the
+        request is in flight. The finished future is sent to the bot actor
+        as a LichessResult.
+
+        Parameters
+        ----------
+        request : str
+            Name of the request, selects the handler in lichess_results
+        args : tuple
+            Arguments for the handler, the future is passed after them
+        function : Callable
+            The blocking Lichess request
+        *function_args
+            Arguments for the request
+        """
+
+        future = self.lichess_executor.submit(function, *function_args)
+        future.add_done_callback(
+            lambda future: self.actor.send(LichessResult(request, args, future))
+        )
+
+    def start(self):
+        """Start the Lichess event stream and the bot actor"""
+
+        self.lichess_events.start()
+        self.actor.start()
+
+    def stop(self):
+        """Stop the Lichess event stream and the bot actor"""
+
+        self.lichess_events.stop()
+        self.actor.stop()
+        self.lichess_executor.shutdown(wait=False)
+        if self.chat_recorder is not None:
+            self.chat_recorder.close()
+
+
+class LichessTwitchBot(ChannelBot, SingleServerIRCBot):
+    """A Twitch bot that can play chess on Lichess
+
+    Manages Lichess and Twitch connections for a single Twitch channel.
+
+    ---
+
+    Methods
+    -------
+    on_welcome(connection: ServerConnection, event: Event)
+        Callback for when the bot joins the Twitch chat
+    start()
+        Starts the bot
+    stop()
+        Stops the bot
+    """
+
+    def __init__(self, configuration: dict, version: str):
+        """
+        Parameters
+        ----------
+        configuration : dict
+            Dictionary with Twitch and Lichess configuration
+        version : str
+            String representation of bot version
+        """
+
+        message_queue = MessageQueue(
+            lambda channel, message: self.connection.privmsg(channel, message),
+            configuration["twitch"].get("rate_limit_tier", "user"),
+        )
+        ChannelBot.__init__(self, configuration, version, message_queue)
+        SingleServerIRCBot.__init__(
+            self,
+            [(self.HOST, self.PORT, f"oauth:{self.TOKEN}")],
+            self.USERNAME,
+            self.USERNAME,
+        )
+
+    def on_welcome(self, connection: ServerConnection, event: Event):
+        """Callback for when connection has been established
+
+        Joins the Twitch chat and sends a message to confirm
+        connection.
+
+        Parameters
+        ----------
+        connection : ServerConnection
+            Connection to Twitch server
+        event : Event
+            Event object for connection
+        """
+
+        for req in ("membership", "tags", "commands"):
+            connection.cap("REQ", f":twitch.tv/{req}")
+
+        connection.join(self.CHANNEL)
+        self.send_message("Connected", MessagePriority.HIGH)
+        LOG.info(f"Connected user {self.USERNAME} to twitch channel {self.CHANNEL[1:]}.")
 
     def start(self):
         """Start bot
@@ -393,7 +919,9 @@ class LichessTwitchBot(SingleServerIRCBot):
         """
 
         LOG.debug("Starting bot")
-        super().start()
+        ChannelBot.start(self)
+        self.message_queue.start()
+        SingleServerIRCBot.start(self)
 
     def stop(self):
         """Stop bot
@@ -402,4 +930,6 @@ class LichessTwitchBot(SingleServerIRCBot):
         """
 
         LOG.debug("Stopping bot")
+        ChannelBot.stop(self)
+        self.message_queue.stop()
         self.die()
@@ -0,0 +1,386 @@
+"""Metrics
+
+Process wide metrics in the Prometheus text format, and a small HTTP
+server that exposes them on /metrics.
+
+    * Counter - Monotonically increasing labelled counter
+    * Gauge - Labelled value that can go up and down
+    * Histogram - Labelled histogram with cumulative buckets
+    * Registry - Collection of metrics rendered together
+    * REGISTRY - The default registry
+    * start_metrics_server - Serves a registry over HTTP
+    * forward_metrics - Sends the metrics of a worker process to a queue
+    * collect_metrics - Merges the metrics forwarded by worker processes
+"""
+
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between the snapshots a worker process forwards
+FORWARD_INTERVAL = 5.0
+
+# Latency buckets in seconds, from fast moves to slow stream reconnects
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+
+def _label_key(label_values: tuple) -> tuple:
+    # Label values are compared when rendering, so they are all kept as strings
+    return tuple(str(value) for value in label_values)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+
+    def snapshot(self) -> dict:
+        """Copy the values by label values"""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Forget every value"""
+
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter with labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        label_values = _label_key(label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(_label_key(label_values), 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _merge(self, values: dict, remote: dict):
+        # Every process counts its own events, the totals are the sums
+        for label_values, value in remote.items():
+            values[label_values] = values.get(label_values, 0) + value
+
+    def render(self, remote: list = ()):
+        lines = self.header()
+        values = self.snapshot()
+        for snapshot in remote:
+            self._merge(values, snapshot)
+        for label_values, value in sorted(values.items()):
+            lines.append(
+                "{}{} {}".format(self.name, _format_labels(self.labels, label_values), value)
+            )
+        return lines
+
+
+class Gauge(Counter):
+    """Value that can go up and down, with labels"""
+
+    kind = "gauge"
+
+    def set(self, *label_values, value: float):
+        label_values = _label_key(label_values)
+        with self._lock:
+            self._values[label_values] = value
+
+    def _merge(self, values: dict, remote: dict):
+        # Snapshots are merged oldest first, the latest value set wins
+        values.update(remote)
+
+
+class Histogram(_Metric):
+    """Histogram with cumulative buckets and labels
+
+    Besides the Prometheus buckets the histogram can estimate quantiles
+    from its buckets, which is enough for logging p50 and p99.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, *label_values, value: float):
+        label_values = _label_key(label_values)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Bucket counts followed by the overflow bucket, sum and count
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(_label_key(label_values))
+        return series[-1] if series else 0
+
+    def quantile(self, q: float, *label_values):
+        """Estimate a quantile as the upper bound of the bucket holding it
+
+        Returns
+        -------
+            The estimated quantile in seconds, or None without observations
+        """
+
+        with self._lock:
+            series = self._series.get(_label_key(label_values))
+            if not series or series[-1] == 0:
+                return None
+            rank = q * series[-1]
+            seen = 0
+            for bound, count in zip(self.buckets, series):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {label_values: list(series) for label_values, series in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self, remote: list = ()):
+        lines = self.header()
+        merged = self.snapshot()
+        for snapshot in remote:
+            for label_values, series in snapshot.items():
+                current = merged.get(label_values)
+                if current is None:
+                    merged[label_values] = list(series)
+                else:
+                    merged[label_values] = [a + b for a, b in zip(current, series)]
+        for label_values, series in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels, label_values, 'le="{}"'.format(le))
+                lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+            labels = _format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels, series[-2]))
+            lines.append("{}_count{} {}".format(self.name, labels, series[-1]))
+        return lines
+
+
+class Registry:
+    """Collection of metrics that are rendered together
+
+    A registry can also hold the latest snapshots of the registries of
+    other processes, which are rendered summed with its own metrics.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        # Latest snapshot by source process, least recently updated first
+        self._remote = collections.OrderedDict()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labels)
+
+    def histogram(
+        self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram, name, documentation, labels, buckets)
+
+    def snapshot(self) -> dict:
+        """Copy the values of every metric, to be merged into another registry"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def clear(self):
+        """Forget the values of every metric and every merged snapshot"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+            self._remote.clear()
+        for metric in metrics:
+            metric.clear()
+
+    def merge(self, source, snapshot: dict):
+        """Keep the latest snapshot of another process
+
+        Parameters
+        ----------
+        source
+            Identifies the process, a newer snapshot replaces the last one
+        snapshot : dict
+            The snapshot of the registry of the process
+        """
+
+        with self._lock:
+            self._remote[source] = snapshot
+            self._remote.move_to_end(source)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+            remote = list(self._remote.values())
+        lines = []
+        for metric in metrics:
+            snapshots = [snapshot[metric.name] for snapshot in remote if metric.name in snapshot]
+            lines.extend(metric.render(snapshots))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY):
+    """Serve metrics on /metrics from a daemon thread
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on, 0 picks a free port
+    host : str
+        Address to listen on, local only by default
+    registry : Registry
+        Metrics to serve
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server, call shutdown() to stop it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOG.debug("Metrics request: " + format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    LOG.info("Serving metrics on http://{}:{}/metrics".format(host, server.server_address[1]))
+    return server
+
+
+def forward_metrics(queue, interval: float = FORWARD_INTERVAL, registry: Registry = REGISTRY):
+    """Send the metrics of a worker process to a queue from a daemon thread
+
+    The registry is cleared first, a forked process starts with a copy of
+    the values its parent already serves. A snapshot is sent whenever the
+    values changed since the last one.
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        Queue the process serving the metrics collects from
+    interval : float
+        Seconds between snapshots
+    registry : Registry
+        Metrics of the process
+    """
+
+    registry.clear()
+    source = os.getpid()
+
+    def forward():
+        last = {}
+        while True:
+            time.sleep(interval)
+            snapshot = registry.snapshot()
+            if snapshot == last:
+                continue
+            try:
+                queue.put((source, snapshot))
+            except Exception:
+                LOG.debug("Failed to forward metrics", exc_info=True)
+                return
+            last = snapshot
+
+    threading.Thread(target=forward, name="metrics-forward", daemon=True).start()
+
+
+def collect_metrics(queue, registry: Registry = REGISTRY):
+    """Merge the metrics forwarded by worker processes from a daemon thread
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        Queue the worker processes forward to
+    registry : Registry
+        Registry to merge into, usually the one served by start_metrics_server
+    """
+
+    def collect():
+        while True:
+            try:
+                source, snapshot = queue.get()
+            except (EOFError, OSError):
+                return
+            registry.merge(source, snapshot)
+
+    threading.Thread(target=collect, name="metrics-collect", daemon=True).start()
@@ -0,0 +1,198 @@
+"""Move overhead
+
+Estimates the clock time a move loses on the way between Lichess and the
+engine, so a game keeps only as much time in reserve as the connection
+actually needs.
+
+    * MoveOverhead - Rolling percentile of the measured move latencies of a game
+"""
+
+import collections
+import logging
+import math
+import time
+
+try:
+    from .metrics import REGISTRY
+except ImportError:
+    # Imported as a top-level module by lichess_bot
+    from metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+MOVE_REQUEST_SECONDS = REGISTRY.histogram(
+    "ltbot_move_request_seconds", "Round trip of the Lichess make move request"
+)
+MOVE_DELIVERY_SECONDS = REGISTRY.histogram(
+    "ltbot_move_delivery_seconds",
+    "Time from sending a move to receiving the game state with it",
+)
+MOVE_OVERHEAD_MILLISECONDS = REGISTRY.gauge(
+    "ltbot_move_overhead_milliseconds", "Move overhead used by the last search"
+)
+
+# Measured moves needed before the estimate replaces the configured overhead
+MIN_SAMPLES = 3
+
+
+def _percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+
+class MoveOverhead:
+    """Rolling percentile of the measured move latencies of a game
+
+    Every move the bot sends is timed twice: the make move request, and
+    the delivery of the game state that contains the move, which covers
+    the whole way through Lichess and back. The overhead is the higher
+    percentile of both over the last moves plus a safety margin, kept
+    within bounds. Until a few moves are measured the configured
+    overhead is used.
+
+    ---
+
+    Attributes
+    ----------
+    request_seconds : collections.deque
+        Latest make move round trips
+    delivery_seconds : collections.deque
+        Latest game state deliveries
+
+    Methods
+    -------
+    move_sent(ply)
+        Marks a move as sent
+    move_acknowledged()
+        Records the round trip of the make move request
+    state_received(plies)
+        Records the delivery of a game state with the sent move
+    milliseconds()
+        Returns the overhead to subtract from the clock
+    """
+
+    def __init__(
+        self,
+        initial: int = 1000,
+        percentile: float = 0.95,
+        window: int = 32,
+        margin: int = 50,
+        minimum: int = 100,
+        maximum: int = 5000,
+    ):
+        """
+        Parameters
+        ----------
+        initial : int
+            Overhead in milliseconds until enough moves are measured
+        percentile : float
+            Percentile of the measured latencies, between 0 and 1
+        window : int
+            Latest moves the percentile is taken over
+        margin : int
+            Milliseconds added to the percentile
+        minimum : int
+            Lowest overhead in milliseconds
+        maximum : int
+            Highest overhead in milliseconds
+        """
+
+        self.initial = initial
+        self.percentile = percentile
+        self.margin = margin
+        self.minimum = minimum
+        self.maximum = maximum
+        self.request_seconds = collections.deque(maxlen=window)
+        self.delivery_seconds = collections.deque(maxlen=window)
+        self._sent_at = None
+        self._sent_ply = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "MoveOverhead":
+        """Create the estimate from the bot configuration
+
+        Parameters
+        ----------
+        config : dict
+            Bot configuration, move_overhead is the initial overhead and
+            adaptive_move_overhead tunes the estimate
+
+        Returns
+        -------
+        MoveOverhead
+            The estimate, fixed to move_overhead if adaptive_move_overhead
+            is disabled
+        """
+
+        initial = config.get("move_overhead", 1000)
+        adaptive = config.get("adaptive_move_overhead", {})
+        if not adaptive.get("enabled", True):
+            return cls(initial, minimum=initial, maximum=initial)
+        return cls(
+            initial,
+            adaptive.get("percentile", 0.95),
+            adaptive.get("window", 32),
+            adaptive.get("margin", 50),
+            adaptive.get("min", 100),
+            adaptive.get("max", 5000),
+        )
+
+    def move_sent(self, ply: int):
+        """Mark a move as sent
+
+        Parameters
+        ----------
+        ply : int
+            Plies of the game before the move
+        """
+
+        self._sent_at = time.monotonic()
+        self._sent_ply = ply
+
+    def move_acknowledged(self):
+        """Record the round trip of the make move request"""
+
+        if self._sent_at is None:
+            return
+        seconds = time.monotonic() - self._sent_at
+        self.request_seconds.append(seconds)
+        MOVE_REQUEST_SECONDS.observe(value=seconds)
+
+    def state_received(self, plies: int):
+        """Record the delivery of a game state if it contains the sent move
+
+        Parameters
+        ----------
+        plies : int
+            Plies of the game in the received state
+        """
+
+        if self._sent_at is None or plies <= self._sent_ply:
+            return
+        seconds = time.monotonic() - self._sent_at
+        self.delivery_seconds.append(seconds)
+        MOVE_DELIVERY_SECONDS.observe(value=seconds)
+        self._sent_at = None
+        self._sent_ply = None
+
+    def milliseconds(self) -> int:
+        """Get the overhead to subtract from the clock before a search
+
+        Returns
+        -------
+        int
+            The overhead in milliseconds
+        """
+
+        samples = [
+            _percentile(measured, self.percentile)
+            for measured in (self.request_seconds, self.delivery_seconds)
+            if len(measured) >= MIN_SAMPLES
+        ]
+        if samples:
+            overhead = round(max(samples) * 1000) + self.margin
+        else:
+            overhead = self.initial
+        overhead = max(self.minimum, min(self.maximum, overhead))
+        MOVE_OVERHEAD_MILLISECONDS.set(value=overhead)
+        return overhead
@@ -0,0 +1,79 @@
+"""Move voting
+
+Fast validation of chess moves voted for in chat.
+
+    * LegalMoveIndex - Every accepted spelling of the legal moves of a position
+"""
+
+from typing import Optional
+
+import chess
+
+
+class LegalMoveIndex:
+    """Every accepted spelling of the legal moves in a position
+
+    The index is built once per ply so that each vote is validated with
+    a dictionary lookup instead of parsing it against the board. Accepted
+    spellings are UCI, SAN and lower case SAN, each with and without the
+    check or mate symbol. A lower case spelling shared by two moves, like
+    bxc3 for a bishop and a pawn capture, is left out.
+
+    ---
+
+    Attributes
+    ----------
+    board : chess.Board
+        Copy of the position the index was built for
+
+    Methods
+    -------
+    get(text)
+        Returns the legal move spelled by the text, or None
+    """
+
+    def __init__(self, board: chess.Board):
+        """
+        Parameters
+        ----------
+        board : chess.Board
+            Position to index the legal moves of
+        """
+
+        self.board = board.copy(stack=False)
+        moves = {}
+        lower_moves = {}
+        for move in self.board.legal_moves:
+            uci = move.uci()
+            san = self.board.san(move)
+            bare_san = san.rstrip("+#")
+            for spelling in (uci, san, bare_san):
+                moves[spelling] = move
+            for spelling in (san.lower(), bare_san.lower()):
+                lower_moves.setdefault(spelling, set()).add(move)
+        for spelling, candidates in lower_moves.items():
+            if spelling not in moves and len(candidates) == 1:
+                moves[spelling] = next(iter(candidates))
+        self._moves = moves
+
+    def __len__(self):
+        return len(self._moves)
+
+    def get(self, text: str) -> Optional[chess.Move]:
+        """Get the legal move spelled by a chat message
+
+        Parameters
+        ----------
+        text : str
+            The voted move
+
+        Returns
+        -------
+        chess.Move
+            The legal move, or None if the text is not a legal move
+        """
+
+        move = self._moves.get(text)
+        if move is None:
+            move = self._moves.get(text.lower())
+        return move
@@ -0,0 +1,287 @@
+"""Polyglot opening books
+
+Process wide cache of memory mapped polyglot books. Positions are found
+by binary search over the mapped file, and their move selection tables
+are built on first lookup, so picking a book move neither reopens the
+book nor reads the whole file.
+
+    * PolyglotBook - Memory mapped book with constant time move selection
+    * open_book - Returns the cached book for a file
+    * preload_books - Opens every book of a book configuration
+"""
+
+import collections
+import logging
+import random
+import threading
+from array import array
+from typing import Optional
+
+import chess
+import chess.polyglot
+
+LOG = logging.getLogger(__name__)
+
+# Positions whose selection tables a book keeps
+DEFAULT_CACHED_POSITIONS = 4096
+
+
+def _alias_table(weights: list):
+    """Vose's alias table for picking an index by weight in constant time"""
+
+    count = len(weights)
+    total = sum(weights)
+    scaled = [weight * count / total for weight in weights]
+    probabilities = [1.0] * count
+    aliases = list(range(count))
+    small = [index for index, value in enumerate(scaled) if value < 1.0]
+    large = [index for index, value in enumerate(scaled) if value >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        (small if scaled[more] < 1.0 else large).append(more)
+    return probabilities, aliases
+
+
+class _Position:
+    """Entries of a book position ordered by weight, with their alias table"""
+
+    __slots__ = ("order", "probabilities", "aliases", "weighted", "eligible")
+
+    def __init__(self, entries: list, minimum_weight: int):
+        # Book indexes and weights of the entries, heaviest first
+        entries = sorted(entries, key=lambda entry: -entry[1])
+        weights = [weight for _, weight in entries]
+        self.order = array("I", (index for index, _ in entries))
+        self.weighted = sum(1 for weight in weights if weight > 0)
+        self.eligible = sum(1 for weight in weights if weight >= minimum_weight)
+        if self.weighted:
+            probabilities, aliases = _alias_table(weights[: self.weighted])
+        else:
+            probabilities, aliases = [], []
+        self.probabilities = array("d", probabilities)
+        self.aliases = array("I", aliases)
+
+
+class PolyglotBook:
+    """Memory mapped polyglot book with constant time move selection
+
+    The book file is memory mapped once, so processes forked after the
+    book is opened share its pages instead of reading their own copy.
+    Positions are found by binary search on their Zobrist keys, which
+    the file is sorted by. The entries of a position are ordered by
+    weight with an alias table the first time it is looked up, so that
+    weighted, uniform and best move choices are constant time once
+    found. The tables of the most recently looked up positions are kept.
+
+    ---
+
+    Attributes
+    ----------
+    path : str
+        The book file
+    minimum_weight : int
+        Entries below this weight are not picked by choice and best_move
+
+    Methods
+    -------
+    weighted_choice(board)
+        Returns a book move picked by weight, or None
+    choice(board)
+        Returns a book move picked uniformly, or None
+    best_move(board)
+        Returns the book move with the highest weight, or None
+    close()
+        Unmaps the book file
+    """
+
+    def __init__(
+        self,
+        path: str,
+        minimum_weight: int = 1,
+        cached_positions: int = DEFAULT_CACHED_POSITIONS,
+    ):
+        """
+        Parameters
+        ----------
+        path : str
+            The polyglot book file
+        minimum_weight : int
+            Entries below this weight are not picked by choice and best_move
+        cached_positions : int
+            Positions whose selection tables are kept
+        """
+
+        self.path = path
+        self.minimum_weight = minimum_weight
+        self.cached_positions = cached_positions
+        self.reader = chess.polyglot.MemoryMappedReader(path)
+        # Selection tables by Zobrist key, None for keys not in the book
+        self._positions = collections.OrderedDict()
+        self._lock = threading.Lock()
+        LOG.debug("Mapped {} entries of book {}".format(len(self.reader), path))
+
+    def __len__(self):
+        """Number of entries in the book"""
+
+        return len(self.reader)
+
+    def _position(self, board: chess.Board) -> Optional[_Position]:
+        key = chess.polyglot.zobrist_hash(board)
+        with self._lock:
+            if key in self._positions:
+                self._positions.move_to_end(key)
+                return self._positions[key]
+        entries = []
+        index = self.reader.bisect_key_left(key)
+        while index < len(self.reader):
+            entry = self.reader[index]
+            if entry.key != key:
+                break
+            entries.append((index, entry.weight))
+            index += 1
+        position = _Position(entries, self.minimum_weight) if entries else None
+        with self._lock:
+            self._positions[key] = position
+            if len(self._positions) > self.cached_positions:
+                self._positions.popitem(last=False)
+        return position
+
+    def _move(self, board: chess.Board, index: int) -> Optional[chess.Move]:
+        move = self.reader[index].move
+        # Castling is stored as king takes rook, normalized like chess.polyglot does
+        move = board._from_chess960(
+            board.chess960, move.from_square, move.to_square, move.promotion, move.drop
+        )
+        # Zobrist keys can collide, callers fall back to the search of chess.polyglot
+        return move if board.is_legal(move) else None
+
+    def _search(self, method, board: chess.Board, **kwargs) -> Optional[chess.Move]:
+        # Skips illegal entries, only needed on a Zobrist key collision
+        try:
+            return method(board, **kwargs).move
+        except IndexError:
+            return None
+
+    def weighted_choice(self, board: chess.Board) -> Optional[chess.Move]:
+        """Pick a book move by weight, like MemoryMappedReader.weighted_choice
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position to find a book move for
+
+        Returns
+        -------
+        chess.Move
+            The book move, or None if the position is not in the book
+        """
+
+        position = self._position(board)
+        if position is None or position.weighted == 0:
+            return None
+        index = random.randrange(position.weighted)
+        if random.random() >= position.probabilities[index]:
+            index = position.aliases[index]
+        move = self._move(board, position.order[index])
+        if move is None:
+            return self._search(self.reader.weighted_choice, board)
+        return move
+
+    def choice(self, board: chess.Board) -> Optional[chess.Move]:
+        """Pick a book move uniformly among the entries of minimum weight
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position to find a book move for
+
+        Returns
+        -------
+        chess.Move
+            The book move, or None if the position is not in the book
+        """
+
+        position = self._position(board)
+        if position is None or position.eligible == 0:
+            return None
+        move = self._move(board, position.order[random.randrange(position.eligible)])
+        if move is None:
+            return self._search(self.reader.choice, board, minimum_weight=self.minimum_weight)
+        return move
+
+    def best_move(self, board: chess.Board) -> Optional[chess.Move]:
+        """Get the book move with the highest weight
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position to find a book move for
+
+        Returns
+        -------
+        chess.Move
+            The book move, or None if the position is not in the book
+        """
+
+        position = self._position(board)
+        if position is None or position.eligible == 0:
+            return None
+        move = self._move(board, position.order[0])
+        if move is None:
+            return self._search(self.reader.find, board, minimum_weight=self.minimum_weight)
+        return move
+
+    def close(self):
+        self.reader.close()
+
+
+_books = {}
+_books_lock = threading.Lock()
+
+
+def open_book(path: str, minimum_weight: int = 1) -> PolyglotBook:
+    """Get the cached book for a file, opening it on first use
+
+    Parameters
+    ----------
+    path : str
+        The polyglot book file
+    minimum_weight : int
+        Entries below this weight are not picked by choice and best_move
+
+    Returns
+    -------
+    PolyglotBook
+        The book, shared by every caller in the process
+    """
+
+    with _books_lock:
+        book = _books.get((path, minimum_weight))
+        if book is None:
+            book = _books[(path, minimum_weight)] = PolyglotBook(path, minimum_weight)
+        return book
+
+
+def preload_books(book_config: dict):
+    """Open every book of a book configuration
+
+    Call before forking worker processes, so they share the mapped books
+    instead of each mapping their own.
+
+    Parameters
+    ----------
+    book_config : dict
+        The engine polyglot book configuration, with a book file for
+        standard chess and optionally one per variant
+    """
+
+    minimum_weight = book_config.get("min_weight", 1)
+    for name, path in book_config.items():
+        if name in ("selection", "min_weight") or not path:
+            continue
+        LOG.info("Loading book {}".format(path))
+        open_book(path, minimum_weight)
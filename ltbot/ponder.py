@@ -0,0 +1,223 @@
+"""Pondering
+
+Searching on the opponent's time for the move the engine expects them
+to play, one ponder search per game at a time.
+
+    * PonderManager - Runs and resolves the ponder searches of a game
+"""
+
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+import chess
+
+try:
+    from .metrics import REGISTRY
+except ImportError:
+    # Imported as a top-level module by lichess_bot
+    from metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+PONDER_TOTAL = REGISTRY.counter(
+    "ltbot_ponder_total", "Ponder searches by whether the opponent played the move", ("result",)
+)
+PONDER_SAVED_SECONDS = REGISTRY.histogram(
+    "ltbot_ponder_saved_seconds", "Search time gained on the opponent's clock by ponder hits"
+)
+
+
+class PonderManager:
+    """Runs and resolves the ponder searches of a game
+
+    The manager owns the ponder thread of a game and the result of its
+    search, so nothing outlives the game. A ponder search whose move was
+    not played is stopped without waiting for the thread, the next
+    search of the engine waits for it instead. Hits, misses and the
+    search time gained by hits are counted in the metrics of the game
+    process, which lichess_bot forwards to the process serving them.
+
+    ---
+
+    Attributes
+    ----------
+    hits : int
+        Ponder searches whose move the opponent played
+    misses : int
+        Ponder searches stopped because another move was played
+    saved_seconds : float
+        Search time gained on the opponent's clock
+
+    Methods
+    -------
+    start(board, best_move, ponder_move, wtime, btime, winc, binc)
+        Starts pondering on the expected reply to a move
+    resolve(move)
+        Handles the move the opponent played
+    cancel()
+        Stops pondering without waiting for the search to return
+    join(timeout=None)
+        Waits for the ponder search to return
+    close(timeout=None)
+        Stops pondering at the end of the game
+    """
+
+    def __init__(self, engine, game_id: str):
+        """
+        Parameters
+        ----------
+        engine : EngineWrapper
+            The engine of the game
+        game_id : str
+            Id of the game, names the ponder thread
+        """
+
+        self.engine = engine
+        self.game_id = game_id
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._thread = None
+        self._expected = None
+        self._started = None
+        self._result = None
+
+    @property
+    def pondering(self) -> bool:
+        """True while a ponder search waits for the opponent's move"""
+
+        return self._expected is not None
+
+    def start(
+        self,
+        board: chess.Board,
+        best_move: chess.Move,
+        ponder_move: chess.Move,
+        wtime: int,
+        btime: int,
+        winc: int,
+        binc: int,
+    ):
+        """Start pondering on the expected reply to a move
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position before the move
+        best_move : chess.Move
+            The move the bot plays
+        ponder_move : chess.Move
+            The reply the engine expects
+        wtime : int
+            White's clock in milliseconds
+        btime : int
+            Black's clock in milliseconds
+        winc : int
+            White's increment in milliseconds
+        binc : int
+            Black's increment in milliseconds
+        """
+
+        self.join()
+        ponder_board = board.copy()
+        ponder_board.push(best_move)
+        ponder_board.push(ponder_move)
+        self._expected = ponder_move.uci()
+        self._started = time.monotonic()
+        self._result = None
+        self._thread = threading.Thread(
+            target=self._search,
+            args=(ponder_board, wtime, btime, winc, binc),
+            name="ponder-{}".format(self.game_id),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _search(self, board: chess.Board, wtime: int, btime: int, winc: int, binc: int):
+        try:
+            self._result = self.engine.search_with_ponder(board, wtime, btime, winc, binc, True)
+        except Exception:
+            LOG.exception("Ponder search of game {} failed".format(self.game_id))
+
+    def resolve(self, move: str) -> Optional[Tuple[chess.Move, Optional[chess.Move]]]:
+        """Handle the move the opponent played
+
+        On a hit the ponder search continues as a normal search and its
+        result is returned once it finishes, on a miss the search is
+        stopped.
+
+        Parameters
+        ----------
+        move : str
+            The opponent's move in UCI notation
+
+        Returns
+        -------
+        Tuple[chess.Move, Optional[chess.Move]]
+            Best and ponder move of the ponder search on a hit, None on a
+            miss or if the bot was not pondering
+        """
+
+        if self._expected is None:
+            return None
+        if move != self._expected:
+            PONDER_TOTAL.inc("miss")
+            self.misses += 1
+            self.cancel()
+            return None
+
+        self._expected = None
+        saved = time.monotonic() - self._started
+        self.engine.engine.ponderhit()
+        self.join()
+        PONDER_TOTAL.inc("hit")
+        PONDER_SAVED_SECONDS.observe(value=saved)
+        self.hits += 1
+        self.saved_seconds += saved
+        result, self._result = self._result, None
+        return result
+
+    def cancel(self):
+        """Stop pondering without waiting for the search to return"""
+
+        if self._expected is None:
+            return
+        self._expected = None
+        self._result = None
+        self.engine.engine.stop()
+
+    def join(self, timeout: float = None):
+        """Wait for the ponder search to return
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait, None waits until it returns
+        """
+
+        if self._thread is None:
+            return
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._thread = None
+
+    def close(self, timeout: float = None):
+        """Stop pondering at the end of the game
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for the ponder search, None waits until it returns
+        """
+
+        self.cancel()
+        self.join(timeout)
+        self._result = None
+        if self.hits or self.misses:
+            LOG.info(
+                "Ponder hits {} of {}, {:.1f}s saved".format(
+                    self.hits, self.hits + self.misses, self.saved_seconds
+                )
+            )
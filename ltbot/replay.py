@@ -0,0 +1,281 @@
+"""Chat replay
+
+Replays recorded chat into a bot to benchmark how many messages per
+second it sustains. The bot is wired to the fake Lichess server and its
+chat messages are counted instead of sent, so a replay needs no network.
+
+Replay a log recorded with twitch.chat_log with
+
+    python -m ltbot.replay chat.jsonl.gz --max-speed --trace-allocations
+
+    * ReplayReport - Throughput, handler latency and allocations of a replay
+    * replay - Feeds chat events into a bot and measures it
+    * main - Command line interface for replaying a chat log
+"""
+
+import argparse as ap
+import copy
+import logging
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Iterable, Tuple
+
+from irc.client import Event
+
+from .chat_log import read_chat_log
+from .lichess_twitch_bot import BotState, LichessTwitchBot
+from .metrics import Histogram
+
+LOG = logging.getLogger(__name__)
+
+# Handler latency buckets in seconds, chat handlers take microseconds
+REPLAY_BUCKETS = (
+    1e-6,
+    2.5e-6,
+    5e-6,
+    1e-5,
+    2.5e-5,
+    5e-5,
+    1e-4,
+    2.5e-4,
+    5e-4,
+    1e-3,
+    2.5e-3,
+    5e-3,
+    1e-2,
+    1e-1,
+)
+
+# Handler of a routed command by bot state
+STATE_HANDLERS = {
+    BotState.IDLE: "idle_handle_message",
+    BotState.CHALLENGE_VOTE: "challenge_vote_handle_message",
+    BotState.WAIT_FOR_OPPONENT: "wait_for_opponent",
+    BotState.PLAY_MOVE: "move_vote_handle_message",
+}
+
+REPLAY_CONFIGURATION = {
+    "twitch": {
+        "username": "replay",
+        "owner": "replay",
+        "client_id": "replay",
+        "token": "replay",
+        "channel_id": "0",
+    },
+    "lichess": {
+        "token": "replay",
+        "url": None,
+        "initial_clock_limit": 600,
+        "initial_clock_increment": 0,
+    },
+    "challenge_vote_time": 10,
+    "challenge_response_time": 60,
+    "move_vote_time": 15,
+    "command": {
+        "challenge_parameters": "!parameters",
+        "challenge_vote": "!vote",
+        "challenge_start": "!challenge",
+        "clock_limit": "!clocklimit",
+        "clock_increment": "!clockincrement",
+        "move_vote": "!move",
+    },
+}
+
+
+class _CountingMessageQueue:
+    """Stands in for the Twitch message queue and only counts messages"""
+
+    def __init__(self):
+        self.messages = 0
+
+    def put(self, channel, message, priority=None, coalesce_key=None):
+        self.messages += 1
+
+
+class ReplayReport:
+    """Throughput, handler latency and allocations of a replay
+
+    ---
+
+    Attributes
+    ----------
+    messages : int
+        Number of replayed chat messages
+    seconds : float
+        Time spent handling the messages, without real time pauses
+    handler_seconds : Histogram
+        Latency of on_pubmsg and the actor handling the command, by handler
+    sent_messages : int
+        Chat messages the bot sent in reply
+    retained_blocks : int
+        Memory blocks still allocated after the replay
+    peak_bytes : int
+        Peak traced memory, or None without allocation tracing
+    top_allocations : List[str]
+        Source lines that retained the most blocks, with allocation tracing
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.seconds = 0.0
+        self.handler_seconds = Histogram(
+            "ltbot_replay_handler_seconds",
+            "Latency of replayed messages",
+            ("handler",),
+            REPLAY_BUCKETS,
+        )
+        self.sent_messages = 0
+        self.retained_blocks = 0
+        self.peak_bytes = None
+        self.top_allocations = []
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    def format(self) -> str:
+        """Format the report for the terminal"""
+
+        lines = [
+            "Replayed {} messages in {:.3f}s, {:.0f} messages/s".format(
+                self.messages, self.seconds, self.messages_per_second
+            ),
+            "Bot sent {} chat messages".format(self.sent_messages),
+        ]
+        for handler in sorted(set(STATE_HANDLERS.values()) | {"not_a_command"}):
+            count = self.handler_seconds.count(handler)
+            if count:
+                lines.append(
+                    "  {:<32} {:>8} messages  p50 <= {:.1f}us  p99 <= {:.1f}us".format(
+                        handler,
+                        count,
+                        self.handler_seconds.quantile(0.5, handler) * 1e6,
+                        self.handler_seconds.quantile(0.99, handler) * 1e6,
+                    )
+                )
+        lines.append("Retained {} memory blocks".format(self.retained_blocks))
+        if self.peak_bytes is not None:
+            lines.append("Peak traced memory {:.1f} KiB".format(self.peak_bytes / 1024))
+            lines.extend("  {}".format(allocation) for allocation in self.top_allocations)
+        return "\n".join(lines)
+
+
+def replay(
+    bot: LichessTwitchBot,
+    events: Iterable[Tuple[float, Event]],
+    speed: float = None,
+    trace_allocations: bool = False,
+) -> ReplayReport:
+    """Feed chat events into a bot and measure it
+
+    Each message goes through on_pubmsg and is then handled by the bot
+    actor on the calling thread, so the latency covers the whole command.
+    The actor thread of the bot must not be running.
+
+    Parameters
+    ----------
+    bot : LichessTwitchBot
+        The bot to replay into
+    events : Iterable[Tuple[float, Event]]
+        Receive time and event of every message, see read_chat_log
+    speed : float
+        Replay speed relative to the recording, 1.0 is real time and None
+        replays as fast as possible
+    trace_allocations : bool
+        Trace allocations with tracemalloc, slows the replay down
+
+    Returns
+    -------
+    ReplayReport
+        Throughput, handler latency and allocations of the replay
+    """
+
+    report = ReplayReport()
+    message_queue = _CountingMessageQueue()
+    bot.message_queue = message_queue
+
+    if trace_allocations:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    blocks = sys.getallocatedblocks()
+
+    first = None
+    for timestamp, event in events:
+        if speed:
+            if first is None:
+                first = (timestamp, time.perf_counter())
+            delay = first[1] + (timestamp - first[0]) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+                # Let vote timers that ran out during the pause fire
+                bot.actor.drain()
+
+        if bot.command_router.route(event.arguments[0]) is None:
+            handler = "not_a_command"
+        else:
+            handler = STATE_HANDLERS[bot.bot_state]
+        start = time.perf_counter()
+        bot.on_pubmsg(None, event)
+        bot.actor.drain()
+        seconds = time.perf_counter() - start
+        report.handler_seconds.observe(handler, value=seconds)
+        report.seconds += seconds
+        report.messages += 1
+
+    report.retained_blocks = sys.getallocatedblocks() - blocks
+    if trace_allocations:
+        after = tracemalloc.take_snapshot()
+        report.peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        statistics = after.compare_to(before, "lineno")
+        statistics.sort(key=lambda statistic: statistic.count_diff, reverse=True)
+        report.top_allocations = [str(statistic) for statistic in statistics[:5]]
+    report.sent_messages = message_queue.messages
+    return report
+
+
+def main():
+    parser = ap.ArgumentParser(description="Replays a recorded chat log into a bot")
+    parser.add_argument("chat_log", type=Path, help="chat log written by ChatRecorder")
+    parser.add_argument(
+        "-c", "--configuration", type=Path, help="bot configuration, Lichess is always faked"
+    )
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1.0 is real time")
+    parser.add_argument("--max-speed", action="store_true", help="replay as fast as possible")
+    parser.add_argument("--trace-allocations", action="store_true", help="trace allocations")
+    args = parser.parse_args()
+
+    # Imported here, the fake server is only needed for replays
+    from .fake_lichess import FakeLichess, start_fake_lichess
+    from .util import load_configuration
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.configuration is not None:
+        configuration = load_configuration(args.configuration)
+    else:
+        configuration = copy.deepcopy(REPLAY_CONFIGURATION)
+    server = start_fake_lichess(FakeLichess())
+    configuration["lichess"]["url"] = "http://{}:{}/".format(*server.server_address[:2])
+    configuration["twitch"].setdefault("channel_id", "0")
+
+    bot = LichessTwitchBot(configuration=configuration, version="replay")
+    bot.lichess_events.start()
+    events = list(read_chat_log(args.chat_log))
+    try:
+        report = replay(
+            bot,
+            events,
+            speed=None if args.max_speed else args.speed,
+            trace_allocations=args.trace_allocations,
+        )
+    finally:
+        bot.lichess_events.stop()
+        server.shutdown()
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
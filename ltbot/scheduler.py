@@ -0,0 +1,354 @@
+"""Lichess request scheduler
+
+Spaces out Lichess API requests so that the account stays within the
+rate limits, and lets move submissions jump ahead of less urgent calls.
+
+    * Priority - Priority classes of Lichess requests
+    * TokenBucket - Token bucket rate limiter
+    * SharedBudget - Global token bucket and cooldown shared by processes
+    * use_shared_budget - Makes the schedulers of a process share a budget
+    * RequestScheduler - Schedules requests per endpoint and priority
+    * retry_after_seconds - Reads the cooldown of a rate limited response
+"""
+
+import enum
+import heapq
+import itertools
+import multiprocessing
+import threading
+import time
+
+# Lichess asks clients to wait a full minute after a 429 response
+DEFAULT_COOLDOWN = 60.0
+
+
+class Priority(enum.IntEnum):
+    MOVE = 0
+    GAME = 1
+    CHALLENGE = 2
+    CHAT = 3
+    BULK = 4
+
+
+# Requests per second and burst size for each endpoint in ENDPOINTS
+DEFAULT_LIMITS = {
+    "move": (10.0, 20),
+    "abort": (2.0, 5),
+    "resign": (2.0, 5),
+    "game": (2.0, 5),
+    "chat": (1.0, 3),
+    "challenge": (0.5, 3),
+    "accept": (1.0, 5),
+    "decline": (1.0, 5),
+    "profile": (0.5, 2),
+    "playing": (0.5, 2),
+    "upgrade": (0.1, 1),
+}
+
+# Fallback limit for endpoints missing from the limits table
+DEFAULT_LIMIT = (2.0, 5)
+
+# Limit over all endpoints, the reserve is only available to moves
+GLOBAL_LIMIT = (8.0, 20)
+MOVE_RESERVE = 5
+
+
+def retry_after_seconds(headers, default: float = DEFAULT_COOLDOWN) -> float:
+    """Read the Retry-After header of a rate limited response
+
+    Parameters
+    ----------
+    headers : Mapping[str, str]
+        Headers of the response
+    default : float
+        Cooldown used when the header is missing or not a number
+
+    Returns
+    -------
+    float
+        Seconds to wait before the next request
+    """
+
+    try:
+        return max(0.0, float(headers["Retry-After"]))
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """Token bucket rate limiter
+
+    Not thread safe, the scheduler guards its buckets with its own lock.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Parameters
+        ----------
+        rate : float
+            Tokens added per second
+        capacity : int
+            Maximum number of tokens
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float, needed: float = 1.0) -> float:
+        """Seconds until the bucket holds the needed number of tokens"""
+
+        self.refill(now)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, count: float = 1.0):
+        self.tokens -= count
+
+
+class SharedBudget:
+    """Global token bucket and cooldown in shared memory
+
+    Schedulers in several processes that use the same budget stay within
+    the limit of the account together, and a 429 response seen by one of
+    them pauses all of them. time.monotonic() is system wide, so the
+    processes agree on refill and cooldown times.
+
+    Only passed to other processes by inheritance, e.g. as an argument
+    of the process or the initializer of a process pool.
+
+    ---
+
+    Attributes
+    ----------
+    rate : float
+        Tokens added per second
+    capacity : int
+        Maximum number of tokens
+
+    Methods
+    -------
+    wait_time(now, needed=1.0)
+        Seconds until the bucket holds the needed number of tokens
+    take(count=1.0)
+        Takes tokens
+    cooldown(until)
+        Pauses every process until the given time
+    cooldown_until()
+        Returns the end of the cooldown
+    """
+
+    def __init__(self, global_limit: tuple = GLOBAL_LIMIT):
+        """
+        Parameters
+        ----------
+        global_limit : tuple
+            Requests per second and burst size over all processes
+        """
+
+        self.rate, self.capacity = global_limit
+        # Tokens, time of the last refill and end of the cooldown
+        self._state = multiprocessing.RawArray("d", [float(self.capacity), time.monotonic(), 0.0])
+        self._lock = multiprocessing.Lock()
+
+    def wait_time(self, now: float, needed: float = 1.0) -> float:
+        """Seconds until the bucket holds the needed number of tokens"""
+
+        with self._lock:
+            # Another process may have refilled after now was read
+            elapsed = max(0.0, now - self._state[1])
+            tokens = min(self.capacity, self._state[0] + elapsed * self.rate)
+            self._state[0] = tokens
+            self._state[1] = max(self._state[1], now)
+        if tokens >= needed:
+            return 0.0
+        return (needed - tokens) / self.rate
+
+    def take(self, count: float = 1.0):
+        # Processes that saw the same free token both take it, the bucket
+        # goes below zero and the next requests wait for the difference
+        with self._lock:
+            self._state[0] -= count
+
+    def cooldown(self, until: float):
+        with self._lock:
+            self._state[2] = max(self._state[2], until)
+
+    def cooldown_until(self) -> float:
+        return self._state[2]
+
+
+# Budget of the schedulers created in this process, set by use_shared_budget
+_shared_budget = None
+
+
+def use_shared_budget(budget: SharedBudget):
+    """Make the schedulers created in this process share a budget
+
+    Parameters
+    ----------
+    budget : SharedBudget
+        The budget, inherited from the process that created it
+    """
+
+    global _shared_budget
+    _shared_budget = budget
+
+
+class RequestScheduler:
+    """Schedules Lichess requests by endpoint budget and priority
+
+    Every endpoint has its own token bucket and all requests share a
+    global bucket. A part of the global bucket is reserved for moves so
+    they never wait behind bulk calls when the budget is tight. Waiting
+    requests are served strictly by priority class and in arrival order
+    within a class. A 429 response puts every endpoint in a cooldown.
+
+    With a shared budget the global bucket and the cooldown are shared
+    with the schedulers of other processes, the endpoint buckets are
+    kept by each scheduler.
+
+    ---
+
+    Methods
+    -------
+    acquire(endpoint, priority)
+        Blocks until a request to the endpoint may be sent
+    reserve(endpoint, priority)
+        Takes a request slot if one is free without blocking
+    cooldown(seconds)
+        Pauses all requests for the given time
+    """
+
+    def __init__(
+        self,
+        limits: dict = None,
+        global_limit: tuple = GLOBAL_LIMIT,
+        move_reserve: int = MOVE_RESERVE,
+        shared: SharedBudget = None,
+    ):
+        """
+        Parameters
+        ----------
+        limits : dict
+            Requests per second and burst size per endpoint name
+        global_limit : tuple
+            Requests per second and burst size over all endpoints, not
+            used with a shared budget
+        move_reserve : int
+            Global tokens only available to moves
+        shared : SharedBudget
+            Global bucket and cooldown shared with other processes, the
+            budget set by use_shared_budget if not given
+        """
+
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.move_reserve = move_reserve
+        self.shared = shared if shared is not None else _shared_budget
+        self._global = self.shared if self.shared is not None else TokenBucket(*global_limit)
+        self._buckets = {}
+        self._cooldown_until = 0.0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, endpoint: str, priority: Priority = Priority.BULK):
+        """Block until a request to the endpoint may be sent
+
+        Parameters
+        ----------
+        endpoint : str
+            Endpoint name from ENDPOINTS
+        priority : Priority
+            Priority class of the request
+        """
+
+        ticket = (priority, next(self._counter))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    wait = self._wait_time(endpoint, priority, time.monotonic())
+                    if self._waiting[0] == ticket and wait == 0.0:
+                        self._take(endpoint)
+                        return
+                    self._condition.wait(wait if wait > 0.0 else None)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def reserve(self, endpoint: str, priority: Priority = Priority.BULK) -> float:
+        """Take a request slot without blocking
+
+        Used by callers that wait on their own, like the asyncio client.
+        Blocked callers of acquire with a higher priority go first.
+
+        Parameters
+        ----------
+        endpoint : str
+            Endpoint name from ENDPOINTS
+        priority : Priority
+            Priority class of the request
+
+        Returns
+        -------
+        float
+            0 if the slot was taken, otherwise seconds to wait before
+            trying again
+        """
+
+        with self._condition:
+            wait = self._wait_time(endpoint, priority, time.monotonic())
+            if wait == 0.0 and self._waiting and self._waiting[0][0] <= priority:
+                wait = 0.05
+            if wait == 0.0:
+                self._take(endpoint)
+            return wait
+
+    def cooldown(self, seconds: float = DEFAULT_COOLDOWN):
+        """Pause all requests
+
+        Parameters
+        ----------
+        seconds : float
+            Length of the pause, usually taken from Retry-After
+        """
+
+        with self._condition:
+            until = time.monotonic() + seconds
+            if self.shared is not None:
+                self.shared.cooldown(until)
+            self._cooldown_until = max(self._cooldown_until, until)
+            self._condition.notify_all()
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            bucket = TokenBucket(*self.limits.get(endpoint, DEFAULT_LIMIT))
+            self._buckets[endpoint] = bucket
+        return bucket
+
+    def _wait_time(self, endpoint: str, priority: Priority, now: float) -> float:
+        needed = 1.0 if priority == Priority.MOVE else 1.0 + self.move_reserve
+        cooldown_until = self._cooldown_until
+        if self.shared is not None:
+            cooldown_until = max(cooldown_until, self.shared.cooldown_until())
+        return max(
+            cooldown_until - now,
+            self._global.wait_time(now, needed),
+            self._bucket(endpoint).wait_time(now),
+            0.0,
+        )
+
+    def _take(self, endpoint: str):
+        self._global.take()
+        self._bucket(endpoint).take()
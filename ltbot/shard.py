@@ -0,0 +1,373 @@
+"""Multi channel hosting
+
+Runs the bot in many Twitch channels, each with its own Lichess account.
+The channels are split over shard processes that are restarted by a
+supervisor when they fail.
+
+    * channel_configurations - Builds the configuration of every channel
+    * shard_channels - Splits channel configurations over shards
+    * ShardBot - One IRC connection serving several channels
+    * run_shard - Runs a shard, the target of the shard processes
+    * ShardSupervisor - Starts the shard processes and restarts failed ones
+"""
+
+import logging
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+from typing import List
+
+from irc.bot import SingleServerIRCBot
+from irc.client import ServerConnection, Event
+
+from .lichess import new_session
+from .lichess_twitch_bot import ChannelBot
+from .metrics import start_metrics_server
+from .twitch import MessagePriority, MessageQueue
+
+LOG = logging.getLogger(__name__)
+
+# Pooled Lichess connections per channel, for the event, game and request traffic
+LICHESS_CONNECTIONS_PER_CHANNEL = 4
+
+# Exit code of a shard without any channel that can play, it is not restarted
+EXIT_NO_CHANNELS = 3
+
+# A shard that ran this many seconds before failing is restarted without delay
+STABLE_UPTIME = 300.0
+
+
+def merge_configuration(base: dict, override: dict) -> dict:
+    """Merge an override into a configuration, nested sections key by key"""
+
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_configuration(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def channel_configurations(configuration: dict) -> List[dict]:
+    """Build the configuration of every channel
+
+    Every entry of configuration["channels"] is merged over the rest of
+    the configuration, so an entry only needs the channel owner and the
+    Lichess token.
+
+    Parameters
+    ----------
+    configuration : dict
+        Bot configuration with a channels list
+
+    Returns
+    -------
+    List[dict]
+        One complete configuration per channel
+    """
+
+    base = {key: value for key, value in configuration.items() if key not in ("channels", "shards")}
+    return [merge_configuration(base, channel) for channel in configuration["channels"]]
+
+
+def shard_channels(configurations: List[dict], shards: int) -> List[List[dict]]:
+    """Split channel configurations over shards, in turn
+
+    Parameters
+    ----------
+    configurations : List[dict]
+        Configuration of every channel
+    shards : int
+        Number of shards
+
+    Returns
+    -------
+    List[List[dict]]
+        Channel configurations of every shard that has channels
+    """
+
+    split = [configurations[index::shards] for index in range(shards)]
+    return [channels for channels in split if channels]
+
+
+class ShardBot(SingleServerIRCBot):
+    """A Twitch bot that plays chess on Lichess in several channels
+
+    All channels of the shard share one IRC connection, one rate limited
+    message queue and one pooled Lichess session. The channels must use
+    the same Twitch bot account.
+
+    ---
+
+    Attributes
+    ----------
+    channel_bots : dict
+        ChannelBot by IRC channel name
+
+    Methods
+    -------
+    on_welcome(connection: ServerConnection, event: Event)
+        Callback for when the bot connects to Twitch, joins every channel
+    on_pubmsg(connection: ServerConnection, event: Event)
+        Callback for chat messages, handled by the bot of the channel
+    start()
+        Starts the bot
+    stop()
+        Stops the bot
+    """
+
+    def __init__(self, configurations: List[dict], version: str, upgrade_lichess: bool = False):
+        """
+        Parameters
+        ----------
+        configurations : List[dict]
+            Configuration of every channel of the shard
+        version : str
+            String representation of bot version
+        upgrade_lichess : bool
+            Upgrade Lichess accounts that are not bot accounts yet
+        """
+
+        # Twitch rate limits the account, not the channel
+        self.message_queue = MessageQueue(
+            lambda channel, message: self.connection.privmsg(channel, message),
+            configurations[0]["twitch"].get("rate_limit_tier", "user"),
+        )
+        session = new_session(pool_maxsize=LICHESS_CONNECTIONS_PER_CHANNEL * len(configurations))
+
+        self.channel_bots = {}
+        for configuration in configurations:
+            channel = ChannelBot(configuration, version, self.message_queue, session)
+            user_profile = channel.lichess_bot.get_profile()
+            lichess_is_bot = user_profile.get("title") == "BOT"
+            if not lichess_is_bot and upgrade_lichess:
+                lichess_is_bot = channel.upgrade_lichess_account()
+            if lichess_is_bot:
+                self.channel_bots[channel.CHANNEL] = channel
+            else:
+                LOG.error(
+                    "Skipping channel {} because {} is not a Lichess bot account".format(
+                        channel.CHANNEL[1:], user_profile["username"]
+                    )
+                )
+
+        twitch_configuration = configurations[0]["twitch"]
+        username = twitch_configuration["username"].lower()
+        super().__init__(
+            [("irc.chat.twitch.tv", 6667, "oauth:{}".format(twitch_configuration["token"]))],
+            username,
+            username,
+        )
+
+    def on_welcome(self, connection: ServerConnection, event: Event):
+        """Callback for when connection has been established
+
+        Joins the chat of every channel and sends a message to confirm
+        the connection.
+
+        Parameters
+        ----------
+        connection : ServerConnection
+            Connection to Twitch server
+        event : Event
+            Event object for connection
+        """
+
+        for req in ("membership", "tags", "commands"):
+            connection.cap("REQ", f":twitch.tv/{req}")
+
+        for channel in self.channel_bots.values():
+            connection.join(channel.CHANNEL)
+            channel.send_message("Connected", MessagePriority.HIGH)
+        LOG.info("Joined {} twitch channels.".format(len(self.channel_bots)))
+
+    def on_pubmsg(self, connection: ServerConnection, event: Event):
+        """Callback for when message is received
+
+        Parameters
+        ----------
+        connection : ServerConnection
+            Connection to Twitch server
+        event : Event
+            Event object for connection
+        """
+
+        channel = self.channel_bots.get(event.target.lower())
+        if channel is not None:
+            channel.on_pubmsg(connection, event)
+
+    def start(self):
+        """Start bot"""
+
+        LOG.debug("Starting shard with {} channels".format(len(self.channel_bots)))
+        for channel in self.channel_bots.values():
+            channel.start()
+        self.message_queue.start()
+        super().start()
+
+    def stop(self):
+        """Stop bot"""
+
+        LOG.debug("Stopping shard")
+        for channel in self.channel_bots.values():
+            channel.stop()
+        self.message_queue.stop()
+        self.die()
+
+
+def run_shard(configurations: List[dict], version: str, index: int, upgrade_lichess: bool):
+    """Run a shard until it is stopped
+
+    Parameters
+    ----------
+    configurations : List[dict]
+        Configuration of every channel of the shard
+    version : str
+        String representation of bot version
+    index : int
+        Index of the shard, offsets the metrics port
+    upgrade_lichess : bool
+        Upgrade Lichess accounts that are not bot accounts yet
+    """
+
+    # The supervisor stops the shards, ignore the terminal's interrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    metrics_configuration = configurations[0].get("metrics", {})
+    if metrics_configuration.get("enabled", False):
+        start_metrics_server(
+            port=metrics_configuration.get("port", 9108) + index,
+            host=metrics_configuration.get("host", "127.0.0.1"),
+        )
+
+    bot = ShardBot(configurations, version, upgrade_lichess)
+    if not bot.channel_bots:
+        sys.exit(EXIT_NO_CHANNELS)
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot.stop())
+    bot.start()
+
+
+class ShardSupervisor:
+    """Starts the shard processes and restarts failed ones
+
+    A failed shard is restarted after a delay that doubles with every
+    failure in a row, so a shard that fails on start does not spin.
+
+    ---
+
+    Methods
+    -------
+    run()
+        Starts the shards and supervises them until stopped
+    stop()
+        Stops the shards
+    """
+
+    def __init__(
+        self,
+        configuration: dict,
+        version: str,
+        upgrade_lichess: bool = False,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 60.0,
+    ):
+        """
+        Parameters
+        ----------
+        configuration : dict
+            Bot configuration with a channels list and optionally the
+            number of shards
+        version : str
+            String representation of bot version
+        upgrade_lichess : bool
+            Upgrade Lichess accounts that are not bot accounts yet
+        restart_delay : float
+            Seconds before the first restart of a failed shard
+        max_restart_delay : float
+            Longest delay between restarts
+        """
+
+        self.version = version
+        self.upgrade_lichess = upgrade_lichess
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.shards = shard_channels(
+            channel_configurations(configuration), configuration.get("shards", 1)
+        )
+        # Forked shards inherit the logging setup of the supervisor
+        self._context = multiprocessing.get_context("fork")
+        self._processes = [None] * len(self.shards)
+        self._started = [0.0] * len(self.shards)
+        self._failures = [0] * len(self.shards)
+        self._restart_at = {}
+        self._stopped = threading.Event()
+
+    def _start_shard(self, index: int):
+        process = self._context.Process(
+            target=run_shard,
+            args=(self.shards[index], self.version, index, self.upgrade_lichess),
+            name="ltbot-shard-{}".format(index),
+        )
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.monotonic()
+        LOG.info("Started shard {} with {} channels".format(index, len(self.shards[index])))
+
+    def _check_shard(self, index: int, now: float):
+        process = self._processes[index]
+        if index in self._restart_at:
+            if now >= self._restart_at[index]:
+                del self._restart_at[index]
+                self._start_shard(index)
+            return
+        if process is None or process.is_alive():
+            return
+        if process.exitcode == EXIT_NO_CHANNELS:
+            LOG.error("Shard {} has no channels that can play, not restarting".format(index))
+            self._processes[index] = None
+            return
+        if now - self._started[index] >= STABLE_UPTIME:
+            self._failures[index] = 0
+        delay = min(self.max_restart_delay, self.restart_delay * 2 ** self._failures[index])
+        self._failures[index] += 1
+        LOG.warning(
+            "Shard {} exited with code {}, restarting in {:.0f}s".format(
+                index, process.exitcode, delay
+            )
+        )
+        self._restart_at[index] = now + delay
+
+    def run(self, check_interval: float = 0.5):
+        """Start the shards and supervise them until stopped
+
+        Parameters
+        ----------
+        check_interval : float
+            Seconds between checks of the shard processes
+        """
+
+        for index in range(len(self.shards)):
+            self._start_shard(index)
+        while not self._stopped.wait(check_interval):
+            now = time.monotonic()
+            for index in range(len(self.shards)):
+                self._check_shard(index, now)
+
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(10)
+                if process.is_alive():
+                    LOG.warning("Shard {} did not stop, killing it".format(process.name))
+                    process.kill()
+
+    def stop(self):
+        """Stop the shards, run returns once they have exited"""
+
+        LOG.debug("Stopping shards")
+        self._stopped.set()
@@ -0,0 +1,249 @@
+"""Lichess stream events
+
+Decodes the NDJSON lines of the Lichess event and game streams into
+compact typed events, and tracks the move list of a game incrementally.
+
+    * decode_line - Decodes one stream line into a typed event
+    * MoveTracker - Finds the moves appended since the last game state
+
+The typed events support item access with the Lichess field names, so
+code written against the decoded dictionaries keeps working.
+"""
+
+import json
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+class StreamEvent:
+    """Base class of the typed stream events"""
+
+    __slots__ = ()
+    type = None
+
+    def __getitem__(self, key):
+        if key == "type":
+            return self.type
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key == "type" or getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __repr__(self):
+        fields = ", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for cls in type(self).__mro__
+            for name in getattr(cls, "__slots__", ())
+        )
+        return "{}({})".format(type(self).__name__, fields)
+
+
+class Ping(StreamEvent):
+    """Keep-alive line of a stream"""
+
+    __slots__ = ()
+    type = "ping"
+
+
+class GameState(StreamEvent):
+    """Clock and move update of a game"""
+
+    __slots__ = ("moves", "wtime", "btime", "winc", "binc", "status", "winner")
+    type = "gameState"
+
+    def __init__(self, data: dict):
+        self.moves = data.get("moves", "")
+        self.wtime = data.get("wtime")
+        self.btime = data.get("btime")
+        self.winc = data.get("winc")
+        self.binc = data.get("binc")
+        self.status = data.get("status")
+        self.winner = data.get("winner")
+
+
+class GameFull(StreamEvent):
+    """First line of a game stream with the full game information
+
+    The decoded dictionary is kept in raw since it is needed for setting
+    up the game and only arrives once per stream.
+    """
+
+    __slots__ = ("id", "variant", "clock", "speed", "white", "black", "initialFen", "state", "raw")
+    type = "gameFull"
+
+    def __init__(self, data: dict):
+        self.id = data["id"]
+        self.variant = data.get("variant")
+        self.clock = data.get("clock")
+        self.speed = data.get("speed")
+        self.white = data.get("white")
+        self.black = data.get("black")
+        self.initialFen = data.get("initialFen")
+        self.state = GameState(data.get("state", {}))
+        self.raw = data
+
+
+class ChatLine(StreamEvent):
+    """Chat message in a game"""
+
+    __slots__ = ("username", "text", "room")
+    type = "chatLine"
+
+    def __init__(self, data: dict):
+        self.username = data["username"]
+        self.text = data["text"]
+        self.room = data["room"]
+
+
+class ChallengeEvent(StreamEvent):
+    """Challenge created, canceled or declined"""
+
+    __slots__ = ("type", "challenge")
+
+    def __init__(self, data: dict):
+        self.type = data["type"]
+        self.challenge = data["challenge"]
+
+
+class GameEvent(StreamEvent):
+    """Game started or finished"""
+
+    __slots__ = ("type", "game")
+
+    def __init__(self, data: dict):
+        self.type = data["type"]
+        self.game = data["game"]
+
+
+class UnknownEvent(StreamEvent):
+    """Event of a type without a dedicated class"""
+
+    __slots__ = ("type", "data")
+
+    def __init__(self, data: dict):
+        self.type = data.get("type")
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+PING = Ping()
+
+EVENT_TYPES = {
+    "gameFull": GameFull,
+    "gameState": GameState,
+    "chatLine": ChatLine,
+    "challenge": ChallengeEvent,
+    "challengeCanceled": ChallengeEvent,
+    "challengeDeclined": ChallengeEvent,
+    "gameStart": GameEvent,
+    "gameFinish": GameEvent,
+}
+
+
+def decode_line(line: bytes) -> StreamEvent:
+    """Decode one line of a Lichess stream
+
+    Parameters
+    ----------
+    line : bytes
+        Raw line from the stream, empty lines are keep-alives
+
+    Returns
+    -------
+    StreamEvent
+        Typed event for the line
+    """
+
+    if not line:
+        return PING
+    data = _loads(line)
+    return EVENT_TYPES.get(data.get("type"), UnknownEvent)(data)
+
+
+class MoveTracker:
+    """Incremental parser of the space separated move list of a game
+
+    Lichess resends the whole move list with every game state. The
+    tracker remembers how much of the list it has seen and only splits
+    the part appended since then.
+
+    ---
+
+    Attributes
+    ----------
+    moves : List[str]
+        All moves seen so far in UCI notation
+    reset : bool
+        True if the last update did not extend the previous move list
+    """
+
+    __slots__ = ("moves", "reset", "_length")
+
+    def __init__(self, moves: str = ""):
+        """
+        Parameters
+        ----------
+        moves : str
+            Initial move list of the game
+        """
+
+        self.moves = moves.split()
+        self.reset = False
+        self._length = len(moves)
+
+    def update(self, moves: str):
+        """Update the tracker with the move list of a new game state
+
+        Parameters
+        ----------
+        moves : str
+            Full move list from the game state
+
+        Returns
+        -------
+        List[str]
+            Moves appended since the previous update, or every move if
+            the list was not an extension of the previous one
+        """
+
+        length = self._length
+        last = self.moves[-1] if self.moves else ""
+        # Only the last known move and the following separator are compared
+        extends = (
+            len(moves) >= length
+            and moves.startswith(last, length - len(last))
+            and (length == 0 or len(moves) == length or moves[length] == " ")
+        )
+        if extends:
+            new_moves = moves[length:].split()
+            self.moves.extend(new_moves)
+            self.reset = False
+        else:
+            new_moves = moves.split()
+            self.moves = list(new_moves)
+            self.reset = True
+        self._length = len(moves)
+        return new_moves
+
+    def __len__(self):
+        return len(self.moves)
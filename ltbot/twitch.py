@@ -0,0 +1,222 @@
+"""Twitch helpers
+
+Lookups against the Twitch API that are cached on disk between restarts,
+and rate limited sending of chat messages.
+
+    * get_channel_id - Looks up the channel id of a Twitch user
+    * MessagePriority - Priority classes of outgoing chat messages
+    * MessageQueue - Rate limited queue of outgoing chat messages
+"""
+
+import enum
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from requests import get
+
+from .scheduler import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+USERS_URL = "https://api.twitch.tv/kraken/users?login={}"
+
+# Default file for caching looked up channel ids between restarts
+CHANNEL_ID_CACHE_FILE = "ltbot_channel_ids.json"
+
+# Messages per 30 seconds allowed by Twitch for each kind of bot account
+RATE_LIMITS = {
+    "user": 20,
+    "moderator": 100,
+    "verified": 7500,
+}
+RATE_LIMIT_PERIOD = 30.0
+
+_cache_lock = threading.Lock()
+
+
+def _read_cache(cache_path: Path) -> dict:
+    try:
+        with open(cache_path, "r") as cache_stream:
+            return json.load(cache_stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_channel_id(username: str, client_id: str, cache_file: Path = CHANNEL_ID_CACHE_FILE) -> str:
+    """Get the channel id of a Twitch user
+
+    Looks in the on-disk cache first and only asks the Twitch API when
+    the username is missing from it.
+
+    Parameters
+    ----------
+    username : str
+        Twitch username to look up
+    client_id : str
+        Twitch client id used for the API request
+    cache_file : Path
+        Json file with cached channel ids keyed by username, None
+        disables the cache
+
+    Returns
+    -------
+    str
+        The channel id
+    """
+
+    username = username.lower()
+    cache_path = Path(cache_file) if cache_file else None
+
+    if cache_path is not None:
+        channel_id = _read_cache(cache_path).get(username)
+        if channel_id is not None:
+            LOG.debug("Using cached channel id for {}".format(username))
+            return channel_id
+
+    headers = {
+        "Client-ID": client_id,
+        "Accept": "application/vnd.twitchtv.v5+json",
+    }
+    resp = get(USERS_URL.format(username), headers=headers, timeout=10).json()
+    channel_id = resp["users"][0]["_id"]
+    LOG.debug("Looked up channel id for {}".format(username))
+
+    if cache_path is not None:
+        with _cache_lock:
+            cache = _read_cache(cache_path)
+            cache[username] = channel_id
+            try:
+                with open(cache_path, "w") as cache_stream:
+                    json.dump(cache, cache_stream)
+            except OSError:
+                LOG.exception("Failed to write channel id cache")
+
+    return channel_id
+
+
+class MessagePriority(enum.IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class MessageQueue:
+    """Rate limited queue of outgoing chat messages
+
+    Messages are sent from a dedicated thread in priority order, never
+    faster than the Twitch limit for the account tier, so callers never
+    block. Messages with the same coalesce key replace each other while
+    they wait, so a burst of acknowledgements becomes a single message
+    with the latest content.
+
+    ---
+
+    Methods
+    -------
+    put(channel, message, priority=MessagePriority.NORMAL, coalesce_key=None)
+        Queues a message for sending
+    start()
+        Starts the sender thread
+    stop()
+        Stops the sender thread
+    """
+
+    def __init__(self, send, tier: str = "user"):
+        """
+        Parameters
+        ----------
+        send : Callable[[str, str], None]
+            Sends a message to a channel, called from the sender thread
+        tier : str
+            Rate limit tier of the account, one of RATE_LIMITS
+        """
+
+        self.send = send
+        limit = RATE_LIMITS[tier]
+        # A burst plus the refill over one period must stay within the limit
+        burst = max(1, limit // 4)
+        self._bucket = TokenBucket((limit - burst) / RATE_LIMIT_PERIOD, burst)
+        self._waiting = []
+        self._coalesced = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._waiting)
+
+    def put(
+        self,
+        channel: str,
+        message: str,
+        priority: MessagePriority = MessagePriority.NORMAL,
+        coalesce_key: str = None,
+    ):
+        """Queue a message for sending
+
+        Parameters
+        ----------
+        channel : str
+            Channel to send the message to
+        message : str
+            The message to send
+        priority : MessagePriority
+            Messages with higher priority are sent first
+        coalesce_key : str
+            Waiting messages to the same channel with the same key are
+            replaced by this one
+        """
+
+        with self._condition:
+            if coalesce_key is not None:
+                entry = self._coalesced.get((channel, coalesce_key))
+                if entry is not None:
+                    entry[3] = message
+                    return
+            entry = [priority, next(self._counter), channel, message, coalesce_key]
+            if coalesce_key is not None:
+                self._coalesced[(channel, coalesce_key)] = entry
+            heapq.heappush(self._waiting, entry)
+            self._condition.notify()
+
+    def start(self):
+        """Start the sender thread"""
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="twitch-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sender thread, waiting messages are dropped"""
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    wait = self._bucket.wait_time(time.monotonic())
+                    if self._waiting and wait == 0.0:
+                        break
+                    self._condition.wait(wait if self._waiting else None)
+                if self._stopped:
+                    return
+                _, _, channel, message, coalesce_key = heapq.heappop(self._waiting)
+                if coalesce_key is not None:
+                    del self._coalesced[(channel, coalesce_key)]
+                self._bucket.take()
+            try:
+                self.send(channel, message)
+            except Exception:
+                LOG.exception("Failed to send message to {}".format(channel))
@@ -0,0 +1,141 @@
+"""Vote tally
+
+Incremental counting of chat votes.
+
+    * VoteTally - Vote counts with constant time leader tracking
+"""
+
+from typing import Hashable, List, Optional, Tuple
+
+
+class VoteTally:
+    """Vote counts that are updated as votes are cast
+
+    Every voter has at most one vote, casting a new vote moves it. The
+    options are kept in buckets by vote count so that the leader is found
+    in constant time and the top options by walking the buckets from the
+    highest count. Within a count the option that reached it first leads.
+
+    ---
+
+    Methods
+    -------
+    vote(voter, option)
+        Casts or changes the vote of a voter
+    retract(voter)
+        Removes the vote of a voter
+    leader()
+        Returns the leading option and its count
+    top(n)
+        Returns the n leading options and their counts
+    standings()
+        Returns every option with votes and its count
+    """
+
+    def __init__(self):
+        self._votes = {}
+        self._counts = {}
+        # Options by vote count, dicts keep the order the count was reached
+        self._buckets = {}
+        self._max_count = 0
+
+    def __len__(self):
+        """Number of voters"""
+
+        return len(self._votes)
+
+    def __contains__(self, voter: Hashable):
+        return voter in self._votes
+
+    def count(self, option: Hashable) -> int:
+        return self._counts.get(option, 0)
+
+    def vote(self, voter: Hashable, option: Hashable) -> Optional[Hashable]:
+        """Cast or change the vote of a voter
+
+        Parameters
+        ----------
+        voter : Hashable
+            Id of the voter, like a Twitch user id
+        option : Hashable
+            The option voted for
+
+        Returns
+        -------
+            The previous vote of the voter, or None if it is a new vote
+        """
+
+        previous = self._votes.get(voter)
+        if previous == option:
+            return previous
+        if previous is not None:
+            self._move(previous, -1)
+        self._votes[voter] = option
+        self._move(option, 1)
+        return previous
+
+    def retract(self, voter: Hashable) -> Optional[Hashable]:
+        """Remove the vote of a voter
+
+        Returns
+        -------
+            The removed vote, or None if the voter had not voted
+        """
+
+        previous = self._votes.pop(voter, None)
+        if previous is not None:
+            self._move(previous, -1)
+        return previous
+
+    def leader(self) -> Optional[Tuple[Hashable, int]]:
+        """Get the leading option
+
+        Returns
+        -------
+            The leading option and its count, or None without votes
+        """
+
+        if self._max_count == 0:
+            return None
+        return next(iter(self._buckets[self._max_count])), self._max_count
+
+    def top(self, n: int) -> List[Tuple[Hashable, int]]:
+        """Get the n leading options, best first"""
+
+        result = []
+        # There are at most about sqrt(2 * voters) distinct counts
+        for count in sorted(self._buckets, reverse=True):
+            for option in self._buckets[count]:
+                if len(result) == n:
+                    return result
+                result.append((option, count))
+        return result
+
+    def standings(self) -> List[Tuple[Hashable, int]]:
+        """Get every option with votes and its count, best first"""
+
+        return self.top(len(self._counts))
+
+    def clear(self):
+        self._votes.clear()
+        self._counts.clear()
+        self._buckets.clear()
+        self._max_count = 0
+
+    def _move(self, option: Hashable, delta: int):
+        old_count = self._counts.get(option, 0)
+        new_count = old_count + delta
+        if old_count:
+            bucket = self._buckets[old_count]
+            del bucket[option]
+            if not bucket:
+                del self._buckets[old_count]
+        if new_count:
+            self._counts[option] = new_count
+            self._buckets.setdefault(new_count, {})[option] = None
+        else:
+            del self._counts[option]
+        if new_count > self._max_count:
+            self._max_count = new_count
+        elif old_count == self._max_count and old_count not in self._buckets:
+            self._max_count = new_count
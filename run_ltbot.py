@@ -30,6 +30,8 @@ from typing import List
 
 from ltbot import load_configuration, setup_logging
 from ltbot import LichessTwitchBot
+from ltbot import ShardSupervisor
+from ltbot import start_metrics_server
 
 
 __version__ = "0.0.1"
@@ -48,8 +50,8 @@ def signal_handler(signum: int, frame, bot: LichessTwitchBot):
         Number representation of the signal received
     frame
         The current call frame when the signal was received
-    bot_manager : LTBotManager
-        Manager of a Lichess Twitch Bot
+    bot : LichessTwitchBot
+        The bot, or the supervisor of the shards
     """
 
     signal_name = signal.Signals(signum).name
@@ -101,6 +103,27 @@ def main(main_args: List[str]):
     # Configuration setup
     configuration = load_configuration(Path(args.configuration))
 
+    # Host many channels over shard processes, each shard serves its own metrics
+    if "channels" in configuration:
+        supervisor = ShardSupervisor(
+            configuration=configuration,
+            version=__version__,
+            upgrade_lichess=args.upgrade_lichess,
+        )
+        signal.signal(
+            signal.SIGINT, lambda signum, frame: signal_handler(signum, frame, supervisor)
+        )
+        supervisor.run()
+        return
+
+    # Expose Lichess request metrics
+    metrics_configuration = configuration.get("metrics", {})
+    if metrics_configuration.get("enabled", False):
+        start_metrics_server(
+            port=metrics_configuration.get("port", 9108),
+            host=metrics_configuration.get("host", "127.0.0.1"),
+        )
+
     # Initialize bot
     bot = LichessTwitchBot(configuration=configuration, version=__version__)
 
@@ -0,0 +1,50 @@
+import chess
+import chess.variant
+
+from ltbot.analysis_cache import Analysis, AnalysisCache, variant_key
+
+
+def test_crazyhouse_pockets_are_part_of_the_key():
+    cache = AnalysisCache()
+    board = chess.variant.CrazyhouseBoard()
+    cache.put(board, Analysis("e2e4", None, 20, 30, None))
+
+    with_pocket = chess.variant.CrazyhouseBoard()
+    with_pocket.pockets[chess.WHITE].add(chess.KNIGHT)
+
+    assert variant_key(with_pocket) != variant_key(board)
+    assert cache.get(with_pocket) is None
+    assert cache.get(board).best_move == "e2e4"
+
+
+def test_three_check_counters_are_part_of_the_key():
+    cache = AnalysisCache()
+    board = chess.variant.ThreeCheckBoard()
+    cache.put(board, Analysis("e2e4", None, 20, 30, None))
+
+    checked = chess.variant.ThreeCheckBoard()
+    checked.remaining_checks[chess.WHITE] = 2
+
+    assert cache.get(checked) is None
+    assert cache.get(board).best_move == "e2e4"
+
+
+def test_repeated_positions_are_searched():
+    cache = AnalysisCache()
+    board = chess.Board()
+    cache.put(board, Analysis("e2e4", "e7e5", 20, 30, None))
+    assert cache.lookup(board, 20) == (chess.Move.from_uci("e2e4"), chess.Move.from_uci("e7e5"))
+
+    for move in ("g1f3", "g8f6", "f3g1", "f6g8"):
+        board.push_uci(move)
+
+    assert cache.lookup(board, 20) is None
+
+
+def test_shallow_analysis_is_not_used():
+    cache = AnalysisCache()
+    board = chess.Board()
+    cache.put(board, Analysis("e2e4", None, 12, 30, None))
+
+    assert cache.lookup(board, 20) is None
+    assert cache.lookup(board, 12) == (chess.Move.from_uci("e2e4"), None)
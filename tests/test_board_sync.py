@@ -0,0 +1,74 @@
+import chess
+import pytest
+
+from ltbot import board_sync
+from ltbot.board_sync import BoardSync, release_board, resume_board
+
+
+@pytest.fixture(autouse=True)
+def no_checkpoints(monkeypatch):
+    monkeypatch.setattr(board_sync, "_checkpoints", type(board_sync._checkpoints)())
+
+
+def test_update_pushes_new_moves():
+    sync = BoardSync("game", chess.Board())
+
+    assert sync.update("e2e4 e7e5") == ["e2e4", "e7e5"]
+    assert sync.update("e2e4 e7e5 g1f3") == ["g1f3"]
+
+    assert sync.moves == ["e2e4", "e7e5", "g1f3"]
+    assert sync.board.fen() == fen_after("e2e4 e7e5 g1f3")
+
+
+def test_update_rewinds_a_takeback():
+    sync = BoardSync("game", chess.Board())
+    sync.update("e2e4 e7e5 g1f3")
+
+    assert sync.update("e2e4 e7e5 f1c4") == ["f1c4"]
+
+    assert sync.rewound == 1
+    assert sync.board.fen() == fen_after("e2e4 e7e5 f1c4")
+
+
+def test_update_with_same_moves_pushes_nothing():
+    sync = BoardSync("game", chess.Board())
+    sync.update("e2e4")
+
+    assert sync.update("e2e4") == []
+    assert sync.rewound == 0
+
+
+def test_resume_from_checkpoint():
+    sync = resume_board("game", chess.Board(), "", checkpoint_interval=2)
+    sync.update("e2e4 e7e5")
+
+    # An empty board could not replay the game, the checkpoint is used
+    resumed = resume_board("game", chess.Board(None), "e2e4 e7e5 g1f3 b8c6", checkpoint_interval=2)
+
+    assert resumed.board is not sync.board
+    assert resumed.moves == ["e2e4", "e7e5", "g1f3", "b8c6"]
+    assert resumed.board.fen() == fen_after("e2e4 e7e5 g1f3 b8c6")
+
+
+def test_resume_ignores_checkpoint_the_moves_do_not_extend():
+    sync = resume_board("game", chess.Board(), "", checkpoint_interval=2)
+    sync.update("e2e4 e7e5")
+
+    resumed = resume_board("game", chess.Board(), "d2d4 d7d5", checkpoint_interval=2)
+
+    assert resumed.board.fen() == fen_after("d2d4 d7d5")
+
+
+def test_released_game_starts_over():
+    sync = resume_board("game", chess.Board(), "", checkpoint_interval=1)
+    sync.update("e2e4")
+    release_board("game")
+
+    assert board_sync._checkpoints == {}
+
+
+def fen_after(moves):
+    board = chess.Board()
+    for move in moves.split():
+        board.push_uci(move)
+    return board.fen()
@@ -0,0 +1,103 @@
+from ltbot.challenge_queue import ChallengeQueue
+
+
+class Challenge:
+    def __init__(self, challenge_id, score=0):
+        self.id = challenge_id
+        self._score = score
+
+    def score(self):
+        return self._score
+
+    def __repr__(self):
+        return "Challenge({})".format(self.id)
+
+
+def take_all(queue, now=0.0):
+    taken = []
+    while True:
+        item = queue.pop(now)
+        if item is None:
+            return taken
+        taken.append(item[0].id)
+
+
+def test_best_challenge_first_and_ties_by_arrival():
+    queue = ChallengeQueue("best")
+    queue.push(Challenge("low", 1), now=0.0)
+    queue.push(Challenge("high", 5), now=1.0)
+    queue.push(Challenge("high_later", 5), now=2.0)
+
+    snapshot = [challenge.id for challenge in queue.snapshot(now=2.0)]
+
+    assert snapshot == ["high", "high_later", "low"]
+    assert take_all(queue, now=2.0) == snapshot
+
+
+def test_first_come_first_served():
+    queue = ChallengeQueue("first")
+    queue.push(Challenge("first", 1), now=0.0)
+    queue.push(Challenge("better", 5), now=1.0)
+
+    challenge, queued = queue.pop(now=1.0)
+
+    assert challenge.id == "first"
+    assert queued == 0.0
+
+
+def test_expired_challenges_are_dropped():
+    queue = ChallengeQueue("best", max_age=30.0)
+    queue.push(Challenge("old", 5), now=0.0)
+    queue.push(Challenge("new", 1), now=20.0)
+
+    assert [challenge.id for challenge in queue.snapshot(now=40.0)] == ["new"]
+    assert take_all(queue, now=40.0) == ["new"]
+    assert len(queue) == 0
+
+
+def test_removed_challenge_is_skipped():
+    queue = ChallengeQueue("best")
+    queue.push(Challenge("canceled", 5), now=0.0)
+    queue.push(Challenge("kept", 1), now=0.0)
+
+    assert queue.remove("canceled")
+    assert not queue.remove("canceled")
+
+    assert "canceled" not in queue
+    assert take_all(queue) == ["kept"]
+
+
+def test_pushed_again_challenge_replaces_queued_one():
+    queue = ChallengeQueue("best")
+    queue.push(Challenge("a", 1), now=0.0)
+    queue.push(Challenge("b", 3), now=0.0)
+    queue.push(Challenge("a", 5), now=1.0)
+
+    assert len(queue) == 2
+    assert take_all(queue, now=1.0) == ["a", "b"]
+
+
+def test_heap_stays_bounded_under_cancels():
+    queue = ChallengeQueue("best")
+    for number in range(1000):
+        queue.push(Challenge(str(number), number), now=0.0)
+        queue.remove(str(number))
+
+    assert len(queue) == 0
+    assert len(queue._heap) <= 16
+
+
+def test_publish_updates_view_once_per_change():
+    view = []
+    queue = ChallengeQueue("best", view=view)
+    queue.push(Challenge("a", 1), now=0.0)
+    queue.publish(now=0.0)
+    assert [challenge.id for challenge in view] == ["a"]
+
+    view[:] = ["unchanged"]
+    queue.publish(now=0.0)
+    assert view == ["unchanged"]
+
+    queue.pop(now=0.0)
+    queue.publish(now=0.0)
+    assert view == []
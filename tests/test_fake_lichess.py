@@ -0,0 +1,41 @@
+import pytest
+from requests.exceptions import HTTPError
+
+from ltbot.fake_lichess import FakeLichess, ScriptedOpponent, start_fake_lichess
+from ltbot.lichess import Lichess
+
+
+@pytest.fixture
+def fake():
+    lichess = FakeLichess(default_opponent=ScriptedOpponent(think_time=60.0))
+    server = start_fake_lichess(lichess)
+    yield lichess, "http://127.0.0.1:{}/".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_fake_lichess_serves_game_snapshot(fake):
+    lichess, url = fake
+    li = Lichess("token", url, "1.0.0")
+    challenge = lichess.add_incoming_challenge("opponent")
+    li.accept_challenge(challenge["id"])
+    game = lichess.games[challenge["id"]]
+    with game.lock:
+        game.push(game.board.parse_uci("e2e4"))
+
+    snapshot = li.get_game(challenge["id"])
+
+    assert snapshot["type"] == "gameFull"
+    assert snapshot["id"] == challenge["id"]
+    assert snapshot["black"]["name"] == lichess.username
+    assert snapshot["state"]["moves"] == "e2e4"
+
+
+def test_fake_lichess_unknown_game(fake):
+    _, url = fake
+    li = Lichess("token", url, "1.0.0")
+
+    with pytest.raises(HTTPError) as error:
+        li.get_game("missing")
+
+    assert error.value.response.status_code == 404
@@ -0,0 +1,52 @@
+import time
+
+from ltbot.flood import FloodControl
+
+
+def test_user_burst_then_one_command_per_interval():
+    flood = FloodControl(user_limit=(0.1, 3), global_limit=(100.0, 100))
+    start = time.monotonic()
+
+    assert [flood.allow("alice", now=start) for _ in range(4)] == [True, True, True, False]
+    assert not flood.allow("alice", now=start + 9.0)
+    assert flood.allow("alice", now=start + 10.0)
+    assert not flood.allow("alice", now=start + 10.0)
+
+
+def test_users_have_separate_budgets():
+    flood = FloodControl(user_limit=(0.1, 1), global_limit=(100.0, 100))
+    start = time.monotonic()
+
+    assert flood.allow("alice", now=start)
+    assert not flood.allow("alice", now=start)
+    assert flood.allow("bob", now=start)
+
+
+def test_global_budget_limits_all_users():
+    flood = FloodControl(user_limit=(1.0, 5), global_limit=(1e-9, 2))
+
+    assert flood.allow("alice")
+    assert flood.allow("bob")
+    assert not flood.allow("carol")
+
+
+def test_rested_users_are_forgotten():
+    flood = FloodControl(user_limit=(0.1, 2), global_limit=(100.0, 100))
+    start = time.monotonic()
+    flood.allow("alice", now=start)
+    flood.allow("bob", now=start + 5.0)
+
+    # Alice's bucket is full again after 10 seconds, Bob's after 15
+    flood.allow("carol", now=start + 12.0)
+
+    assert len(flood) == 2
+
+
+def test_table_is_bounded():
+    flood = FloodControl(user_limit=(0.1, 1), global_limit=(100.0, 1000), max_users=10)
+    start = time.monotonic()
+
+    for user in range(100):
+        flood.allow(str(user), now=start)
+
+    assert len(flood) == 10
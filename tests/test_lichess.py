@@ -0,0 +1,49 @@
+import pickle
+
+from ltbot.lichess import Lichess
+
+
+def test_lichess_pickles():
+    li = Lichess("token", "https://lichess.org/", "1.0.0")
+    li.set_user_agent("bot")
+
+    copy = pickle.loads(pickle.dumps(li))
+
+    assert copy.header == li.header
+    assert copy.baseUrl == li.baseUrl
+    assert copy.scheduler is not li.scheduler
+    assert copy.cache is not li.cache
+    assert copy.session is not li.session
+
+
+def test_lichess_copy_caches_ongoing_games():
+    li = Lichess("token", "https://lichess.org/", "1.0.0")
+    copy = pickle.loads(pickle.dumps(li))
+    requests = []
+
+    def api_get(path, endpoint=None):
+        requests.append(endpoint)
+        return {"nowPlaying": [{"gameId": "abcd1234"}]}
+
+    copy.api_get = api_get
+
+    # Reconnects of a game share one request
+    for _ in range(3):
+        assert copy.get_ongoing_games() == [{"gameId": "abcd1234"}]
+    assert requests == ["playing"]
+
+
+def test_lichess_invalidated_ongoing_games_list_new_game():
+    li = Lichess("token", "https://lichess.org/", "1.0.0")
+    copy = pickle.loads(pickle.dumps(li))
+    ongoing = []
+    copy.api_get = lambda path, endpoint=None: {"nowPlaying": list(ongoing)}
+
+    # Loaded before the game started, the cached list would end the new game
+    assert copy.get_ongoing_games() == []
+    ongoing.append({"gameId": "abcd1234"})
+    assert copy.get_ongoing_games() == []
+
+    copy.invalidate_cache("playing")
+
+    assert copy.get_ongoing_games() == [{"gameId": "abcd1234"}]
@@ -0,0 +1,76 @@
+import multiprocessing
+import time
+
+from ltbot.metrics import Registry, collect_metrics, forward_metrics
+
+
+def test_counter_renders_mixed_label_values():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("endpoint", "status"))
+    requests.inc("move", 200)
+    requests.inc("move", "ReadTimeout")
+    requests.inc("move", "200")
+
+    rendered = registry.render()
+
+    assert 'requests_total{endpoint="move",status="200"} 2' in rendered
+    assert 'requests_total{endpoint="move",status="ReadTimeout"} 1' in rendered
+    assert requests.value("move", 200) == 2
+
+
+def test_histogram_renders_mixed_label_values():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", ("status",), buckets=(1.0,))
+    latency.observe(200, value=0.5)
+    latency.observe("ConnectionError", value=2.0)
+
+    rendered = registry.render()
+
+    assert 'latency_seconds_count{status="200"} 1' in rendered
+    assert 'latency_seconds_count{status="ConnectionError"} 1' in rendered
+    assert latency.quantile(0.5, 200) == 1.0
+
+
+def test_registry_renders_merged_snapshots():
+    registry = Registry()
+    moves = registry.counter("moves_total", "Moves")
+    overhead = registry.gauge("overhead_milliseconds", "Overhead")
+    delivery = registry.histogram("delivery_seconds", "Delivery", buckets=(1.0,))
+    moves.inc()
+
+    worker = Registry()
+    worker.counter("moves_total", "Moves").inc(amount=2)
+    worker.gauge("overhead_milliseconds", "Overhead").set(value=250)
+    worker.histogram("delivery_seconds", "Delivery", buckets=(1.0,)).observe(value=0.5)
+    registry.merge(1, worker.snapshot())
+    registry.merge(1, worker.snapshot())
+
+    rendered = registry.render()
+
+    assert "moves_total 3" in rendered
+    assert "overhead_milliseconds 250" in rendered
+    assert 'delivery_seconds_bucket{le="1.0"} 1' in rendered
+    assert delivery.count() == 0
+
+
+def _play(queue, registry):
+    forward_metrics(queue, interval=0.01, registry=registry)
+    registry.counter("moves_total", "Moves").inc()
+    time.sleep(0.2)
+
+
+def test_metrics_forwarded_from_worker_process():
+    registry = Registry()
+    registry.counter("moves_total", "Moves").inc()
+    queue = multiprocessing.Queue()
+    collect_metrics(queue, registry)
+
+    worker = multiprocessing.get_context("fork").Process(target=_play, args=(queue, registry))
+    worker.start()
+    worker.join()
+    deadline = time.monotonic() + 5
+    while "moves_total 2" not in registry.render() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # The worker starts from a cleared copy, its parent's count is not added twice
+    assert "moves_total 2" in registry.render()
@@ -0,0 +1,85 @@
+import pytest
+
+from ltbot import move_overhead
+from ltbot.move_overhead import MoveOverhead
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(move_overhead.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def play(overhead, clock, ply, request, delivery):
+    overhead.move_sent(ply)
+    clock.now += request
+    overhead.move_acknowledged()
+    clock.now += delivery - request
+    overhead.state_received(ply + 1)
+
+
+def test_configured_overhead_until_enough_moves(clock):
+    overhead = MoveOverhead(initial=1000)
+    play(overhead, clock, 0, 0.1, 0.2)
+    play(overhead, clock, 2, 0.1, 0.2)
+
+    assert overhead.milliseconds() == 1000
+
+
+def test_overhead_is_percentile_plus_margin(clock):
+    overhead = MoveOverhead(initial=1000, percentile=0.95, margin=50, minimum=0)
+    for ply in range(20):
+        play(overhead, clock, 2 * ply, 0.01, (ply + 1) / 100)
+
+    # The 95th percentile of 10 ms to 200 ms deliveries is 190 ms
+    assert overhead.milliseconds() == 240
+
+
+def test_overhead_is_bounded(clock):
+    overhead = MoveOverhead(initial=1000, minimum=100, maximum=500)
+    for ply in range(5):
+        play(overhead, clock, 2 * ply, 0.001, 0.002)
+    assert overhead.milliseconds() == 100
+
+    for ply in range(5, 40):
+        play(overhead, clock, 2 * ply, 2.0, 3.0)
+    assert overhead.milliseconds() == 500
+
+
+def test_window_forgets_old_moves(clock):
+    overhead = MoveOverhead(initial=1000, window=4, margin=0, minimum=0)
+    for ply in range(4):
+        play(overhead, clock, 2 * ply, 1.0, 1.0)
+    for ply in range(4, 8):
+        play(overhead, clock, 2 * ply, 0.1, 0.1)
+
+    assert overhead.milliseconds() == 100
+
+
+def test_state_without_the_sent_move_is_not_measured(clock):
+    overhead = MoveOverhead()
+    overhead.move_sent(10)
+    clock.now += 0.5
+    overhead.state_received(10)
+
+    assert len(overhead.delivery_seconds) == 0
+    overhead.state_received(11)
+    assert list(overhead.delivery_seconds) == [0.5]
+
+
+def test_fixed_overhead_when_adaptive_disabled():
+    overhead = MoveOverhead.from_config(
+        {"move_overhead": 700, "adaptive_move_overhead": {"enabled": False}}
+    )
+    overhead.request_seconds.extend([2.0] * 10)
+
+    assert overhead.milliseconds() == 700
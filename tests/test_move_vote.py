@@ -0,0 +1,57 @@
+import chess
+
+from ltbot.move_vote import LegalMoveIndex
+
+
+def test_accepts_uci_san_and_lower_case_san():
+    index = LegalMoveIndex(chess.Board())
+    knight = chess.Move.from_uci("g1f3")
+
+    assert index.get("g1f3") == knight
+    assert index.get("Nf3") == knight
+    assert index.get("nf3") == knight
+    assert index.get("NF3") == knight
+
+
+def test_accepts_san_without_check_symbol():
+    board = chess.Board("4k3/8/8/8/8/8/8/R3K3 w - - 0 1")
+    index = LegalMoveIndex(board)
+    check = chess.Move.from_uci("a1a8")
+
+    assert index.get("Ra8+") == check
+    assert index.get("Ra8") == check
+
+
+def test_rejects_illegal_moves():
+    index = LegalMoveIndex(chess.Board())
+
+    assert index.get("e2e5") is None
+    assert index.get("Ke2") is None
+    assert index.get("hello") is None
+    assert index.get("") is None
+
+
+def test_rejects_ambiguous_san():
+    board = chess.Board("4k3/8/8/8/8/5N2/8/1N2K3 w - - 0 1")
+    index = LegalMoveIndex(board)
+
+    assert index.get("Nd2") is None
+    assert index.get("Nbd2") == chess.Move.from_uci("b1d2")
+    assert index.get("Nfd2") == chess.Move.from_uci("f3d2")
+
+
+def test_bishop_and_pawn_capture_keep_their_case():
+    board = chess.Board("4k3/8/8/4B3/8/2n5/1P6/4K3 w - - 0 1")
+    index = LegalMoveIndex(board)
+
+    assert index.get("bxc3") == chess.Move.from_uci("b2c3")
+    assert index.get("Bxc3") == chess.Move.from_uci("e5c3")
+
+
+def test_index_is_bound_to_its_position():
+    board = chess.Board()
+    index = LegalMoveIndex(board)
+    board.push_uci("e2e4")
+
+    assert index.get("e2e4") == chess.Move.from_uci("e2e4")
+    assert LegalMoveIndex(board).get("e2e4") is None
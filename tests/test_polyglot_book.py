@@ -0,0 +1,68 @@
+import struct
+
+import chess
+import chess.polyglot
+import pytest
+
+from ltbot.polyglot_book import PolyglotBook
+
+ENTRY = struct.Struct(">QHHI")
+
+
+def raw_move(uci):
+    move = chess.Move.from_uci(uci)
+    return move.to_square | move.from_square << 6
+
+
+@pytest.fixture
+def book(tmp_path):
+    start = chess.Board()
+    after_e4 = chess.Board()
+    after_e4.push_uci("e2e4")
+    entries = [
+        (chess.polyglot.zobrist_hash(start), raw_move("e2e4"), 10),
+        (chess.polyglot.zobrist_hash(start), raw_move("d2d4"), 30),
+        (chess.polyglot.zobrist_hash(start), raw_move("g1f3"), 0),
+        (chess.polyglot.zobrist_hash(after_e4), raw_move("c7c5"), 0),
+    ]
+    path = tmp_path / "book.bin"
+    path.write_bytes(
+        b"".join(ENTRY.pack(key, move, weight, 0) for key, move, weight in sorted(entries))
+    )
+    book = PolyglotBook(str(path), minimum_weight=1)
+    yield book
+    book.close()
+
+
+def test_book_builds_position_tables_on_lookup(book):
+    assert len(book) == 4
+    assert len(book._positions) == 0
+
+    assert book.best_move(chess.Board()) == chess.Move.from_uci("d2d4")
+    assert len(book._positions) == 1
+
+
+def test_book_choices_skip_light_entries(book):
+    board = chess.Board()
+    heavy = {chess.Move.from_uci("e2e4"), chess.Move.from_uci("d2d4")}
+
+    for _ in range(50):
+        assert book.weighted_choice(board) in heavy
+        assert book.choice(board) in heavy
+
+
+def test_book_position_without_moves(book):
+    board = chess.Board()
+    board.push_uci("e2e4")
+
+    assert book.weighted_choice(board) is None
+    assert book.choice(board) is None
+    assert book.best_move(board) is None
+
+
+def test_book_position_not_in_book(book):
+    board = chess.Board()
+    board.push_uci("a2a3")
+
+    assert book.best_move(board) is None
+    assert book.weighted_choice(board) is None
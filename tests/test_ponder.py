@@ -0,0 +1,62 @@
+import threading
+
+import chess
+
+from ltbot.metrics import REGISTRY
+from ltbot.ponder import PONDER_TOTAL, PonderManager
+
+
+class FakeUci:
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.hit = threading.Event()
+
+    def ponderhit(self):
+        self.hit.set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FakeEngine:
+    def __init__(self, result):
+        self.engine = FakeUci()
+        self.result = result
+
+    def search_with_ponder(self, board, wtime, btime, winc, binc, ponder=False):
+        # A ponder search runs until the opponent moves
+        while not (self.engine.hit.is_set() or self.engine.stopped.is_set()):
+            self.engine.hit.wait(0.01)
+        return self.result
+
+
+def start(ponder):
+    board = chess.Board()
+    ponder.start(board, chess.Move.from_uci("e2e4"), chess.Move.from_uci("e7e5"), 1, 1, 0, 0)
+
+
+def test_ponder_hit_returns_search_result():
+    result = (chess.Move.from_uci("g1f3"), chess.Move.from_uci("b8c6"))
+    ponder = PonderManager(FakeEngine(result), "game")
+    hits = PONDER_TOTAL.value("hit")
+    start(ponder)
+
+    assert ponder.resolve("e7e5") == result
+    assert not ponder.pondering
+    assert ponder.hits == 1
+    assert PONDER_TOTAL.value("hit") == hits + 1
+    # Game processes forward their registry, the ponder counts are part of it
+    assert REGISTRY.snapshot()["ltbot_ponder_total"][("hit",)] == hits + 1
+
+
+def test_ponder_miss_stops_search():
+    engine = FakeEngine(None)
+    ponder = PonderManager(engine, "game")
+    misses = PONDER_TOTAL.value("miss")
+    start(ponder)
+
+    assert ponder.resolve("c7c5") is None
+    assert engine.engine.stopped.is_set()
+    ponder.close(timeout=1)
+    assert ponder.misses == 1
+    assert PONDER_TOTAL.value("miss") == misses + 1
@@ -0,0 +1,86 @@
+import multiprocessing
+import pickle
+import threading
+import time
+
+from ltbot import scheduler
+from ltbot.lichess import Lichess
+from ltbot.scheduler import Priority, RequestScheduler, SharedBudget, retry_after_seconds
+
+
+def test_waiting_requests_are_served_by_priority():
+    requests = RequestScheduler(global_limit=(20.0, 1), move_reserve=0)
+    requests.acquire("chat", Priority.CHAT)
+    served = []
+
+    def send(endpoint, priority):
+        requests.acquire(endpoint, priority)
+        served.append(endpoint)
+
+    threads = [
+        threading.Thread(target=send, args=("chat", Priority.CHAT)),
+        threading.Thread(target=send, args=("game", Priority.GAME)),
+        threading.Thread(target=send, args=("move", Priority.MOVE)),
+    ]
+    with requests._condition:
+        # Queue every request before the bucket refills
+        for thread in threads:
+            thread.start()
+        while len(requests._waiting) < len(threads):
+            requests._condition.wait(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert served == ["move", "game", "chat"]
+
+
+def test_move_reserve_is_only_available_to_moves():
+    requests = RequestScheduler(global_limit=(0.001, 3), move_reserve=2)
+
+    assert requests.reserve("chat", Priority.CHAT) == 0.0
+    assert requests.reserve("chat", Priority.CHAT) > 0.0
+    assert requests.reserve("move", Priority.MOVE) == 0.0
+
+
+def test_cooldown_pauses_every_endpoint():
+    requests = RequestScheduler()
+    requests.cooldown(retry_after_seconds({"Retry-After": "30"}))
+
+    assert requests.reserve("move", Priority.MOVE) > 29.0
+    assert requests.reserve("profile") > 29.0
+
+
+def test_retry_after_defaults_to_a_minute():
+    assert retry_after_seconds({}) == 60.0
+    assert retry_after_seconds({"Retry-After": "soon"}) == 60.0
+
+
+def _rate_limited(budget):
+    child = RequestScheduler(shared=budget)
+    child.acquire("move", Priority.MOVE)
+    child.cooldown(30)
+
+
+def test_shared_budget_spans_processes():
+    budget = SharedBudget(global_limit=(0.001, 2))
+    parent = RequestScheduler(shared=budget, move_reserve=0)
+
+    process = multiprocessing.get_context("fork").Process(target=_rate_limited, args=(budget,))
+    process.start()
+    process.join()
+
+    # The child took one of the two tokens and saw a 429
+    assert budget.wait_time(time.monotonic()) == 0.0
+    assert budget.wait_time(time.monotonic(), 2.0) > 0.0
+    assert parent.reserve("move", Priority.MOVE) > 29.0
+
+
+def test_lichess_copy_uses_shared_budget(monkeypatch):
+    budget = SharedBudget()
+    monkeypatch.setattr(scheduler, "_shared_budget", budget)
+    li = Lichess("token", "https://lichess.org/", "1.0.0")
+
+    copy = pickle.loads(pickle.dumps(li))
+
+    assert li.scheduler.shared is budget
+    assert copy.scheduler.shared is budget
@@ -0,0 +1,69 @@
+from ltbot.vote import VoteTally
+
+
+def test_vote_counts_and_leader():
+    tally = VoteTally()
+
+    assert tally.leader() is None
+    assert tally.vote("alice", "lichess") is None
+    assert tally.vote("bob", "stockfish") is None
+    assert tally.vote("carol", "stockfish") is None
+
+    assert tally.leader() == ("stockfish", 2)
+    assert tally.standings() == [("stockfish", 2), ("lichess", 1)]
+    assert len(tally) == 3
+
+
+def test_changed_vote_moves_to_new_option():
+    tally = VoteTally()
+    tally.vote("alice", "lichess")
+    tally.vote("bob", "lichess")
+
+    assert tally.vote("alice", "stockfish") == "lichess"
+
+    assert tally.count("lichess") == 1
+    assert tally.count("stockfish") == 1
+    assert len(tally) == 2
+
+
+def test_repeated_vote_counts_once():
+    tally = VoteTally()
+    tally.vote("alice", "lichess")
+
+    assert tally.vote("alice", "lichess") == "lichess"
+
+    assert tally.count("lichess") == 1
+    assert tally.leader() == ("lichess", 1)
+
+
+def test_tie_is_led_by_first_option_to_reach_count():
+    tally = VoteTally()
+    tally.vote("alice", "lichess")
+    tally.vote("bob", "stockfish")
+
+    assert tally.leader() == ("lichess", 1)
+    assert tally.top(1) == [("lichess", 1)]
+
+
+def test_leader_drops_when_votes_move_away():
+    tally = VoteTally()
+    tally.vote("alice", "lichess")
+    tally.vote("bob", "lichess")
+    tally.vote("carol", "stockfish")
+
+    tally.vote("alice", "stockfish")
+    tally.retract("bob")
+
+    assert tally.leader() == ("stockfish", 2)
+    assert tally.count("lichess") == 0
+    assert tally.standings() == [("stockfish", 2)]
+
+
+def test_clear_forgets_votes():
+    tally = VoteTally()
+    tally.vote("alice", "lichess")
+
+    tally.clear()
+
+    assert tally.leader() is None
+    assert "alice" not in tally